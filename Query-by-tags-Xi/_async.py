@@ -0,0 +1,47 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+# boto3 and PynamoDB only have blocking clients, so the async path runs each call on a
+# worker thread and awaits it. The semaphore bounds how many reads are in flight at
+# once so a wide search can't exhaust the table's read capacity in one burst.
+ASYNC_QUERIES = os.environ.get("ASYNC_QUERIES", "true").lower() == "true"
+MAX_CONCURRENCY = int(os.environ.get("MAX_CONCURRENCY", "16"))
+BATCH_GET_SIZE = 100
+
+# Shared across warm invocations; the pool is sized to the semaphore
+_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY)
+
+
+async def _bounded(semaphore, call):
+    async with semaphore:
+        return await asyncio.get_running_loop().run_in_executor(_executor, call)
+
+async def _gather(calls, limit):
+    semaphore = asyncio.Semaphore(limit)
+    return await asyncio.gather(*(_bounded(semaphore, call) for call in calls))
+
+def run_all(calls, limit=MAX_CONCURRENCY):
+    """
+    Runs independent blocking calls (zero-argument callables) and returns their
+    results in order. With ASYNC_QUERIES on they run concurrently, at most limit at a
+    time; otherwise one after another like before.
+    """
+    calls = list(calls)
+    if not ASYNC_QUERIES or len(calls) < 2:
+        return [call() for call in calls]
+    return asyncio.run(_gather(calls, min(limit, MAX_CONCURRENCY)))
+
+
+def _batch_get_chunk(model, chunk):
+    return list(model.batch_get(chunk))
+
+def batch_get(model, keys):
+    """
+    Model.batch_get split into 100-key requests that are sent concurrently.
+    """
+    keys = list(keys)
+    chunks = [keys[i:i + BATCH_GET_SIZE] for i in range(0, len(keys), BATCH_GET_SIZE)]
+    calls = [partial(_batch_get_chunk, model, chunk) for chunk in chunks]
+    return [item for items in run_all(calls) for item in items]
@@ -0,0 +1,155 @@
+import base64
+import json
+import os
+import time
+import zlib
+
+# Precomputed species index: every MediaID gets a dense integer ordinal and every
+# (species, min-count bucket) pair gets a bitmap of the ordinals that qualify.
+# Bitmaps are plain Python ints, so intersecting species is a single C-level AND.
+BITMAP_BUCKET = os.environ.get("BITMAP_INDEX_BUCKET", "birdstore")
+BITMAP_KEY = os.environ.get("BITMAP_INDEX_KEY", "indexes/species-bitmaps.json")
+BITMAP_TTL = int(os.environ.get("BITMAP_INDEX_TTL", "60"))
+
+# A media file is in bucket b of a species when its count is >= b
+MIN_COUNT_BUCKETS = (1, 2, 3, 4, 5, 10, 20)
+
+
+def _encode(bits):
+    raw = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+    return base64.b64encode(zlib.compress(raw)).decode("ascii")
+
+def _decode(text):
+    return int.from_bytes(zlib.decompress(base64.b64decode(text)), "little")
+
+def _members(bits):
+    raw = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+    for byte_index, byte in enumerate(raw):
+        if not byte:
+            continue
+        for bit in range(8):
+            if byte >> bit & 1:
+                yield byte_index * 8 + bit
+
+
+class SpeciesBitmapIndex:
+    def __init__(self, media_ids=None, bitmaps=None):
+        self.media_ids = list(media_ids or [])
+        self.ordinals = {media_id: i for i, media_id in enumerate(self.media_ids)}
+        # species -> {bucket: bitmap}
+        self.bitmaps = bitmaps or {}
+
+    def ordinal(self, media_id):
+        if media_id not in self.ordinals:
+            self.ordinals[media_id] = len(self.media_ids)
+            self.media_ids.append(media_id)
+        return self.ordinals[media_id]
+
+    def set(self, species, media_id, count):
+        bit = 1 << self.ordinal(media_id)
+        buckets = self.bitmaps.setdefault(species.lower(), {})
+        for bucket in MIN_COUNT_BUCKETS:
+            if count >= bucket:
+                buckets[bucket] = buckets.get(bucket, 0) | bit
+            elif bucket in buckets:
+                buckets[bucket] &= ~bit
+
+    def remove(self, species, media_id):
+        if media_id not in self.ordinals or species.lower() not in self.bitmaps:
+            return
+        mask = ~(1 << self.ordinals[media_id])
+        buckets = self.bitmaps[species.lower()]
+        for bucket in buckets:
+            buckets[bucket] &= mask
+
+    def cardinality(self, species, min_count=1):
+        """
+        Number of media files with at least min_count of a species, rounded down to the
+        nearest bucket so it stays an upper bound.
+        """
+        buckets = [bucket for bucket in MIN_COUNT_BUCKETS if bucket <= min_count]
+        bits = self.bitmaps.get(species, {}).get(buckets[-1] if buckets else 1, 0)
+        return bin(bits).count("1")
+
+    def species_ids(self, species, min_count):
+        if min_count not in MIN_COUNT_BUCKETS:
+            return None
+        bits = self.bitmaps.get(species, {}).get(min_count, 0)
+        return {self.media_ids[i] for i in _members(bits)}
+
+    def match(self, filter_tags):
+        """
+        Returns the MediaIDs that satisfy every species>=count filter, or None when a
+        count has no bucket and the caller has to read the index table instead.
+        """
+        if any(min_count not in MIN_COUNT_BUCKETS for min_count in filter_tags.values()):
+            return None
+
+        bits = None
+        for species, min_count in filter_tags.items():
+            species_bits = self.bitmaps.get(species, {}).get(min_count, 0)
+            bits = species_bits if bits is None else bits & species_bits
+            if not bits:
+                return set()
+        return {self.media_ids[i] for i in _members(bits)}
+
+    def to_json(self):
+        return json.dumps({
+            "buckets": list(MIN_COUNT_BUCKETS),
+            "media_ids": self.media_ids,
+            "bitmaps": {
+                species: {str(bucket): _encode(bits) for bucket, bits in buckets.items()}
+                for species, buckets in self.bitmaps.items()
+            }
+        })
+
+    @classmethod
+    def from_json(cls, text):
+        data = json.loads(text)
+        if tuple(data.get("buckets", [])) != MIN_COUNT_BUCKETS:
+            # built with other buckets; the stored bitmaps can't answer our filters
+            raise ValueError("Bitmap index was built with different count buckets")
+        bitmaps = {
+            species: {int(bucket): _decode(bits) for bucket, bits in buckets.items()}
+            for species, buckets in data["bitmaps"].items()
+        }
+        return cls(data["media_ids"], bitmaps)
+
+
+# Warm containers keep the loaded index and only re-check S3 once per TTL
+_cache = {"index": None, "etag": None, "checked_at": 0.0}
+
+def load_index(s3_client):
+    """
+    Returns (index, etag) straight from S3, or (None, None) when it doesn't exist yet.
+    """
+    try:
+        obj = s3_client.get_object(Bucket=BITMAP_BUCKET, Key=BITMAP_KEY)
+    except s3_client.exceptions.NoSuchKey:
+        return None, None
+    return SpeciesBitmapIndex.from_json(obj["Body"].read()), obj["ETag"]
+
+def get_index(s3_client):
+    now = time.time()
+    if now - _cache["checked_at"] < BITMAP_TTL:
+        return _cache["index"]
+    _cache["checked_at"] = now
+
+    try:
+        head = s3_client.head_object(Bucket=BITMAP_BUCKET, Key=BITMAP_KEY)
+        if head["ETag"] != _cache["etag"]:
+            _cache["index"], _cache["etag"] = load_index(s3_client)
+            print(f"Loaded bitmap index {BITMAP_KEY} ({_cache['etag']})")
+    except Exception as e:
+        # keep serving the copy we have; the index table is always there as fallback
+        print(f"Error loading bitmap index: {e}")
+    return _cache["index"]
+
+def match(filter_tags, s3_client):
+    """
+    MediaIDs matching all filters from the bitmap index, or None if it can't answer.
+    """
+    index = get_index(s3_client)
+    if index is None:
+        return None
+    return index.match(filter_tags)
@@ -0,0 +1,427 @@
+import os
+import re
+import _async
+import _bitmap
+from models import BirdBaseModel, BirdBaseIndexModel, has_media_copy
+
+# Tag search expressions, e.g.
+#   crow>=2 AND (owl OR NOT duck=1..3) AND FileType=image AND Uploader!=user_7
+# A bare species means ">=1"; "a..b" is an inclusive count range.
+
+# Media attributes that can be filtered on, as written in a query -> attribute name
+ATTRIBUTES = {"filetype": "FileType", "uploader": "Uploader"}
+
+# Partition size assumed for a species when the bitmap index has no statistics
+DEFAULT_PARTITION_ROWS = 1000
+
+# A full BirdBase scan; only used when nothing narrower can answer a predicate
+SCAN_COST = 10 ** 9
+# Queries with no positive species (e.g. "NOT duck", "FileType=video") have to scan
+# BirdBase; they return at most this many records and the plan says "capped"
+SCAN_LIMIT = int(os.environ.get("QUERY_SCAN_LIMIT", "1000"))
+
+_TOKEN = re.compile(r'\s*(?:(?P<paren>[()])|(?P<op>>=|<=|!=|=|>|<)|"(?P<quoted>[^"]*)"|(?P<word>[\w.\-]+))')
+_RANGE = re.compile(r"^(\d*)\.\.(\d*)$")
+
+
+class QueryError(ValueError):
+    pass
+
+
+class Species:
+    def __init__(self, name, low, high=None):
+        self.name = name
+        self.low = max(low, 1)
+        self.high = high
+
+    def matches(self, count):
+        return count >= self.low and (self.high is None or count <= self.high)
+
+    def __str__(self):
+        if self.high is None:
+            return f"{self.name}>={self.low}"
+        if self.low == self.high:
+            return f"{self.name}={self.low}"
+        return f"{self.name}={self.low}..{self.high}"
+
+class Attribute:
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+
+    def matches(self, record):
+        return getattr(record, self.name) == self.value
+
+    def __str__(self):
+        return f'{self.name}="{self.value}"'
+
+class Not:
+    def __init__(self, child):
+        self.child = child
+
+    def __str__(self):
+        return f"NOT {self.child}"
+
+class And:
+    def __init__(self, children):
+        self.children = children
+
+    def __str__(self):
+        return "(" + " AND ".join(str(child) for child in self.children) + ")"
+
+class Or:
+    def __init__(self, children):
+        self.children = children
+
+    def __str__(self):
+        return "(" + " OR ".join(str(child) for child in self.children) + ")"
+
+
+def tokenize(text):
+    tokens = []
+    pos = 0
+    text = text.strip()
+    while pos < len(text):
+        match = _TOKEN.match(text, pos)
+        if not match or match.end() == pos:
+            raise QueryError(f"Unexpected character at position {pos}: {text[pos:pos + 10]!r}")
+        pos = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "word" and value.upper() in ("AND", "OR", "NOT"):
+            kind, value = "keyword", value.upper()
+        elif kind == "quoted":
+            kind = "word"
+        tokens.append((kind, value))
+    return tokens
+
+class _Parser:
+    def __init__(self, text):
+        self.tokens = tokenize(text)
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def accept(self, kind, value=None):
+        token_kind, token_value = self.peek()
+        if token_kind == kind and (value is None or token_value == value):
+            self.pos += 1
+            return token_value
+        return None
+
+    def expect(self, kind, value=None):
+        token = self.accept(kind, value)
+        if token is None:
+            found = self.peek()[1]
+            raise QueryError(f"Expected {value or kind} but found {found or 'end of query'}")
+        return token
+
+    def parse(self):
+        if not self.tokens:
+            raise QueryError("Empty query")
+        node = self.expression()
+        if self.pos < len(self.tokens):
+            raise QueryError(f"Unexpected {self.peek()[1]!r}")
+        return node
+
+    def expression(self):
+        children = [self.term()]
+        while self.accept("keyword", "OR"):
+            children.append(self.term())
+        return children[0] if len(children) == 1 else Or(children)
+
+    def term(self):
+        children = [self.factor()]
+        while self.accept("keyword", "AND"):
+            children.append(self.factor())
+        return children[0] if len(children) == 1 else And(children)
+
+    def factor(self):
+        if self.accept("keyword", "NOT"):
+            return Not(self.factor())
+        if self.accept("paren", "("):
+            node = self.expression()
+            self.expect("paren", ")")
+            return node
+        return self.predicate()
+
+    def predicate(self):
+        name = self.expect("word")
+        op = self.accept("op")
+
+        if name.lower() in ATTRIBUTES:
+            if op not in ("=", "!="):
+                raise QueryError(f"{name} only supports = and !=")
+            node = Attribute(ATTRIBUTES[name.lower()], self.expect("word"))
+            return Not(node) if op == "!=" else node
+
+        species = name.lower()
+        if op is None:
+            return Species(species, 1)
+
+        value = self.expect("word")
+        value_range = _RANGE.match(value)
+        if value_range and op == "=":
+            low, high = value_range.groups()
+            return Species(species, int(low or 1), int(high) if high else None)
+        if not value.isdigit():
+            raise QueryError(f"Invalid count {value!r} for {name}")
+
+        count = int(value)
+        if op == ">=":
+            return Species(species, count)
+        if op == ">":
+            return Species(species, count + 1)
+        if op == "<=":
+            return Species(species, 1, count)
+        if op == "<":
+            return Species(species, 1, count - 1)
+        if op == "=":
+            return Species(species, count, count)
+        # "!=" still requires the species, just not with that count
+        return Or([Species(species, 1, count - 1), Species(species, count + 1)])
+
+def parse(text):
+    return _Parser(text).parse()
+
+
+def _has_media(row):
+    return row is not None and row.FileType is not None and row.MediaURL is not None
+
+def _is_complete(row):
+    # BirdBase records are the source; index rows only count with a full copy
+    return isinstance(row, BirdBaseModel) or has_media_copy(row)
+
+def _index_filter(filters):
+    """
+    Pushes attribute predicates down into an index query. Rows written before the media
+    attributes were copied onto the index pass through and are checked after hydration.
+    """
+    condition = None
+    for node in filters:
+        negate = isinstance(node, Not)
+        attribute = node.child if negate else node
+        field = getattr(BirdBaseIndexModel, attribute.name)
+        check = (field != attribute.value) if negate else (field == attribute.value)
+        check = check | field.does_not_exist()
+        condition = check if condition is None else condition & check
+    return condition
+
+def _scan_filter(filters):
+    condition = None
+    for node in filters:
+        negate = isinstance(node, Not)
+        attribute = node.child if negate else node
+        field = getattr(BirdBaseModel, attribute.name)
+        check = (field != attribute.value) if negate else (field == attribute.value)
+        condition = check if condition is None else condition & check
+    return condition
+
+def _is_attribute(node):
+    return isinstance(node, Attribute) or (isinstance(node, Not) and isinstance(node.child, Attribute))
+
+
+class Planner:
+    """
+    Evaluates a parsed expression, choosing per species predicate the cheapest of:
+      cached     - the species bitmap index in S3; no index reads, but its IDs are
+                   hydrated from BirdBase, so it costs one read per result
+      probe      - batch get of (species, MediaID) for an already narrowed candidate set
+      count      - TagValueIndex query with the count range as key condition
+      key        - BirdBaseIndex partition query with the count as filter
+    Every stage is recorded with its read count so the plan can be returned for debugging.
+    A BirdBase scan stops after SCAN_LIMIT records and marks the plan "capped".
+    """
+
+    def __init__(self, s3_client):
+        self.bitmap = _bitmap.get_index(s3_client)
+        # MediaID -> index row or BirdBase record, whichever was read first
+        self.rows = {}
+        self.stages = []
+        self.capped = False
+
+    def record(self, predicate, path, reads, rows):
+        self.stages.append({"predicate": str(predicate), "path": path, "reads": reads, "rows": rows})
+
+    def remember(self, row):
+        if not _is_complete(self.rows.get(row.MediaID)):
+            self.rows[row.MediaID] = row
+
+    # --- cost estimates -----------------------------------------------------------
+
+    def partition_rows(self, species):
+        if self.bitmap is None:
+            return DEFAULT_PARTITION_ROWS
+        return self.bitmap.cardinality(species)
+
+    def species_costs(self, node, candidates=None):
+        costs = {}
+        if self.bitmap is not None and node.high is None and node.low in _bitmap.MIN_COUNT_BUCKETS:
+            # the IDs are free, but each one without a row is hydrated from BirdBase
+            matches = self.bitmap.cardinality(node.name, node.low)
+            costs["cached"] = matches if candidates is None else min(matches, len(candidates))
+        if candidates is not None:
+            costs["probe"] = len(candidates)
+        partition = self.partition_rows(node.name)
+        costs["key"] = partition
+        if node.low > 1 or node.high is not None:
+            if self.bitmap is not None:
+                costs["count"] = self.bitmap.cardinality(node.name, node.low)
+            else:
+                # a bounded range reads only its slice of the partition
+                costs["count"] = partition // 2
+        return costs
+
+    def estimate(self, node):
+        if isinstance(node, Species):
+            return min(self.species_costs(node).values())
+        if isinstance(node, Or):
+            return sum(self.estimate(child) for child in node.children)
+        if isinstance(node, And):
+            positives = [child for child in node.children if not isinstance(child, Not) and not _is_attribute(child)]
+            return min((self.estimate(child) for child in positives), default=SCAN_COST)
+        return SCAN_COST
+
+    # --- evaluation -----------------------------------------------------------------
+
+    def evaluate(self, node, candidates=None, filters=()):
+        """
+        MediaIDs matching node; restricted to candidates when they are given.
+        """
+        if isinstance(node, Species):
+            return self.species(node, candidates, filters)
+        if isinstance(node, Attribute):
+            return self.attribute(node, candidates)
+        if isinstance(node, Not):
+            base = candidates if candidates is not None else self.universe(filters)
+            return base - self.evaluate(node.child, base)
+        if isinstance(node, Or):
+            result = set()
+            for child in node.children:
+                result |= self.evaluate(child, candidates, filters)
+            return result
+        return self.conjunction(node, candidates, filters)
+
+    def conjunction(self, node, candidates, filters):
+        attributes = [child for child in node.children if _is_attribute(child)]
+        negatives = [child for child in node.children if isinstance(child, Not) and child not in attributes]
+        positives = [child for child in node.children if child not in attributes and child not in negatives]
+        filters = tuple(filters) + tuple(attributes)
+
+        # cheapest first, so later predicates can probe the narrowed candidate set
+        result = candidates
+        for child in sorted(positives, key=self.estimate):
+            result = self.evaluate(child, result, filters)
+            if not result:
+                return set()
+
+        if result is None:
+            result = self.universe(filters)
+        for child in attributes + negatives:
+            result = self.evaluate(child, result)
+            if not result:
+                break
+        return result
+
+    def species(self, node, candidates, filters):
+        if node.high is not None and node.high < node.low:
+            self.record(node, "empty", 0, 0)
+            return set()
+
+        costs = self.species_costs(node, candidates)
+        path = min(costs, key=costs.get)
+
+        if path == "cached":
+            ids = self.bitmap.species_ids(node.name, node.low)
+            self.record(node, path, 0, len(ids))
+            return ids if candidates is None else ids & candidates
+
+        ids = set()
+        if path == "probe":
+            keys = [(node.name, media_id) for media_id in candidates]
+            reads = len(keys)
+            for row in _async.batch_get(BirdBaseIndexModel, keys):
+                if node.matches(row.TagValue):
+                    ids.add(row.MediaID)
+                    self.remember(row)
+            self.record(node, path, reads, len(ids))
+            return ids
+
+        condition = _index_filter(filters)
+        if path == "count":
+            if node.high is None:
+                key_condition = BirdBaseIndexModel.TagValue >= node.low
+            else:
+                key_condition = BirdBaseIndexModel.TagValue.between(node.low, node.high)
+            rows = BirdBaseIndexModel.tag_value_index.query(
+                node.name, range_key_condition=key_condition, filter_condition=condition
+            )
+        else:
+            count_condition = BirdBaseIndexModel.TagValue >= node.low
+            if node.high is not None:
+                count_condition = BirdBaseIndexModel.TagValue.between(node.low, node.high)
+            condition = count_condition if condition is None else count_condition & condition
+            rows = BirdBaseIndexModel.query(node.name, filter_condition=condition)
+
+        for row in rows:
+            if candidates is None or row.MediaID in candidates:
+                ids.add(row.MediaID)
+                self.remember(row)
+        self.record(node, path, rows.page_iter.total_scanned_count, len(ids))
+        return ids
+
+    def attribute(self, node, candidates):
+        if candidates is None:
+            return self.universe((node,))
+        # copied FileType/Uploader answer the filter; a missing ThumbnailURL can wait for run()
+        self.hydrate([media_id for media_id in candidates if not _has_media(self.rows.get(media_id))])
+        return {
+            media_id for media_id in candidates
+            if _has_media(self.rows.get(media_id)) and node.matches(self.rows[media_id])
+        }
+
+    def universe(self, filters=()):
+        rows = BirdBaseModel.scan(_scan_filter(filters), limit=SCAN_LIMIT)
+        ids = set()
+        for row in rows:
+            ids.add(row.MediaID)
+            self.rows[row.MediaID] = row
+        if len(ids) >= SCAN_LIMIT:
+            self.capped = True
+        self.record(" AND ".join(str(node) for node in filters) or "*", "scan",
+                    rows.page_iter.total_scanned_count, len(ids))
+        return ids
+
+    def hydrate(self, media_ids):
+        missing = [media_id for media_id in media_ids if not _is_complete(self.rows.get(media_id))]
+        if not missing:
+            return
+        found = set()
+        for item in _async.batch_get(BirdBaseModel, missing):
+            self.rows[item.MediaID] = item
+            found.add(item.MediaID)
+        # no BirdBase record means the media was deleted, whatever its index row says
+        for media_id in set(missing) - found:
+            self.rows.pop(media_id, None)
+        self.record("hydrate", "batch_get", len(missing), len(found))
+
+    def run(self, node):
+        ids = self.evaluate(node)
+        self.hydrate(ids)
+        # media deleted since its tags were indexed has no BirdBase record any more
+        records = [self.rows[media_id] for media_id in ids if _has_media(self.rows.get(media_id))]
+        plan = {
+            "query": str(node),
+            "stages": self.stages,
+            "reads": sum(stage["reads"] for stage in self.stages),
+            # results may be missing when a scan stopped at SCAN_LIMIT
+            "capped": self.capped
+        }
+        return records, plan
+
+def run(text, s3_client):
+    """
+    Parses and executes a search expression; returns (media records, plan).
+    """
+    return Planner(s3_client).run(parse(text))
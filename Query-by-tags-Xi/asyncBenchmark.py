@@ -0,0 +1,113 @@
+"""
+Compares the sequential and async query paths against a local DynamoDB stand-in.
+
+    docker run -p 8000:8000 amazon/dynamodb-local
+    DYNAMODB_HOST=http://localhost:8000 python asyncBenchmark.py --media 500 --latency-ms 20
+
+--latency-ms adds a fixed delay to every DynamoDB request, because a local table answers
+far faster than the real service and hides the round trips the async path overlaps.
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import statistics
+import time
+import uuid
+
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "local")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "local")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+from pynamodb.connection.base import Connection
+import _async
+import _bitmap
+import queryByTagsFunction
+import queryByThumbnailURLFunction
+import queryTagsByMediaIDFunction
+from models import BirdBaseModel, BirdBaseIndexModel
+
+SPECIES = ["crow", "owl", "pigeon", "sparrow", "duck", "eagle", "magpie", "kookaburra"]
+BUCKET_URL = "https://birdstore.s3.us-east-1.amazonaws.com"
+
+
+def add_latency(latency_ms):
+    make_api_call = Connection._make_api_call
+
+    def delayed(self, *args, **kwargs):
+        time.sleep(latency_ms / 1000)
+        return make_api_call(self, *args, **kwargs)
+
+    Connection._make_api_call = delayed
+
+def seed(media_count):
+    for model in (BirdBaseModel, BirdBaseIndexModel):
+        if not model.exists():
+            model.create_table(wait=True)
+
+    media = []
+    with BirdBaseModel.batch_write() as base, BirdBaseIndexModel.batch_write() as index:
+        for _ in range(media_count):
+            media_id = str(uuid.uuid4())
+            thumbnail_url = f"{BUCKET_URL}/thumbnails/{media_id}.jpg"
+            base.save(BirdBaseModel(
+                media_id,
+                FileType="image",
+                MediaURL=f"{BUCKET_URL}/upload/{media_id}.jpg",
+                ThumbnailURL=thumbnail_url,
+                Uploader="benchmark"
+            ))
+            for species in random.sample(SPECIES, 3):
+                # legacy rows without the copied attributes, so searches hydrate from BirdBase
+                index.save(BirdBaseIndexModel(species, media_id, TagValue=random.randint(1, 4)))
+            media.append((media_id, thumbnail_url))
+    return media
+
+def time_calls(label, call, repeat):
+    timings = {}
+    for mode in (False, True):
+        _async.ASYNC_QUERIES = mode
+        samples = []
+        # the handlers log every result; keep the report readable
+        with contextlib.redirect_stdout(io.StringIO()):
+            call()  # warm up connections
+            for _ in range(repeat):
+                start = time.perf_counter()
+                call()
+                samples.append((time.perf_counter() - start) * 1000)
+        timings[mode] = statistics.median(samples)
+    speedup = timings[False] / timings[True] if timings[True] else float("inf")
+    print(f"{label:<28} sequential {timings[False]:8.1f} ms   async {timings[True]:8.1f} ms   x{speedup:.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--media", type=int, default=300, help="media files to seed")
+    parser.add_argument("--latency-ms", type=float, default=0, help="extra delay per DynamoDB request")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if not os.environ.get("DYNAMODB_HOST"):
+        parser.error("set DYNAMODB_HOST to the local DynamoDB endpoint")
+
+    media = seed(args.media)
+    if args.latency_ms:
+        add_latency(args.latency_ms)
+    # skip the bitmap index so the species partitions are actually read
+    _bitmap.BITMAP_TTL = float("inf")
+
+    media_id, thumbnail_url = random.choice(media)
+    tags_event = {"queryStringParameters": {"crow": "1", "owl": "1", "sparrow": "1"}}
+    expression_event = {"queryStringParameters": {"q": "(crow OR owl) AND NOT duck AND sparrow>=2"}}
+    media_event = {"httpMethod": "GET", "queryStringParameters": {"media_id": media_id}}
+    thumbnail_event = {"httpMethod": "POST", "body": f'{{"thumbnail": "{thumbnail_url}"}}'}
+
+    print(f"{args.media} media files, +{args.latency_ms} ms per request, "
+          f"concurrency {_async.MAX_CONCURRENCY}")
+    time_calls("queryByTags (3 species)", lambda: queryByTagsFunction.lambda_handler(tags_event, None), args.repeat)
+    time_calls("queryByTags (?q=)", lambda: queryByTagsFunction.lambda_handler(expression_event, None), args.repeat)
+    time_calls("queryTagsByMediaID", lambda: queryTagsByMediaIDFunction.lambda_handler(media_event, None), args.repeat)
+    time_calls("queryByThumbnailURL", lambda: queryByThumbnailURLFunction.lambda_handler(thumbnail_event, None), args.repeat)
+
+if __name__ == "__main__":
+    main()
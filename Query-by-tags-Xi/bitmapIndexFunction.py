@@ -0,0 +1,91 @@
+import json
+import boto3
+from botocore.exceptions import ClientError
+import _bitmap
+from _bitmap import SpeciesBitmapIndex, BITMAP_BUCKET, BITMAP_KEY
+
+s3 = boto3.client('s3')
+dynamodb = boto3.resource('dynamodb')
+index_table = dynamodb.Table('BirdBaseIndex')
+
+MAX_ATTEMPTS = 5
+
+def rebuild_index():
+    """
+    Builds the bitmap index from a full scan of BirdBaseIndex.
+    """
+    index = SpeciesBitmapIndex()
+    scan_args = {'ProjectionExpression': 'TagName, MediaID, TagValue'}
+    while True:
+        response = index_table.scan(**scan_args)
+        for row in response.get('Items', []):
+            index.set(row['TagName'], row['MediaID'], int(row['TagValue']))
+        if 'LastEvaluatedKey' not in response:
+            return index
+        scan_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def apply_stream_records(index, records):
+    for record in records:
+        keys = record['dynamodb']['Keys']
+        species = keys['TagName']['S']
+        media_id = keys['MediaID']['S']
+        if record['eventName'] == 'REMOVE':
+            index.remove(species, media_id)
+        else:
+            count = int(record['dynamodb']['NewImage']['TagValue']['N'])
+            index.set(species, media_id, count)
+
+def save_index(index, etag=None):
+    put_args = {
+        'Bucket': BITMAP_BUCKET,
+        'Key': BITMAP_KEY,
+        'Body': index.to_json().encode('utf-8'),
+        'ContentType': 'application/json'
+    }
+    # only replace the version we read, so concurrent updaters can't drop changes
+    if etag:
+        put_args['IfMatch'] = etag
+    else:
+        put_args['IfNoneMatch'] = '*'
+    s3.put_object(**put_args)
+
+def lambda_handler(event, context):
+    records = event.get('Records', [])
+
+    # Invoked without stream records (e.g. manually or on a schedule): full rebuild
+    if not records:
+        index = rebuild_index()
+        s3.put_object(
+            Bucket=BITMAP_BUCKET,
+            Key=BITMAP_KEY,
+            Body=index.to_json().encode('utf-8'),
+            ContentType='application/json'
+        )
+        print(f'Rebuilt bitmap index with {len(index.media_ids)} media files')
+        return {
+            'statusCode': 200,
+            'body': json.dumps({'message': 'Bitmap index rebuilt', 'media_count': len(index.media_ids)})
+        }
+
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        index, etag = _bitmap.load_index(s3)
+        if index is None:
+            # first run: the scan already contains these changes
+            index = rebuild_index()
+        else:
+            apply_stream_records(index, records)
+
+        try:
+            save_index(index, etag)
+            print(f'Applied {len(records)} tag changes to bitmap index')
+            return {
+                'statusCode': 200,
+                'body': json.dumps({'message': f'Applied {len(records)} tag changes'})
+            }
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise
+            print(f'Bitmap index changed during update, retrying ({attempt}/{MAX_ATTEMPTS})')
+
+    # let the stream redeliver this batch
+    raise RuntimeError('Could not update bitmap index after several attempts')
@@ -25,7 +25,11 @@ def generate_tags(media_records):
                 results.append({
                     "TagName": species_name,
                     "TagValue": species_count,
-                    "MediaID": media_id
+                    "MediaID": media_id,
+                    "FileType": record["FileType"],
+                    "MediaURL": record["MediaURL"],
+                    "ThumbnailURL": record["ThumbnailURL"],
+                    "Uploader": record["Uploader"]
                 })
     return results
 
@@ -108,7 +112,11 @@ def lambda_handler(event, context):
         BirdBaseIndexModel(
             TagName=tag["TagName"],
             TagValue=tag["TagValue"],
-            MediaID=tag["MediaID"]
+            MediaID=tag["MediaID"],
+            FileType=tag["FileType"],
+            MediaURL=tag["MediaURL"],
+            ThumbnailURL=tag["ThumbnailURL"],
+            Uploader=tag["Uploader"]
         ).save()
 
     return {
@@ -47,10 +47,18 @@ def lambda_handler(event, context):
             # Delete file from S3
             try:
                 bucket, key = _.parse_s3_url(item.MediaURL)
-                if item.FileType == 'image':
+                # Images, videos and audio all get a thumbnail
+                if item.ThumbnailURL:
                     thumbnail_bucket, thumbnail_key = _.parse_s3_url(item.ThumbnailURL)
                     s3.delete_object(Bucket=thumbnail_bucket, Key=thumbnail_key)
                     print(f'Deleted {thumbnail_key} from S3 bucket {thumbnail_bucket}')
+                # Sized renditions of the thumbnail, e.g. thumbnails/512/<id>.webp
+                renditions = item.ThumbnailRenditions.as_dict() if item.ThumbnailRenditions else {}
+                for formats in renditions.values():
+                    for rendition_url in formats.values():
+                        rendition_bucket, rendition_key = _.parse_s3_url(rendition_url)
+                        s3.delete_object(Bucket=rendition_bucket, Key=rendition_key)
+                        print(f'Deleted {rendition_key} from S3 bucket {rendition_bucket}')
                 s3.delete_object(Bucket=bucket, Key=key)
             except Exception as e:
                 print(f"Error deleting file from S3: {e}")
@@ -30,6 +30,10 @@ resource "aws_dynamodb_table" "BirdBaseIndexTable" {
   hash_key = "TagName"
   range_key = "MediaID"
 
+  # tag changes feed bitmapIndexFunction, which keeps the species bitmaps in S3 current
+  stream_enabled   = true
+  stream_view_type = "NEW_AND_OLD_IMAGES"
+
   attribute {
     name = "TagName" # hash key
     type = "S"
@@ -40,6 +44,26 @@ resource "aws_dynamodb_table" "BirdBaseIndexTable" {
     type = "S"
   }
 
+  attribute {
+    name = "TagValue" # sort key of TagValueIndex
+    type = "N"
+  }
+
+  # count ranges (e.g. crow=2..5) become key conditions instead of partition filters
+  global_secondary_index {
+    name            = "TagValueIndex"
+    hash_key        = "TagName"
+    range_key       = "TagValue"
+    projection_type = "ALL"
+  }
+
+  # look up every tag row of a media file, e.g. to sync a new ThumbnailURL onto them
+  global_secondary_index {
+    name            = "MediaIDIndex"
+    hash_key        = "MediaID"
+    projection_type = "KEYS_ONLY"
+  }
+
   tags = {
     Name        = "BirdStore"
     Environment = "Prod"
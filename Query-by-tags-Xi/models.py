@@ -1,10 +1,15 @@
+import os
 from pynamodb.models import Model
 from pynamodb.attributes import UnicodeAttribute, NumberAttribute, MapAttribute
+from pynamodb.indexes import GlobalSecondaryIndex, AllProjection, KeysOnlyProjection
+import _async
 
 class BirdBaseModel(Model):
     class Meta:
         table_name = "BirdBase"
         region = 'us-east-1'
+        # e.g. http://localhost:8000 for DynamoDB Local
+        host = os.environ.get("DYNAMODB_HOST")
         read_capacity_units = 1
         write_capacity_units = 1
 
@@ -20,16 +25,42 @@ class BirdBaseModel(Model):
     # Link to the image thumbnail
     ThumbnailURL = UnicodeAttribute(null=True)
 
+    # Links to every thumbnail rendition, by size then format, e.g. {"512": {"webp": url}}
+    ThumbnailRenditions = MapAttribute(null=True)
+
     # Uploaded date
     # UploadedDate = UnicodeAttribute()
 
     # Uploader's username
     Uploader = UnicodeAttribute()
 
+class TagValueIndex(GlobalSecondaryIndex):
+    class Meta:
+        index_name = "TagValueIndex"
+        projection = AllProjection()
+        read_capacity_units = 1
+        write_capacity_units = 1
+
+    # Same partitions as the table, sorted by count so count ranges are key conditions
+    TagName = UnicodeAttribute(hash_key=True)
+    TagValue = NumberAttribute(range_key=True)
+
+class MediaIDIndex(GlobalSecondaryIndex):
+    class Meta:
+        index_name = "MediaIDIndex"
+        projection = KeysOnlyProjection()
+        read_capacity_units = 1
+        write_capacity_units = 1
+
+    # Every tag row of a media file without scanning the table; only keys are projected
+    MediaID = UnicodeAttribute(hash_key=True)
+
 class BirdBaseIndexModel(Model):
     class Meta:
         table_name = "BirdBaseIndex"
         region = 'us-east-1'
+        # e.g. http://localhost:8000 for DynamoDB Local
+        host = os.environ.get("DYNAMODB_HOST")
         read_capacity_units = 1
         write_capacity_units = 1
 
@@ -40,4 +71,56 @@ class BirdBaseIndexModel(Model):
     TagValue = NumberAttribute()
 
     # UUID of the media file
-    MediaID = UnicodeAttribute(range_key=True)
\ No newline at end of file
+    MediaID = UnicodeAttribute(range_key=True)
+
+    # Copies of the BirdBase attributes so a search can answer from the index alone.
+    # Rows written before these existed leave them empty and get hydrated from BirdBase.
+    FileType = UnicodeAttribute(null=True)
+    MediaURL = UnicodeAttribute(null=True)
+    ThumbnailURL = UnicodeAttribute(null=True)
+    Uploader = UnicodeAttribute(null=True)
+
+    tag_value_index = TagValueIndex()
+    media_id_index = MediaIDIndex()
+
+def has_media_copy(index_item):
+    """
+    Whether an index row carries every BirdBase attribute search returns. Taggers often
+    copy ThumbnailURL before the thumbnail is registered, and a row the thumbnail
+    Lambda missed keeps "", so an empty ThumbnailURL counts as not copied.
+    """
+    return (index_item is not None and index_item.FileType is not None
+            and index_item.MediaURL is not None and bool(index_item.ThumbnailURL))
+
+def media_record(index_item):
+    """
+    Returns something with the BirdBase attributes for an index row: the row itself when
+    the media attributes were copied onto it, otherwise the BirdBase record.
+    """
+    if has_media_copy(index_item):
+        return index_item
+    return BirdBaseModel.get(index_item.MediaID)
+
+def index_rows_for(species, media_ids):
+    """
+    The BirdBaseIndex rows of media_ids in one species partition, by MediaID, read in
+    concurrent 100-key batches. For when the bitmap index already picked the matches
+    and only their copied media attributes are needed.
+    """
+    rows = _async.batch_get(BirdBaseIndexModel, [(species, media_id) for media_id in media_ids])
+    return {row.MediaID: row for row in rows}
+
+def media_records(media_ids, index_rows):
+    """
+    Yields the BirdBase attributes for each media ID, taken from its index row when
+    it has them. The rest are read from BirdBase in concurrent 100-key batches.
+    """
+    missing = []
+    for media_id in media_ids:
+        row = index_rows.get(media_id)
+        if has_media_copy(row):
+            yield row
+        else:
+            missing.append(media_id)
+    if missing:
+        yield from _async.batch_get(BirdBaseModel, missing)
@@ -36,6 +36,8 @@ def find_media_by_mediaurl(media_urls, uploader = ""):
 
 def add_tags_to_media_files(media_ids, tags):
     for media_id in media_ids:
+        # media attributes are copied onto new index rows so search can skip BirdBase
+        media = BirdBaseModel.get(media_id)
         for each_tag in tags:
             for tag_name in each_tag:
                 tag_value = each_tag[tag_name]
@@ -50,7 +52,11 @@ def add_tags_to_media_files(media_ids, tags):
                     BirdBaseIndexModel(
                         TagName = tag_name,
                         MediaID = media_id,
-                        TagValue = tag_value
+                        TagValue = tag_value,
+                        FileType = media.FileType,
+                        MediaURL = media.MediaURL,
+                        ThumbnailURL = media.ThumbnailURL,
+                        Uploader = media.Uploader
                     ).save()
 
 def remove_tags_from_media_files(media_ids, tags):
@@ -1,17 +1,60 @@
-from models import BirdBaseModel, BirdBaseIndexModel
+from models import BirdBaseIndexModel, index_rows_for, media_records
 import uuid
 import json
 import boto3
 import _helper as _
+import _bitmap
+import _query
+import _async
+from functools import partial
 
 s3 = boto3.client('s3')
 
+def query_species(species, min_count):
+    """
+    Index rows of one species with at least min_count, keyed by MediaID.
+    """
+    rows = {}
+    for item in BirdBaseIndexModel.query(species):
+        if item.TagValue >= min_count:
+            rows[item.MediaID] = item
+    return rows
+
 def lambda_handler(event, context):
     try:
         params = event.get("queryStringParameters", {}) or {}
+        # ?fields=ids, ?fields=thumbnails or ?fields=MediaID,FileType trims each result
+        fields = _.parse_fields(params.get("fields"))
+
+        # Boolean/range expressions, e.g. ?q=crow>=2 AND (owl OR NOT duck) AND FileType=image
+        if params.get("q"):
+            try:
+                records, plan = _query.run(params["q"], s3)
+            except _query.QueryError as e:
+                return _.build_response(400, {
+                    "message": "Invalid search expression",
+                    "error": str(e)
+                })
+
+            results = []
+            for item in records:
+                results.append(_.media_result(item, s3, fields))
+            print(f"plan: {plan}")
+
+            # ?debug=1 returns the chosen access paths and their read counts
+            headers = {"X-Query-Plan": json.dumps(plan)} if params.get("debug") else None
+            return _.build_response(200, {
+                "message": f"Succeeded! Got {len(results)} records",
+                "results": results
+            }, headers, event)
+
         filter_tags = {}
 
         for species, count_str in params.items():
+            # Skip the expression, debug and projection params
+            if species in ("q", "debug", "fields"):
+                continue
+
             try:
                 species = species.lower()
                 # If count is missing or empty, treat as 1
@@ -27,21 +70,28 @@ def lambda_handler(event, context):
                 "message": "To search, use a GET request with parameters like ?crow=2&owl=1"
             })
              
-        matching_ids = None
-
-        for species, min_count in filter_tags.items():
-            # Query BirdBaseIndexModel for each tag
-            result_ids = set()
-            for item in BirdBaseIndexModel.query(species):
-                if item.TagValue >= min_count:
-                    result_ids.add(item.MediaID)
-                    result_ids.add(item.MediaID)
-            
-            # Intersect with previous results to satisfy all tag conditions
-            if matching_ids is None:
-                matching_ids = result_ids
-            else:
-                matching_ids &= result_ids
+        index_rows = {}
+
+        # Precomputed species bitmaps answer the intersection without reading partitions
+        matching_ids = _bitmap.match(filter_tags, s3)
+        if matching_ids:
+            # Every match has a row in each filtered species' partition; one species'
+            # rows carry the media attributes, so BirdBase isn't read for them
+            index_rows = index_rows_for(next(iter(filter_tags)), matching_ids)
+        elif matching_ids is None:
+            # Each species is an independent partition, so they're read concurrently
+            species_rows = _async.run_all(
+                partial(query_species, species, min_count) for species, min_count in filter_tags.items()
+            )
+            for rows in species_rows:
+                for media_id, item in rows.items():
+                    index_rows.setdefault(media_id, item)
+
+                # Intersect with previous results to satisfy all tag conditions
+                if matching_ids is None:
+                    matching_ids = set(rows)
+                else:
+                    matching_ids &= set(rows)
 
         if not matching_ids:
             return _.build_response(200, {
@@ -51,25 +101,16 @@ def lambda_handler(event, context):
             
         # Retrieve media records from BirdBaseModel
         results = []
-        for media_id in matching_ids:
-            item = BirdBaseModel.get(media_id)
-        for media_id in matching_ids:
-            item = BirdBaseModel.get(media_id)
-            results.append({
-                "MediaID": item.MediaID,
-                "FileType": item.FileType,
-                "MediaURL": _.generate_presigned_url(item.MediaURL, s3),
-                "ThumbnailURL": _.generate_presigned_url(item.ThumbnailURL, s3),
-            #    "UploadedDate": item.UploadedDate,
-                "Uploader": item.Uploader
-            })
+        # Index rows carry the media attributes, so BirdBase is only read for the rest
+        for item in media_records(matching_ids, index_rows):
+            results.append(_.media_result(item, s3, fields))
 
         print(results)
 
         return _.build_response(200, {
             "message": f"Succeeded! Got {len(results)} records",
             "results": results
-        })
+        }, event=event)
         
     except Exception as e:
         return _.build_response(500, {
@@ -1,6 +1,8 @@
 import json
+import os
 import _helper as _
 from models import BirdBaseModel
+from pynamodb.exceptions import DoesNotExist
 
 def lambda_handler(event, context):
     # TODO implement
@@ -10,6 +12,7 @@ def lambda_handler(event, context):
     print(f'request_method: {request_method}')
 
     thumbnail_url = ''    
+    fields = None
     if request_method == "POST":
         # Handle POST request
         print("POST method")
@@ -22,6 +25,7 @@ def lambda_handler(event, context):
         try:
             parsed_body = json.loads(body)
             thumbnail_url = parsed_body.get("thumbnail")
+            fields = _.parse_fields(parsed_body.get("fields"))
         except json.JSONDecodeError:
             return _.build_response(400, {
                 "message": "Error. Invalid JSON."
@@ -40,11 +44,19 @@ def lambda_handler(event, context):
     thumbnail_url = _.extract_s3_url(thumbnail_url)
     print(f'Thumbnail after extract: {thumbnail_url}')
 
-    # do the query
-    item = None 
-    for item in BirdBaseModel.scan(BirdBaseModel.ThumbnailURL == thumbnail_url):
-        if item:
-            break
+    # Thumbnails are stored as thumbnails/<MediaID>.jpg, so the record is read by its key
+    # instead of scanning the table for the URL
+    bucket, key = _.parse_s3_url(thumbnail_url) or (None, None)
+    media_id = os.path.splitext(os.path.basename(key or ''))[0]
+    item = None
+    if media_id:
+        try:
+            item = BirdBaseModel.get(media_id)
+        except DoesNotExist:
+            pass
+    # a different URL for the same name, e.g. another bucket, is not a match
+    if item and item.ThumbnailURL != thumbnail_url:
+        item = None
     print(f'result: {item}')
 
     if not item:
@@ -56,13 +68,6 @@ def lambda_handler(event, context):
     return _.build_response(200, {
         "message": f"The MediaURL found.",
         "requested_thumbnail_url": thumbnail_url,
-        "results": {
-            "MediaID": item.MediaID,
-            "FileType": item.FileType,
-            "MediaURL": _.generate_presigned_url(item.MediaURL),
-            "ThumbnailURL": _.generate_presigned_url(item.ThumbnailURL),
-            #    "UploadedDate": item.UploadedDate,
-            "Uploader": item.Uploader
-        }
-    })
+        "results": _.media_result(item, _.s3_client, fields)
+    }, event=event)
            
\ No newline at end of file
@@ -1,6 +1,7 @@
 import json
 import _helper as _
 from models import BirdBaseModel, BirdBaseIndexModel
+import _async
 
 def lambda_handler(event, context):
     # TODO implement
@@ -20,7 +21,9 @@ def lambda_handler(event, context):
         
         try:
             media_tags = []
-            for item in BirdBaseIndexModel.scan(BirdBaseIndexModel.MediaID == media_id):
+            # The key-only MediaIDIndex names the tag rows; they're then fetched concurrently
+            keys = [(row.TagName, row.MediaID) for row in BirdBaseIndexModel.media_id_index.query(media_id)]
+            for item in _async.batch_get(BirdBaseIndexModel, keys):
                 media_tags.append({
                     "TagName": item.TagName,
                     "TagValue": item.TagValue,
@@ -1,9 +1,41 @@
 import boto3
 import os
+from boto3.dynamodb.conditions import Key
 
 dynamodb = boto3.resource('dynamodb')
 table = dynamodb.Table('BirdBase')
+index_table = dynamodb.Table('BirdBaseIndex')
 
+def sync_index_thumbnail(media_id, s3_url):
+    # Tag rows carry a copy of ThumbnailURL so search can skip BirdBase; keep it current
+    updated = 0
+    query_args = {
+        'IndexName': 'MediaIDIndex',
+        'KeyConditionExpression': Key('MediaID').eq(media_id)
+    }
+    while True:
+        response = index_table.query(**query_args)
+        for row in response.get('Items', []):
+            try:
+                index_table.update_item(
+                    Key={'TagName': row['TagName'], 'MediaID': media_id},
+                    UpdateExpression='SET ThumbnailURL = :url',
+                    # don't recreate a deleted tag row, and skip rows that are already current
+                    ConditionExpression='attribute_exists(TagName) AND '
+                                        '(attribute_not_exists(ThumbnailURL) OR ThumbnailURL <> :url)',
+                    ExpressionAttributeValues={
+                        ':url': s3_url
+                    }
+                )
+                updated += 1
+            except index_table.meta.client.exceptions.ConditionalCheckFailedException:
+                continue
+        if 'LastEvaluatedKey' not in response:
+            return updated
+        query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+# Optional: generate-Thumbnail-lambda registers ThumbnailURL itself after the upload.
+# This S3-triggered step is only needed when it runs with REGISTER_THUMBNAIL=false.
 def lambda_handler(event, context):
     # Get bucket and object key from the event
     bucket = event['Records'][0]['s3']['bucket']['name']
@@ -13,6 +45,10 @@ def lambda_handler(event, context):
     if not key.startswith('thumbnails/'):
         return {'statusCode': 400, 'body': 'Not a thumbnail upload.'}
 
+    # Sized renditions (thumbnails/<size>/<id>.<ext>) are recorded by the generator
+    if key.count('/') != 1:
+        return {'statusCode': 200, 'body': 'Skipped thumbnail rendition.'}
+
     # Extract the thumbnail file name
     thumbnail_name = os.path.basename(key) 
     media_id = os.path.splitext(thumbnail_name)[0] 
@@ -29,7 +65,10 @@ def lambda_handler(event, context):
         }
     )
 
+    # Tag rows written before the thumbnail existed still have the old value
+    synced = sync_index_thumbnail(media_id, s3_url)
+
     return {
         'statusCode': 200,
-        'body': f"Thumbnail URL stored in DynamoDB: {s3_url}"
+        'body': f"Thumbnail URL stored in DynamoDB: {s3_url} ({synced} tag rows updated)"
     }
\ No newline at end of file
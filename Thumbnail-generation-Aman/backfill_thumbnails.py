@@ -0,0 +1,160 @@
+"""
+Regenerates thumbnails for media already in the bucket, e.g. after THUMBNAIL_SIZES
+changes or for uploads whose thumbnail event was lost.
+
+    python backfill_thumbnails.py --bucket birdstore --prefixes images/ videos/ --workers 8
+
+Objects are listed page by page and every page is processed in a process pool with
+generate-Thumbnail-lambda.py's own handler, so the output is what an upload would
+produce. Objects that already have every rendition are skipped unless --force is given.
+After each page the last key is written to the checkpoint file, and a restart
+continues listing after it. Keys that failed are kept in the checkpoint and retried
+first on the next run; a prefix that was listed to the end is dropped from it, so a
+later run (new sizes, --force) lists it again from the start.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import boto3
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+GENERATOR_PATH = os.path.join(HERE, 'generate-Thumbnail-lambda.py')
+
+# The generator module, loaded once per worker process
+generator = None
+
+def load_generator():
+    global generator
+    spec = importlib.util.spec_from_file_location('generate_thumbnail', GENERATOR_PATH)
+    generator = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(generator)
+    return generator
+
+def expected_keys(key):
+    """
+    Every thumbnail key an upload of key produces.
+    """
+    media_id = os.path.splitext(os.path.basename(key))[0]
+    sizes = set(generator.THUMBNAIL_SIZES) | {generator.CANONICAL_SIZE}
+    keys = {generator.rendition_key(media_id, size, ext) for size in sizes for ext in generator.THUMBNAIL_FORMATS}
+    keys.add(f"thumbnails/{media_id}.jpg")
+    return keys
+
+def existing_thumbnails(s3_client, bucket):
+    keys = set()
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix='thumbnails/'):
+        keys.update(obj['Key'] for obj in page.get('Contents', []))
+    return keys
+
+def process(bucket, key):
+    """
+    Runs the thumbnail Lambda's handler on one object inside a worker process.
+
+    Returns:
+        tuple: (key, error message or None)
+    """
+    try:
+        response = generator.lambda_handler({'detail': {'bucket': {'name': bucket}, 'object': {'key': key}}}, None)
+    except Exception as e:
+        return key, str(e)
+    if response['statusCode'] != 200:
+        return key, response['body']
+    return key, None
+
+def process_keys(pool, bucket, keys, totals):
+    """
+    Runs process over keys in the pool and counts the outcomes in totals.
+
+    Returns:
+        list: Keys that failed
+    """
+    failed = []
+    for key, error in pool.map(process, [bucket] * len(keys), keys):
+        if error:
+            totals['failed'] += 1
+            failed.append(key)
+            print(f"Failed {key}: {error}")
+        else:
+            totals['done'] += 1
+    return failed
+
+def read_checkpoint(path):
+    """
+    Returns:
+        dict: {"after": {prefix: last finished key}, "failed": [keys to retry]}
+    """
+    checkpoint = {'after': {}, 'failed': []}
+    if os.path.exists(path):
+        with open(path) as f:
+            checkpoint.update(json.load(f))
+    return checkpoint
+
+def write_checkpoint(path, checkpoint):
+    # write and rename, so an interrupted run never leaves a half-written file
+    with open(path + '.tmp', 'w') as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+def backfill(bucket, prefixes, workers, checkpoint_path, force=False):
+    s3_client = boto3.client('s3')
+    load_generator()
+    existing = set() if force else existing_thumbnails(s3_client, bucket)
+    checkpoint = read_checkpoint(checkpoint_path)
+    totals = {'listed': 0, 'skipped': 0, 'done': 0, 'failed': 0}
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=load_generator) as pool:
+        if checkpoint['failed']:
+            print(f"Retrying {len(checkpoint['failed'])} keys that failed last time")
+            checkpoint['failed'] = process_keys(pool, bucket, checkpoint['failed'], totals)
+            write_checkpoint(checkpoint_path, checkpoint)
+
+        for prefix in prefixes:
+            paginate_args = {'Bucket': bucket, 'Prefix': prefix}
+            if checkpoint['after'].get(prefix):
+                paginate_args['StartAfter'] = checkpoint['after'][prefix]
+                print(f"Resuming {prefix} after {checkpoint['after'][prefix]}")
+
+            paginator = s3_client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(**paginate_args):
+                contents = page.get('Contents', [])
+                if not contents:
+                    continue
+                keys = [obj['Key'] for obj in contents if not obj['Key'].endswith('/')]
+                todo = [key for key in keys if force or not expected_keys(key) <= existing]
+                totals['listed'] += len(keys)
+                totals['skipped'] += len(keys) - len(todo)
+
+                # failed keys are retried on the next run, the page itself is finished
+                checkpoint['failed'].extend(process_keys(pool, bucket, todo, totals))
+                checkpoint['after'][prefix] = contents[-1]['Key']
+                write_checkpoint(checkpoint_path, checkpoint)
+
+                elapsed = time.perf_counter() - start
+                print(f"{prefix} up to {checkpoint['after'][prefix]}: {totals['listed']} listed, "
+                      f"{totals['skipped']} skipped, {totals['done']} done, {totals['failed']} failed, "
+                      f"{totals['listed'] / elapsed:.1f} objects/s ({totals['done'] / elapsed:.1f} generated/s)")
+
+            # listed to the end; the next run starts this prefix over
+            checkpoint['after'].pop(prefix, None)
+            write_checkpoint(checkpoint_path, checkpoint)
+
+    elapsed = time.perf_counter() - start
+    print(f"Finished in {elapsed:.1f} s: {totals['done']} generated, {totals['skipped']} skipped, "
+          f"{totals['failed']} failed, {totals['listed'] / max(elapsed, 1e-9):.1f} objects/s")
+    return totals
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bucket', default='birdstore')
+    parser.add_argument('--prefixes', nargs='+', default=['images/', 'videos/'])
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--checkpoint', default='thumbnail-backfill.json', help='progress file, deleted to start over')
+    parser.add_argument('--force', action='store_true', help='regenerate even if every rendition exists')
+    args = parser.parse_args()
+    backfill(args.bucket, args.prefixes, args.workers, args.checkpoint, args.force)
@@ -2,9 +2,259 @@ import boto3
 import cv2
 import numpy as np
 import os
+import subprocess
+from boto3.dynamodb.conditions import Key
 from io import BytesIO
 
 s3 = boto3.client('s3')
+dynamodb = boto3.resource('dynamodb')
+table = dynamodb.Table('BirdBase')
+index_table = dynamodb.Table('BirdBaseIndex')
+
+# Register ThumbnailURL here right after the upload. The S3-triggered
+# Upload-Thumbnail-to-DB Lambda does the same and is only needed when this is off.
+REGISTER_THUMBNAIL = os.environ.get('REGISTER_THUMBNAIL', 'true').lower() == 'true'
+
+# Longest side of each rendition, e.g. 64 for lists, 128 for grids, 512 for previews
+THUMBNAIL_SIZES = sorted(int(size) for size in os.environ.get('THUMBNAIL_SIZES', '64,128,512').split(','))
+# This size is also written to thumbnails/<id>.jpg, the key ThumbnailURL points at
+CANONICAL_SIZE = int(os.environ.get('CANONICAL_THUMBNAIL_SIZE', '128'))
+JPEG_QUALITY = int(os.environ.get('THUMBNAIL_JPEG_QUALITY', '85'))
+WEBP_QUALITY = int(os.environ.get('THUMBNAIL_WEBP_QUALITY', '80'))
+
+# Format extension -> (encode params, content type)
+THUMBNAIL_FORMATS = {
+    'jpg': ([int(cv2.IMWRITE_JPEG_QUALITY), JPEG_QUALITY], 'image/jpeg'),
+    'webp': ([int(cv2.IMWRITE_WEBP_QUALITY), WEBP_QUALITY], 'image/webp'),
+}
+
+# Reduced decodes, largest reduction first. For JPEGs libjpeg scales the DCT while
+# decoding, so a 1/8 decode of a 24MP photo only ever produces ~0.4MP of pixels.
+REDUCED_MODES = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+# Videos and audio are read with ffmpeg straight from a presigned URL, so only the
+# bytes around the poster frame or the first seconds of audio are downloaded
+FFMPEG_PATH = os.environ.get('FFMPEG_PATH', 'ffmpeg')
+FFMPEG_TIMEOUT = int(os.environ.get('FFMPEG_TIMEOUT', '60'))
+POSTER_SECONDS = float(os.environ.get('POSTER_SECONDS', '1'))
+
+# Spectrogram thumbnails: the first SPECTROGRAM_SECONDS at 22.05 kHz, so up to ~11 kHz
+SPECTROGRAM_SECONDS = float(os.environ.get('SPECTROGRAM_SECONDS', '10'))
+SPECTROGRAM_RATE = 22050
+SPECTROGRAM_FFT = 512
+SPECTROGRAM_HOP = 256
+SPECTROGRAM_RANGE_DB = 80
+SPECTROGRAM_SHAPE = (512, 256)  # width, height
+
+def s3_url(bucket, key):
+    return f"https://{bucket}.s3.us-east-1.amazonaws.com/{key}"
+
+def decode_for_size(np_arr, size):
+    """
+    Decodes the image at the smallest scale whose longest side is still at least size.
+    Returns None if the bytes are not an image.
+    """
+    # only JPEG decoding gets cheaper at reduced scales, other formats decode in full once
+    if np_arr[:2].tobytes() != b'\xff\xd8':
+        return cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
+    # the 1/8 decode is cheap and tells us roughly how big the full image is
+    img = cv2.imdecode(np_arr, cv2.IMREAD_REDUCED_COLOR_8)
+    if img is None:
+        return None
+    longest = max(img.shape[:2])
+    if longest >= size:
+        return img
+    for factor, mode in REDUCED_MODES[1:]:
+        if longest * 8 // factor >= size:
+            return cv2.imdecode(np_arr, mode)
+    return cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
+
+def run_ffmpeg(args):
+    """
+    Runs ffmpeg and returns what it wrote to stdout, or None if it failed.
+    """
+    try:
+        result = subprocess.run(
+            [FFMPEG_PATH, '-hide_banner', '-loglevel', 'error', *args],
+            capture_output=True,
+            timeout=FFMPEG_TIMEOUT
+        )
+    except (OSError, subprocess.TimeoutExpired) as e:
+        print(f"ffmpeg failed: {e}")
+        return None
+    if result.returncode != 0:
+        print(f"ffmpeg failed: {result.stderr.decode('utf-8', 'replace').strip()}")
+        return None
+    return result.stdout
+
+def poster_frame(url):
+    """
+    Decodes a single keyframe at or before POSTER_SECONDS as the video's poster.
+    Only keyframes are decoded and the seek is not made frame-accurate, so the
+    rest of the stream is never read. Clips shorter than that use their first frame.
+    """
+    for seconds in (POSTER_SECONDS, 0):
+        frame = run_ffmpeg([
+            '-skip_frame', 'nokey',
+            '-ss', str(seconds),
+            '-noaccurate_seek',
+            '-i', url,
+            '-frames:v', '1',
+            '-f', 'image2pipe',
+            '-c:v', 'bmp',
+            'pipe:1'
+        ])
+        if frame:
+            img = cv2.imdecode(np.frombuffer(frame, np.uint8), cv2.IMREAD_COLOR)
+            if img is not None:
+                return img
+    return None
+
+def spectrogram(signal):
+    """
+    Power spectrogram in dB of a mono signal, with frequency rows and time columns,
+    low frequencies at the bottom. Every frame is transformed in one rfft call.
+    """
+    if len(signal) < SPECTROGRAM_FFT:
+        signal = np.pad(signal, (0, SPECTROGRAM_FFT - len(signal)))
+    frames = np.lib.stride_tricks.sliding_window_view(signal, SPECTROGRAM_FFT)[::SPECTROGRAM_HOP]
+    power = np.abs(np.fft.rfft(frames * np.hanning(SPECTROGRAM_FFT), axis=1)) ** 2
+    db = 10 * np.log10(np.maximum(power, 1e-12))
+    return db.T[::-1]
+
+def spectrogram_image(url):
+    """
+    Renders the first SPECTROGRAM_SECONDS of a recording as a colour spectrogram.
+    Returns None if no audio could be decoded.
+    """
+    pcm = run_ffmpeg([
+        '-t', str(SPECTROGRAM_SECONDS),
+        '-i', url,
+        '-vn',
+        '-ac', '1',
+        '-ar', str(SPECTROGRAM_RATE),
+        '-f', 'f32le',
+        'pipe:1'
+    ])
+    if not pcm:
+        return None
+    db = spectrogram(np.frombuffer(pcm, np.float32))
+
+    # the loudest SPECTROGRAM_RANGE_DB decibels map onto the colour scale
+    top = db.max()
+    scaled = np.clip((db - (top - SPECTROGRAM_RANGE_DB)) / SPECTROGRAM_RANGE_DB, 0, 1)
+    gray = (scaled * 255).astype(np.uint8)
+    gray = cv2.resize(gray, SPECTROGRAM_SHAPE, interpolation=cv2.INTER_AREA)
+    return cv2.applyColorMap(gray, cv2.COLORMAP_MAGMA)
+
+def build_pyramid(img, sizes):
+    """
+    Resizes img to each size (longest side), largest first, each level from the previous
+    one. Images smaller than a size are not upscaled.
+    """
+    levels = {}
+    current = img
+    for size in sorted(sizes, reverse=True):
+        h, w = current.shape[:2]
+        scale = size / max(h, w)
+        if scale < 1:
+            new_size = (max(1, int(w * scale)), max(1, int(h * scale)))
+            current = cv2.resize(current, new_size, interpolation=cv2.INTER_AREA)
+        levels[size] = current
+    return levels
+
+def rendition_key(media_id, size, ext):
+    return f"thumbnails/{size}/{media_id}.{ext}"
+
+def upload_renditions(bucket, media_id, levels):
+    """
+    Encodes every level in every format and uploads it. The canonical JPEG goes last,
+    so it only exists once all the renditions do.
+
+    Returns:
+        tuple: ({size: {ext: url}} of the uploaded renditions, canonical thumbnail URL or None)
+    """
+    renditions = {}
+    canonical = None
+    for size, level in levels.items():
+        for ext, (encode_param, content_type) in THUMBNAIL_FORMATS.items():
+            ok, buffer = cv2.imencode(f'.{ext}', level, encode_param)
+            if not ok:
+                print(f"Could not encode {size}px {ext} thumbnail for {media_id}")
+                continue
+            key = rendition_key(media_id, size, ext)
+            s3.put_object(Bucket=bucket, Key=key, Body=buffer.tobytes(), ContentType=content_type)
+            renditions.setdefault(str(size), {})[ext] = s3_url(bucket, key)
+            if size == CANONICAL_SIZE and ext == 'jpg':
+                canonical = buffer.tobytes()
+
+    # Upload thumbnail to S3 under 'thumbnails/' prefix
+    if canonical is None:
+        return renditions, None
+    thumb_key = f"thumbnails/{media_id}.jpg"
+    s3.put_object(Bucket=bucket, Key=thumb_key, Body=canonical, ContentType='image/jpeg')
+    return renditions, s3_url(bucket, thumb_key)
+
+def sync_index_thumbnail(media_id, thumbnail_url):
+    # Tag rows carry a copy of ThumbnailURL so search can skip BirdBase; keep it current
+    updated = 0
+    query_args = {
+        'IndexName': 'MediaIDIndex',
+        'KeyConditionExpression': Key('MediaID').eq(media_id)
+    }
+    while True:
+        response = index_table.query(**query_args)
+        for row in response.get('Items', []):
+            try:
+                index_table.update_item(
+                    Key={'TagName': row['TagName'], 'MediaID': media_id},
+                    UpdateExpression='SET ThumbnailURL = :url',
+                    # don't recreate a deleted tag row, and skip rows that are already current
+                    ConditionExpression='attribute_exists(TagName) AND '
+                                        '(attribute_not_exists(ThumbnailURL) OR ThumbnailURL <> :url)',
+                    ExpressionAttributeValues={
+                        ':url': thumbnail_url
+                    }
+                )
+                updated += 1
+            except index_table.meta.client.exceptions.ConditionalCheckFailedException:
+                continue
+        if 'LastEvaluatedKey' not in response:
+            return updated
+        query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def register_thumbnail(media_id, thumbnail_url, renditions):
+    """
+    Records the renditions and, with REGISTER_THUMBNAIL, ThumbnailURL on the BirdBase
+    item and its tag rows. Repeating it with the same values changes nothing, so a
+    retry or the Upload-Thumbnail-to-DB Lambda running as well is harmless.
+
+    Returns:
+        int: Number of tag rows updated, or None if there is no BirdBase record
+    """
+    update_expression = 'SET ThumbnailRenditions = :renditions'
+    values = {':renditions': renditions}
+    if REGISTER_THUMBNAIL and thumbnail_url:
+        update_expression += ', ThumbnailURL = :url'
+        values[':url'] = thumbnail_url
+    # Only update an existing BirdBase item, never create a partial one
+    try:
+        table.update_item(
+            Key={'MediaID': media_id},
+            UpdateExpression=update_expression,
+            ConditionExpression='attribute_exists(MediaID)',
+            ExpressionAttributeValues=values
+        )
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        print(f"No BirdBase record for {media_id}, thumbnail not registered")
+        return None
+    if ':url' not in values:
+        return 0
+    return sync_index_thumbnail(media_id, thumbnail_url)
 
 def lambda_handler(event, context):
     # Get bucket and object key from the event
@@ -17,34 +267,37 @@ def lambda_handler(event, context):
             'body': 'Skipped thumbnail generation for thumbnails/ folder.'
         }
 
-    # Download the image from S3
-    response = s3.get_object(Bucket=bucket, Key=key)
-    image_data = response['Body'].read()
-
-    # Convert image bytes to numpy array for OpenCV
-    np_arr = np.frombuffer(image_data, np.uint8)
-    img = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-
-    # Resize image to thumbnail (e.g., max 128x128, maintaining aspect ratio)
-    thumbnail_size = 128
-    h, w = img.shape[:2]
-    scale = thumbnail_size / max(h, w)
-    new_size = (int(w * scale), int(h * scale))
-    thumbnail = cv2.resize(img, new_size, interpolation=cv2.INTER_AREA)
+    sizes = sorted(set(THUMBNAIL_SIZES) | {CANONICAL_SIZE})
+    if key.startswith(('videos/', 'audio/')):
+        # ffmpeg reads the object with range requests instead of downloading it
+        url = s3.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': bucket, 'Key': key},
+            ExpiresIn=FFMPEG_TIMEOUT * 2
+        )
+        img = poster_frame(url) if key.startswith('videos/') else spectrogram_image(url)
+    else:
+        # Download the image from S3
+        response = s3.get_object(Bucket=bucket, Key=key)
+        image_data = response['Body'].read()
 
-    # Encode thumbnail to JPEG with compression
-    encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 85]
-    _, buffer = cv2.imencode('.jpg', thumbnail, encode_param)
-    thumbnail_bytes = buffer.tobytes()
+        # Convert image bytes to numpy array for OpenCV, decoded no larger than needed
+        np_arr = np.frombuffer(image_data, np.uint8)
+        img = decode_for_size(np_arr, sizes[-1])
+    if img is None:
+        return {
+            'statusCode': 400,
+            'body': f"Could not make a thumbnail for {key}."
+        }
 
-    # Upload thumbnail to S3 under 'thumbnails/' prefix
-    file_base_name = os.path.splitext(os.path.basename(key))[0]  # Without extension
-    thumb_key = f"thumbnails/{file_base_name}.jpg"
+    levels = build_pyramid(img, sizes)
 
-    
-    s3.put_object(Bucket=bucket, Key=thumb_key, Body=thumbnail_bytes, ContentType='image/jpeg')
+    media_id = os.path.splitext(os.path.basename(key))[0]  # Without extension
+    renditions, thumbnail_url = upload_renditions(bucket, media_id, levels)
+    synced = register_thumbnail(media_id, thumbnail_url, renditions)
 
     return {
         'statusCode': 200,
-        'body': f"Thumbnail created and uploaded to {thumb_key}"
-    }
\ No newline at end of file
+        'body': f"Thumbnails created and uploaded to thumbnails/{media_id}.jpg "
+                f"({len(renditions)} sizes, {synced or 0} tag rows updated)"
+    }
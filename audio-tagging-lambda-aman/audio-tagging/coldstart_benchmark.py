@@ -0,0 +1,98 @@
+"""
+Times the first request of a fresh process, the way a Lambda cold start sees it.
+
+    BIRDNET_MODEL_DIR=./checkpoints/V2.4 python coldstart_benchmark.py clip.wav --runs 3
+
+Each run starts a new Python interpreter and reports import, init and first/second
+analysis times for:
+
+    birdnet_analyzer   the old path: analyze() with numba caching off, WAV on disk
+    pipeline           the in-process pipeline, model loaded on the first request
+    pipeline+warmup    the in-process pipeline with BIRDNET_WARMUP, model run during init
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+BIRDNET_ANALYZER = """
+import os, tempfile, time
+start = time.perf_counter()
+import numba
+numba.config.CACHE = False
+from birdnet_analyzer.analyze.core import analyze
+imported = time.perf_counter()
+output = tempfile.mkdtemp()
+analyze(input=PATH, output=output)
+first = time.perf_counter()
+analyze(input=PATH, output=output)
+second = time.perf_counter()
+print(json.dumps({"import": imported - start, "init": 0.0, "first": first - imported, "second": second - first}))
+"""
+
+PIPELINE = """
+import time
+start = time.perf_counter()
+import pipeline
+imported = time.perf_counter()
+if pipeline.WARMUP:
+    pipeline.warm_up()
+initialized = time.perf_counter()
+pipeline.analyze(PATH)
+first = time.perf_counter()
+pipeline.analyze(PATH)
+second = time.perf_counter()
+print(json.dumps({"import": imported - start, "init": initialized - imported,
+                  "first": first - initialized, "second": second - first}))
+"""
+
+MODES = {
+    "birdnet_analyzer": (BIRDNET_ANALYZER, {}),
+    "pipeline": (PIPELINE, {"BIRDNET_WARMUP": "false"}),
+    "pipeline+warmup": (PIPELINE, {"BIRDNET_WARMUP": "true"}),
+}
+
+
+def cold_run(code, env, path):
+    script = f"import json\nPATH = {path!r}\n{code}"
+    result = subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=HERE,
+        env={**os.environ, **env},
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr else "failed")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("audio", help="recording to analyze")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--modes", nargs="+", choices=list(MODES), default=list(MODES))
+    args = parser.parse_args()
+    path = os.path.abspath(args.audio)
+
+    print(f"{'mode':<18} {'import s':>9} {'init s':>8} {'1st req s':>10} {'2nd req s':>10} {'cold total s':>13}")
+    for mode in args.modes:
+        code, env = MODES[mode]
+        try:
+            runs = [cold_run(code, env, path) for _ in range(args.runs)]
+        except RuntimeError as e:
+            print(f"{mode:<18} failed: {e}")
+            continue
+        median = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+        # what a cold start costs before the first response goes out
+        total = median["import"] + median["init"] + median["first"]
+        print(f"{mode:<18} {median['import']:>9.2f} {median['init']:>8.2f} "
+              f"{median['first']:>10.2f} {median['second']:>10.2f} {total:>13.2f}")
+
+
+if __name__ == "__main__":
+    main()
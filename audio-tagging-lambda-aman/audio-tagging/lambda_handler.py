@@ -1,19 +1,24 @@
+import io
 import os
 import boto3
 import logging
-from birdnet_analyzer.analyze.core import analyze
-import numba
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from . import pipeline
 
 
-os.environ["NUMBA_CACHE_DIR"] = "/tmp/numba_cache"
-numba.config.CACHE = False
-
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-# Constants
-AUDIO_DIR = "/tmp/audio"
-OUTPUT_DIR = "/tmp/output"
+# Per-window BirdNET embeddings for "calls like this clip" search in query-by-audio
+EMBEDDING_BUCKET = os.environ.get("EMBEDDING_BUCKET", "birdstore")
+EMBEDDING_PREFIX = os.environ.get("EMBEDDING_PREFIX", "embeddings/audio/")
+
+# Analysis stops this long before the Lambda timeout so the detections so far get stored
+RESPONSE_RESERVE_MS = int(os.environ.get("RESPONSE_RESERVE_MS", "20000"))
+# Recordings of one event analyzed at once; their windows share pipeline's thread pool
+RECORD_CONCURRENCY = int(os.environ.get("RECORD_CONCURRENCY", "4"))
+MEDIA_ATTRIBUTES = "MediaID, FileType, MediaURL, ThumbnailURL, Uploader"
 
 s3 = boto3.client("s3")
 
@@ -50,66 +55,162 @@ def download_model_folder():
     logger.info("✅ Model downloaded to /tmp/checkpoints/V2.4")
 
 
-def lambda_handler(event, context):
-    try:
-        download_model_folder()
-
-        record = event["Records"][0]
-        bucket = record["s3"]["bucket"]["name"]
-        key = record["s3"]["object"]["key"]
-        filename = os.path.basename(key)
-
-        dynamodb = boto3.resource("dynamodb")
-        table_index = dynamodb.Table("BirdBaseIndex")
-
-        os.makedirs(AUDIO_DIR, exist_ok=True)
-        os.makedirs(OUTPUT_DIR, exist_ok=True)
+# Optional eager start: the model is fetched and run once during init, so the first
+# request is as fast as a warm one
+if pipeline.WARMUP:
+    download_model_folder()
+    pipeline.warm_up()
 
-        local_audio_path = os.path.join(AUDIO_DIR, filename)
-        logger.info(f"⬇️ Downloading audio: s3://{bucket}/{key}")
-        s3.download_file(bucket, key, local_audio_path)
 
-        # Convert to .wav if needed
-        input_ext = os.path.splitext(filename)[1].lower()
-        if input_ext != ".wav":
-            wav_filename = os.path.splitext(filename)[0] + ".wav"
-            wav_path = os.path.join(AUDIO_DIR, wav_filename)
-
-            logger.info(f"🎵 Converting {filename} to WAV format...")
-            os.system(f"ffmpeg -y -i '{local_audio_path}' -ar 48000 -ac 1 '{wav_path}'")
-
-            logger.info(f"✅ Conversion done: {wav_filename}")
-            analysis_input_path = wav_path
-        else:
-            analysis_input_path = local_audio_path
+def save_embeddings(media_id, vectors):
+    try:
+        if vectors is None:
+            logger.info("🔇 Audio too short for an analysis window, no embeddings saved")
+            return
+        buffer = io.BytesIO()
+        np.save(buffer, vectors.astype(np.float16))
+        key = f"{EMBEDDING_PREFIX}{media_id}.npy"
+        s3.put_object(Bucket=EMBEDDING_BUCKET, Key=key, Body=buffer.getvalue())
+        logger.info(f"🧬 Saved {len(vectors)} window embeddings to s3://{EMBEDDING_BUCKET}/{key}")
+    except Exception:
+        # similarity search just won't find this recording; tagging still succeeds
+        logger.exception("⚠️ Could not save embeddings")
+
+
+def analyze_record(record, context):
+    """
+    Runs BirdNET over one uploaded recording and saves its window embeddings.
+
+    Returns:
+        dict: MediaID, S3 key, detection windows per species and whether the whole
+              recording was analyzed
+    """
+    bucket = record["s3"]["bucket"]["name"]
+    key = record["s3"]["object"]["key"]
+    bird_id = os.path.splitext(os.path.basename(key))[0]
+
+    # ffmpeg streams the object from a presigned URL and BirdNET scores it window by
+    # window, so memory stays flat however long the recording is
+    audio_url = s3.generate_presigned_url(
+        "get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=3600
+    )
+
+    # Run BirdNET
+    logger.info(f"🔍 Running BirdNET analysis on s3://{bucket}/{key}...")
+    embeddings = []
+    # every 3 s window a species is detected in counts once, like objects in an image
+    found = []
+    analyzed = 0
+    skipped = 0
+    complete = True
+    try:
+        for batch, vectors, scored, quiet in pipeline.analyze_stream(audio_url):
+            embeddings.append(vectors)
+            analyzed += scored + quiet
+            skipped += quiet
+            found.extend(batch)
+            logger.info(
+                f"📈 {bird_id}: {analyzed * pipeline.STEP_SECONDS:.0f} s analyzed, "
+                f"{len({detection.species for detection in found})} species so far"
+            )
+            if context and context.get_remaining_time_in_millis() < RESPONSE_RESERVE_MS:
+                logger.warning(f"⏱️ Running out of time, storing the detections so far for {bird_id}")
+                complete = False
+                break
+    except Exception:
+        # keep what was already scored; only a recording that never decoded fails
+        if not analyzed:
+            raise
+        logger.exception(f"⚠️ Analysis of {bird_id} stopped after {analyzed} windows, storing the detections so far")
+        complete = False
+
+    if pipeline.PREFILTER and analyzed:
+        logger.info(f"🤫 Pre-filter skipped {skipped}/{analyzed} windows of {bird_id} ({skipped / analyzed:.0%})")
+
+    # Saved even without detections, similarity search doesn't need a species
+    save_embeddings(bird_id, np.concatenate(embeddings) if embeddings else None)
+
+    # counted on the 3 s grid, so TagValue doesn't depend on BIRDNET_HOPS
+    species_counts = pipeline.window_counts(found)
+    logger.info(f"📊 Detected species in {bird_id}: {species_counts}")
+    return {
+        "MediaID": bird_id,
+        "key": key,
+        "species": species_counts,
+        "complete": complete
+    }
+
+
+def media_attributes(dynamodb, media_ids):
+    """
+    BirdBase attributes of every media ID, read with batch_get_item 100 keys at a time.
+
+    Returns:
+        dict: MediaID -> {FileType, MediaURL, ThumbnailURL, Uploader} (those present)
+    """
+    found = {}
+    media_ids = list(dict.fromkeys(media_ids))
+    for start in range(0, len(media_ids), 100):
+        request = {"BirdBase": {
+            "Keys": [{"MediaID": media_id} for media_id in media_ids[start:start + 100]],
+            "ProjectionExpression": MEDIA_ATTRIBUTES
+        }}
+        while request:
+            response = dynamodb.batch_get_item(RequestItems=request)
+            for item in response["Responses"].get("BirdBase", []):
+                found[item.pop("MediaID")] = item
+            request = response.get("UnprocessedKeys")
+    return found
 
-        # Run BirdNET
-        logger.info("🔍 Running BirdNET analysis...")
-        species_list = analyze(
-            input=analysis_input_path,
-            output=OUTPUT_DIR,
-        )
 
-        if species_list:
-            species_list = species_list[0]  # Unpack nested list if needed
+def lambda_handler(event, context):
+    try:
+        download_model_folder()
 
-            logger.info(f"📊 Detected species: {species_list}")
+        records = event.get("Records", [])
+        if not records:
+            return {"statusCode": 400, "error": "No S3 records in the event"}
 
+        # Every record of the event, analyzed concurrently
+        workers = max(1, min(len(records), RECORD_CONCURRENCY))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(analyze_record, record, context) for record in records]
 
-            bird_id = os.path.splitext(filename)[0]
+        results, failed = [], []
+        for record, future in zip(records, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logger.exception(f"❌ Could not analyze {record['s3']['object']['key']}")
+                failed.append({"key": record["s3"]["object"]["key"], "error": str(e)})
 
-            # Create BirdBaseIndex entries (one per species)
-            for species in species_list:
-                table_index.put_item(Item={
-                    "TagName": species,
-                    "TagValue": 1,
-                    "MediaID": bird_id
-                })
+        dynamodb = boto3.resource("dynamodb")
+        table_index = dynamodb.Table("BirdBaseIndex")
 
-            return {
-                "statusCode": 200,
-                "message": f"Stored {len(species_list)} species for {filename}"
-            }
+        # Copy the media attributes onto the index rows so search can skip BirdBase
+        tagged = [result for result in results if result["species"]]
+        attributes = media_attributes(dynamodb, [result["MediaID"] for result in tagged])
+
+        # One BirdBaseIndex row per species and recording, all through one batch writer;
+        # it re-sends unprocessed items until DynamoDB accepts them
+        rows = 0
+        with table_index.batch_writer(overwrite_by_pkeys=["TagName", "MediaID"]) as writer:
+            for result in tagged:
+                for species, count in result["species"].items():
+                    writer.put_item(Item={
+                        **attributes.get(result["MediaID"], {}),
+                        "TagName": species,
+                        "TagValue": count,
+                        "MediaID": result["MediaID"]
+                    })
+                    rows += 1
+
+        return {
+            "statusCode": 500 if failed and not results else 200,
+            "message": f"Stored {rows} species rows for {len(results)} of {len(records)} recordings",
+            "results": results,
+            "failed": failed
+        }
 
     except Exception as e:
         logger.exception("❌ Lambda error")
@@ -0,0 +1,441 @@
+import os
+import subprocess
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import numpy as np
+
+try:
+    import tflite_runtime.interpreter as tflite
+except ImportError:
+    from tensorflow import lite as tflite
+
+# In-memory BirdNET: ffmpeg decodes and resamples into a pipe and the TFLite interpreter
+# scores the 3 s windows directly, so nothing is written to /tmp and no result files are
+# produced. Scores match birdnet_analyzer's defaults (sigmoid sensitivity 1.0, min
+# confidence 0.25, no location filter).
+SAMPLE_RATE = 48000
+WINDOW_SECONDS = 3.0
+WINDOW_SAMPLES = int(SAMPLE_RATE * WINDOW_SECONDS)
+# A shorter tail than this is dropped instead of padded into a window
+MIN_SECONDS = 1.0
+MIN_CONFIDENCE = float(os.environ.get("BIRDNET_MIN_CONFIDENCE", "0.25"))
+SIGMOID_SENSITIVITY = 1.0
+
+# Window batches are scored on a thread pool, one interpreter per thread. TFLite releases
+# the GIL while invoking, so the threads use every vCPU without the /dev/shm a process
+# pool needs (Lambda has none). BIRDNET_HOPS > 1 overlaps the windows: 2 starts one every
+# 1.5 s, 3 one every second, like birdnet_analyzer's --overlap.
+WORKERS = int(os.environ.get("BIRDNET_WORKERS", "0")) or os.cpu_count() or 1
+HOPS = max(1, int(os.environ.get("BIRDNET_HOPS", "1")))
+STEP_SAMPLES = WINDOW_SAMPLES // HOPS
+STEP_SECONDS = WINDOW_SECONDS / HOPS
+BATCH_SIZE = 16
+# Load the interpreters and run one batch while the Lambda initializes (see warm_up)
+WARMUP = os.environ.get("BIRDNET_WARMUP", "false").lower() == "true"
+
+# Optional pre-pass that skips quiet windows before BirdNET. A window is scored when the
+# RMS level of its bird band is PREFILTER_MARGIN_DB over the recording's noise floor, or
+# its spectral flux in that band is PREFILTER_FLUX_RATIO times the floor's. The floor is
+# a low percentile of the recent background windows, so it follows wind and rain as they
+# change. Digitally silent windows are always skipped.
+PREFILTER = os.environ.get("BIRDNET_PREFILTER", "false").lower() == "true"
+PREFILTER_MARGIN_DB = float(os.environ.get("BIRDNET_PREFILTER_MARGIN_DB", "6"))
+PREFILTER_FLUX_RATIO = float(os.environ.get("BIRDNET_PREFILTER_FLUX_RATIO", "1.5"))
+PREFILTER_BAND = (1000, 10000)  # Hz, where most bird calls are
+SILENCE_DB = -80.0
+NOISE_HISTORY = 100  # background windows the floor is taken from, about 5 minutes
+NOISE_WARMUP = 3  # windows always scored before the floor means anything
+FRAME_SAMPLES = 1024
+
+EMBEDDING_SIZE = 1024
+MODEL_DIR = os.environ.get("BIRDNET_MODEL_DIR", "/tmp/checkpoints/V2.4")
+MODEL_FILE = "BirdNET_GLOBAL_6K_V2.4_Model_FP32.tflite"
+LABELS_FILE = "BirdNET_GLOBAL_6K_V2.4_Labels.txt"
+
+
+def species_tag(label: str):
+    """
+    The tag a BirdNET label is stored and searched under: its common name, lowercased.
+    "Corvus corax_Common Raven" becomes "common raven", matching the lowercased
+    species names every search path queries with.
+    """
+    return label.rsplit("_", 1)[-1].strip().lower()
+
+
+@dataclass
+class Detection:
+    # species_tag of the BirdNET label
+    species: str
+    confidence: float
+    start: float
+    end: float
+
+
+def stream_signal(source, chunk_samples: int = STEP_SAMPLES):
+    """
+    Decodes any ffmpeg-readable audio to 48 kHz mono float32, chunk_samples at a time.
+    Only one chunk is held in memory, however long the recording is.
+
+    Parameters:
+        source: The encoded file as bytes, or a path / URL ffmpeg can open (a presigned
+                S3 URL is streamed without being downloaded first)
+        chunk_samples (int): Samples per yielded chunk; only the last one is shorter
+
+    Yields:
+        np.ndarray: float32 chunks of the signal
+    """
+    from_bytes = isinstance(source, (bytes, bytearray))
+    process = subprocess.Popen(
+        [
+            "ffmpeg", "-hide_banner", "-loglevel", "error",
+            "-i", "pipe:0" if from_bytes else source,
+            "-f", "f32le", "-ac", "1", "-ar", str(SAMPLE_RATE), "pipe:1",
+        ],
+        stdin=subprocess.PIPE if from_bytes else subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+
+    def feed():
+        # written from a thread so ffmpeg's output pipe never blocks its input
+        try:
+            process.stdin.write(source)
+        except BrokenPipeError:
+            pass
+        finally:
+            process.stdin.close()
+
+    if from_bytes:
+        threading.Thread(target=feed, daemon=True).start()
+
+    try:
+        chunk = bytearray(chunk_samples * 4)
+        view = memoryview(chunk)
+        while True:
+            filled = 0
+            while filled < len(chunk):
+                read = process.stdout.readinto(view[filled:])
+                if not read:
+                    break
+                filled += read
+            if filled:
+                yield np.frombuffer(chunk, dtype=np.float32, count=filled // 4).copy()
+            if filled < len(chunk):
+                break
+        if process.wait() != 0:
+            raise ValueError(f"Could not decode audio: {process.stderr.read().decode(errors='replace').strip()}")
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+
+def stream_windows(chunks):
+    """
+    Turns STEP_SAMPLES-long signal chunks into 3 s windows starting every STEP_SAMPLES.
+    A ring of HOPS chunk slots holds the only copy of the signal, so memory stays at one
+    window. A tail of at least MIN_SECONDS is zero-padded to a full window.
+
+    Yields:
+        tuple: (window index, (WINDOW_SAMPLES,) float32 window)
+    """
+    ring = np.zeros((HOPS, STEP_SAMPLES), dtype=np.float32)
+    received = 0  # chunks written to the ring
+    total = 0  # samples decoded
+
+    def window(index):
+        # the window's chunks in time order, oldest slot first
+        return np.concatenate([ring[(index + slot) % HOPS] for slot in range(HOPS)])
+
+    for chunk in chunks:
+        slot = ring[received % HOPS]
+        slot[:len(chunk)] = chunk
+        slot[len(chunk):] = 0
+        received += 1
+        total += len(chunk)
+        if len(chunk) < STEP_SAMPLES:
+            break
+        if received >= HOPS:
+            yield received - HOPS, window(received - HOPS)
+
+    # windows running past the end of the signal; a short last chunk hasn't ended one yet
+    index = max(received - HOPS + (total == received * STEP_SAMPLES), 0)
+    while total - index * STEP_SAMPLES >= MIN_SECONDS * SAMPLE_RATE:
+        while received < index + HOPS:
+            ring[received % HOPS] = 0
+            received += 1
+        yield index, window(index)
+        index += 1
+
+
+def window_features(windows: np.ndarray):
+    """
+    RMS levels and band-limited spectral flux of each window, vectorized over the batch.
+
+    Returns:
+        tuple: (broadband RMS level in dBFS, RMS level of the bird band in dB,
+                spectral flux of the bird band normalized by its energy), one value per window
+    """
+    rms = np.sqrt(np.mean(np.square(windows, dtype=np.float64), axis=1))
+    level = 20 * np.log10(np.maximum(rms, 1e-10))
+
+    # non-overlapping frames; bins outside the band are dropped, so wind rumble and
+    # hum below it don't count
+    frames = windows[:, :windows.shape[1] // FRAME_SAMPLES * FRAME_SAMPLES]
+    frames = frames.reshape(len(windows), -1, FRAME_SAMPLES) * np.hanning(FRAME_SAMPLES).astype(np.float32)
+    bins = np.fft.rfftfreq(FRAME_SAMPLES, 1 / SAMPLE_RATE)
+    band = (bins >= PREFILTER_BAND[0]) & (bins <= PREFILTER_BAND[1])
+    spectrum = np.abs(np.fft.rfft(frames, axis=-1)[..., band]).astype(np.float32)
+    band_energy = spectrum.sum(axis=2).mean(axis=1)
+    band_level = 10 * np.log10(np.maximum(np.square(spectrum).sum(axis=2).mean(axis=1), 1e-20))
+    # calls switch on and off between frames, steady noise doesn't
+    rise = np.maximum(np.diff(spectrum, axis=1), 0).sum(axis=2).mean(axis=1)
+    flux = rise / np.maximum(band_energy, 1e-10)
+    return level, band_level, flux
+
+
+class NoiseFloor:
+    """
+    The adaptive floor of one recording, taken from its background windows: the first
+    few, then every window without a flux rise. A steady sound (wind, rain, hum) joins
+    the background even while it is loud, so the floor climbs with it.
+    """
+
+    def __init__(self):
+        self.levels = deque(maxlen=NOISE_HISTORY)
+        self.fluxes = deque(maxlen=NOISE_HISTORY)
+
+    def keep(self, windows: np.ndarray):
+        """
+        Which windows of a batch are worth scoring.
+
+        Returns:
+            np.ndarray: bool mask over windows
+        """
+        level, band_level, flux = window_features(windows)
+        # digital silence is never worth a model call
+        audible = level > SILENCE_DB
+        keep = np.zeros(len(windows), dtype=bool)
+
+        if len(self.levels) < NOISE_WARMUP:
+            seed = np.flatnonzero(audible)[:NOISE_WARMUP - len(self.levels)]
+            keep[seed] = True
+            self.levels.extend(band_level[seed])
+            self.fluxes.extend(flux[seed])
+        if len(self.levels) < NOISE_WARMUP:
+            return keep
+
+        rest = audible & ~keep
+        floor_level = np.percentile(self.levels, 20)
+        floor_flux = np.median(self.fluxes)
+        rising = flux >= floor_flux * PREFILTER_FLUX_RATIO
+        keep |= rest & (rising | (band_level >= floor_level + PREFILTER_MARGIN_DB))
+        background = rest & ~rising
+        self.levels.extend(band_level[background])
+        self.fluxes.extend(flux[background])
+        return keep
+
+
+class Classifier:
+    """
+    The BirdNET TFLite model with both of its outputs: species scores and the
+    1024-d feature embedding of each window.
+    """
+
+    def __init__(self, model_dir: str = MODEL_DIR, threads: int = 1):
+        self.interpreter = tflite.Interpreter(
+            model_path=os.path.join(model_dir, MODEL_FILE),
+            num_threads=threads,
+        )
+        self.interpreter.allocate_tensors()
+        self.input_index = self.interpreter.get_input_details()[0]["index"]
+        # the embedding layer is the tensor right before the classification output
+        self.output_index = self.interpreter.get_output_details()[0]["index"]
+        self.embedding_index = self.output_index - 1
+        with open(os.path.join(model_dir, LABELS_FILE), encoding="utf-8") as f:
+            self.labels = [line.strip() for line in f if line.strip()]
+        self.batch_size = None
+
+    def _invoke(self, windows: np.ndarray):
+        if len(windows) != self.batch_size:
+            self.interpreter.resize_tensor_input(self.input_index, list(windows.shape))
+            self.interpreter.allocate_tensors()
+            self.batch_size = len(windows)
+        self.interpreter.set_tensor(self.input_index, np.ascontiguousarray(windows, dtype=np.float32))
+        self.interpreter.invoke()
+
+    def infer(self, windows: np.ndarray):
+        """
+        One forward pass over a batch of windows.
+
+        Returns:
+            tuple: (species confidences (windows, labels), embeddings (windows, 1024))
+        """
+        self._invoke(windows)
+        logits = self.interpreter.get_tensor(self.output_index)
+        scores = 1 / (1.0 + np.exp(-SIGMOID_SENSITIVITY * np.clip(logits, -20, 20)))
+        return scores, np.array(self.interpreter.get_tensor(self.embedding_index))
+
+
+_local = threading.local()
+_executor = None
+
+
+def get_classifier():
+    # One interpreter per thread, loaded once per warm container
+    if not hasattr(_local, "classifier"):
+        _local.classifier = Classifier()
+    return _local.classifier
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=WORKERS)
+    return _executor
+
+
+def warm_up():
+    """
+    Loads an interpreter on every worker thread and runs one batch of silence through
+    each, so the first request doesn't pay for loading the model and sizing its tensors.
+    """
+    windows = np.zeros((BATCH_SIZE, WINDOW_SAMPLES), dtype=np.float32)
+    if WORKERS < 2:
+        get_classifier().infer(windows)
+        return
+
+    # every task waits for the others, so each one gets a thread of its own
+    barrier = threading.Barrier(WORKERS)
+
+    def warm(_):
+        barrier.wait(timeout=60)
+        get_classifier().infer(windows)
+
+    list(_get_executor().map(warm, range(WORKERS)))
+
+
+def detections(scores: np.ndarray, labels: list, indices: np.ndarray, min_confidence: float = MIN_CONFIDENCE):
+    """
+    Turns window scores into Detections; indices are the window index of each row.
+    """
+    found = []
+    for row, label in zip(*np.nonzero(scores >= min_confidence)):
+        start = float(indices[row] * STEP_SECONDS)
+        found.append(Detection(species_tag(labels[label]), float(scores[row, label]), start, start + WINDOW_SECONDS))
+    return found
+
+
+def window_counts(found):
+    """
+    The number of 3 s windows each species was detected in, counted on the BIRDNET_HOPS=1
+    grid: a detection belongs to the 3 s slot its window starts in, and a slot counts once
+    however many overlapping windows found the species there. The value is then the same
+    unit for every BIRDNET_HOPS, overlap only helps find calls that straddle two slots.
+
+    Parameters:
+        found: Detections, from any number of batches of one recording
+
+    Returns:
+        dict: species -> number of 3 s slots
+    """
+    slots = {}
+    for detection in found:
+        # starts are multiples of STEP_SECONDS; the epsilon absorbs float error
+        slots.setdefault(detection.species, set()).add(int(detection.start / WINDOW_SECONDS + 1e-6))
+    return {species: len(species_slots) for species, species_slots in slots.items()}
+
+
+def _score_batch(windows: np.ndarray, indices: np.ndarray, keep: np.ndarray, min_confidence: float):
+    # embeddings stay on the 3 s grid whatever the overlap, so stored rows keep their
+    # meaning; skipped windows get zero vectors, which never match anything
+    grid = indices % HOPS == 0
+    vectors = np.zeros((int(grid.sum()), EMBEDDING_SIZE), dtype=np.float32)
+    found = []
+    if keep.any():
+        classifier = get_classifier()
+        scores, embedded = classifier.infer(windows[keep])
+        found = detections(scores, classifier.labels, indices[keep], min_confidence)
+        vectors[keep[grid]] = embedded[grid[keep]]
+    return found, vectors, int(keep.sum()), int((~keep).sum())
+
+
+def _batches(windows):
+    batch, indices = [], []
+    for index, window in windows:
+        batch.append(window)
+        indices.append(index)
+        if len(batch) == BATCH_SIZE:
+            yield np.stack(batch), np.array(indices)
+            batch, indices = [], []
+    if batch:
+        yield np.stack(batch), np.array(indices)
+
+
+def analyze_stream(source, min_confidence: float = MIN_CONFIDENCE, prefilter: bool = PREFILTER):
+    """
+    Runs BirdNET over a recording while it is being decoded. At most 2 * WORKERS batches
+    are decoded ahead of the scoring, so memory stays flat whatever the duration.
+
+    Parameters:
+        source: The encoded file as bytes, or a path / URL ffmpeg can open
+        min_confidence (float): Detections below this are dropped
+        prefilter (bool): Skip windows that stay at the noise floor
+
+    Yields:
+        tuple: (Detections of one batch of windows, their embeddings on the 3 s grid,
+                number of windows scored, number of windows skipped), in time order
+    """
+    noise_floor = NoiseFloor() if prefilter else None
+
+    def batches():
+        # the floor is updated in order here, only the scoring runs on the pool
+        for windows, indices in _batches(stream_windows(stream_signal(source))):
+            keep = noise_floor.keep(windows) if noise_floor else np.ones(len(windows), dtype=bool)
+            yield windows, indices, keep
+
+    if WORKERS < 2:
+        for windows, indices, keep in batches():
+            yield _score_batch(windows, indices, keep, min_confidence)
+        return
+
+    executor = _get_executor()
+    pending = deque()
+    for windows, indices, keep in batches():
+        pending.append(executor.submit(_score_batch, windows, indices, keep, min_confidence))
+        if len(pending) >= 2 * WORKERS:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def analyze(source, min_confidence: float = MIN_CONFIDENCE, prefilter: bool = PREFILTER):
+    """
+    Runs BirdNET over a whole recording.
+
+    Returns:
+        tuple: (Detection of every species over min_confidence in every window, in time
+                order; embeddings of every 3 s window (windows, 1024), or None if the
+                recording is shorter than one window; {"scored": n, "skipped": n} windows)
+    """
+    found, embeddings = [], []
+    stats = {"scored": 0, "skipped": 0}
+    for batch, vectors, scored, skipped in analyze_stream(source, min_confidence, prefilter):
+        found.extend(batch)
+        embeddings.append(vectors)
+        stats["scored"] += scored
+        stats["skipped"] += skipped
+    return found, np.concatenate(embeddings) if embeddings else None, stats
+
+
+def species_of(found: list):
+    """
+    Distinct species in found, most confident first.
+    """
+    best = {}
+    for detection in found:
+        best[detection.species] = max(detection.confidence, best.get(detection.species, 0.0))
+    return sorted(best, key=best.get, reverse=True)
@@ -0,0 +1,79 @@
+"""
+Measures what the silence pre-filter saves and what it misses on a local corpus.
+
+    BIRDNET_MODEL_DIR=./checkpoints/V2.4 python prefilter_benchmark.py recordings/ --margin-db 6
+
+Every file is analyzed twice, without and with the pre-filter. The full run is the
+reference: recall is the share of its (species, window) detections the filtered run
+still finds, and species recall the share of its species.
+"""
+import argparse
+import os
+import time
+
+import pipeline
+
+AUDIO_EXTENSIONS = (".wav", ".mp3", ".flac", ".ogg", ".m4a", ".aac")
+
+
+def run(path, prefilter):
+    start = time.perf_counter()
+    found, _, stats = pipeline.analyze(path, prefilter=prefilter)
+    return found, stats, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("corpus", help="directory of recordings")
+    parser.add_argument("--margin-db", type=float, default=pipeline.PREFILTER_MARGIN_DB)
+    parser.add_argument("--flux-ratio", type=float, default=pipeline.PREFILTER_FLUX_RATIO)
+    args = parser.parse_args()
+    pipeline.PREFILTER_MARGIN_DB = args.margin_db
+    pipeline.PREFILTER_FLUX_RATIO = args.flux_ratio
+
+    paths = sorted(
+        os.path.join(root, name)
+        for root, _, names in os.walk(args.corpus)
+        for name in names
+        if name.lower().endswith(AUDIO_EXTENSIONS)
+    )
+    if not paths:
+        parser.error(f"no recordings under {args.corpus}")
+
+    totals = {"full_s": 0.0, "filtered_s": 0.0, "windows": 0, "skipped": 0,
+              "hits": 0, "kept_hits": 0, "species": 0, "kept_species": 0}
+    print(f"{'file':<40} {'skipped':>8} {'full s':>8} {'filtered s':>11} {'recall':>7} {'species':>8}")
+    for path in paths:
+        full, _, full_s = run(path, prefilter=False)
+        filtered, stats, filtered_s = run(path, prefilter=True)
+
+        reference = {(d.species, d.start) for d in full}
+        kept = reference & {(d.species, d.start) for d in filtered}
+        species = {d.species for d in full}
+        kept_species = species & {d.species for d in filtered}
+        windows = stats["scored"] + stats["skipped"]
+
+        print(f"{os.path.basename(path)[:40]:<40} {stats['skipped'] / max(windows, 1):>8.0%} "
+              f"{full_s:>8.1f} {filtered_s:>11.1f} "
+              f"{len(kept) / max(len(reference), 1):>7.0%} {f'{len(kept_species)}/{len(species)}':>8}")
+
+        totals["full_s"] += full_s
+        totals["filtered_s"] += filtered_s
+        totals["windows"] += windows
+        totals["skipped"] += stats["skipped"]
+        totals["hits"] += len(reference)
+        totals["kept_hits"] += len(kept)
+        totals["species"] += len(species)
+        totals["kept_species"] += len(kept_species)
+
+    print(f"\n{len(paths)} files, {totals['windows']} windows, "
+          f"margin {args.margin_db} dB, flux ratio {args.flux_ratio}")
+    print(f"skipped {totals['skipped'] / max(totals['windows'], 1):.1%} of windows, "
+          f"{totals['full_s']:.1f} s -> {totals['filtered_s']:.1f} s "
+          f"(x{totals['full_s'] / max(totals['filtered_s'], 1e-9):.2f})")
+    print(f"detection recall {totals['kept_hits'] / max(totals['hits'], 1):.1%}, "
+          f"species recall {totals['kept_species'] / max(totals['species'], 1):.1%}")
+
+
+if __name__ == "__main__":
+    main()
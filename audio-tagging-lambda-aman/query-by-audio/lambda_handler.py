@@ -3,21 +3,27 @@ import boto3
 import logging
 import json
 import base64
-from birdnet_analyzer.analyze.core import analyze
-import numba
+import heapq
+from collections import Counter, defaultdict
+import numpy as np
 from pynamodb.models import Model
 from pynamodb.attributes import UnicodeAttribute, NumberAttribute
 from . import helper as _
-
-os.environ["NUMBA_CACHE_DIR"] = "/tmp/numba_cache"
-numba.config.CACHE = False
+from . import vectors
+from . import pipeline
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-# Constants
-AUDIO_DIR = "/tmp/audio"
-OUTPUT_DIR = "/tmp/output"
+# Vector index over the per-window embeddings audio-tagging stores
+INDEX_BUCKET = os.environ.get("VECTOR_INDEX_BUCKET", "birdstore")
+INDEX_PREFIX = os.environ.get("VECTOR_INDEX_PREFIX", "indexes/audio-vectors/")
+INDEX_TTL = int(os.environ.get("VECTOR_INDEX_TTL", "60"))
+INDEX_PROBES = int(os.environ.get("VECTOR_INDEX_PROBES", "8"))
+# Windows fetched per wanted recording, since one recording can fill several hits
+WINDOW_OVERSAMPLE = 5
+# Species matches returned when the request doesn't say
+DEFAULT_MATCHES = 20
 
 s3 = boto3.client("s3")
 
@@ -63,6 +69,12 @@ class BirdBaseIndexModel(Model):
     # UUID of the media file
     MediaID = UnicodeAttribute(range_key=True)
 
+    # Copies of the BirdBase attributes so a search can answer from the index alone.
+    # Rows written before these existed leave them empty and get hydrated from BirdBase.
+    FileType = UnicodeAttribute(null=True)
+    MediaURL = UnicodeAttribute(null=True)
+    ThumbnailURL = UnicodeAttribute(null=True)
+    Uploader = UnicodeAttribute(null=True)
 
 
 def download_model_folder():
@@ -97,6 +109,87 @@ def download_model_folder():
     logger.info("✅ Model downloaded to /tmp/checkpoints/V2.4")
 
 
+# Optional eager start: the model is fetched and run once during init, so the first
+# request is as fast as a warm one
+if pipeline.WARMUP:
+    download_model_folder()
+    pipeline.warm_up()
+
+
+
+def similar_recordings(audio_data, k):
+    """
+    Recordings with a call like one in the clip, answered from the vector index alone.
+    Each recording is scored by its best matching window.
+    """
+    index = vectors.get_index(s3, INDEX_BUCKET, INDEX_PREFIX, INDEX_TTL)
+    if index is None:
+        return _.build_response(503, {
+            "message": "The similarity index has not been built yet"
+        })
+
+    _found, query, _stats = pipeline.analyze(audio_data)
+    if query is not None:
+        # windows the pre-filter skipped have zero vectors and match nothing
+        query = query[np.any(query != 0, axis=1)]
+    if query is None or not len(query):
+        return _.build_response(400, {
+            "message": "Audio clip is silent or shorter than one analysis window"
+        })
+
+    # MediaID -> (best score, window of that score)
+    best = {}
+    for window in query:
+        for vector_id, score in index.search(window, k * WINDOW_OVERSAMPLE, INDEX_PROBES):
+            media_id, sep, row = vector_id.partition("#")
+            if media_id not in best or score > best[media_id][0]:
+                best[media_id] = (score, int(row or 0))
+    top = dict(sorted(best.items(), key=lambda entry: entry[1][0], reverse=True)[:k])
+    logger.info(f"🧬 {len(query)} query windows matched {len(best)} recordings")
+
+    matching_media = []
+    for media_item in BirdBaseModel.batch_get(list(top)):
+        score, row = top[media_item.MediaID]
+        matching_media.append({
+            "MediaID": media_item.MediaID,
+            "FileType": media_item.FileType,
+            "MediaURL": _.generate_presigned_url(media_item.MediaURL, s3),
+            "ThumbnailURL": media_item.ThumbnailURL,
+            "Uploader": media_item.Uploader,
+            "Score": round(score, 4),
+            # where in the recording the matching call starts
+            "MatchStart": row * pipeline.WINDOW_SECONDS
+        })
+    matching_media.sort(key=lambda media: media["Score"], reverse=True)
+
+    return _.build_response(200, {
+        "matching_media": matching_media
+    })
+
+
+def rank_media(species_windows, k):
+    """
+    Scores every media file sharing a species with the clip, in one pass over those
+    species' index partitions, and keeps the k best on a bounded heap.
+
+    A species adds min(its windows in the clip, the file's TagValue) / its windows in
+    the clip, so a file with every species at least as often as the clip scores
+    len(species_windows).
+
+    Returns:
+        list: (score, matched species, MediaID), best first
+    """
+    scores = defaultdict(float)
+    matched = Counter()
+    for species, windows in species_windows.items():
+        logger.info(f"🔎 Querying BirdBaseIndex for species: {species}")
+        # only the key and count are read, the winners are hydrated afterwards
+        for entry in BirdBaseIndexModel.query(species.lower(), attributes_to_get=["MediaID", "TagValue"]):
+            scores[entry.MediaID] += min(windows, entry.TagValue) / windows
+            matched[entry.MediaID] += 1
+    logger.info(f"📊 {len(scores)} media files share a species with the clip")
+    return heapq.nlargest(k, ((score, matched[media_id], media_id) for media_id, score in scores.items()))
+
 
 def lambda_handler(event, context):
     try:
@@ -123,70 +216,60 @@ def lambda_handler(event, context):
         audio_data = base64.b64decode(body["audio"])
         filename = body["filename"]
 
-        # Save audio to temp file
-        os.makedirs(AUDIO_DIR, exist_ok=True)
-        os.makedirs(OUTPUT_DIR, exist_ok=True)
-        local_audio_path = os.path.join(AUDIO_DIR, filename)
-
-        logger.info(f"Saving base64 audio to: {local_audio_path}")
-        with open(local_audio_path, "wb") as f:
-            f.write(audio_data)
+        # Decoded and resampled in memory while BirdNET scores it, nothing is written to /tmp
+        logger.info(f"🎵 Analyzing {filename}...")
 
-        # Convert to WAV if needed
-        input_ext = os.path.splitext(filename)[1].lower()
-        if input_ext != ".wav":
-            wav_filename = os.path.splitext(filename)[0] + ".wav"
-            wav_path = os.path.join(AUDIO_DIR, wav_filename)
-
-            logger.info(f"🎵 Converting {filename} to WAV format...")
-            os.system(f"ffmpeg -y -i '{local_audio_path}' -ar 48000 -ac 1 '{wav_path}'")
+        similar = str(body.get("mode", "")).lower() == "similar"
+        try:
+            k = min(max(int(body.get("k", 10 if similar else DEFAULT_MATCHES)), 1), 100)
+        except (TypeError, ValueError):
+            return _.build_response(400, {
+                "message": "'k' must be a number"
+            })
 
-            logger.info(f"✅ Conversion done: {wav_filename}")
-            analysis_input_path = wav_path
-        else:
-            analysis_input_path = local_audio_path
+        # "mode": "similar" finds recordings with a call like this clip, no species step
+        if similar:
+            return similar_recordings(audio_data, k)
 
         # Run BirdNET
         logger.info("🔍 Running BirdNET analysis...")
-        species_list = analyze(
-            input=analysis_input_path,
-            output=OUTPUT_DIR,
-        )
-
-        if species_list:
-            species_list = species_list[0]  # Unpack nested list
-            logger.info(f"📊 Detected species: {species_list}")
-
-            # Query BirdBaseIndex and fetch media for detected species
-            matching_media = []
-            for species in species_list:
-                logger.info(f"🔎 Querying BirdBaseIndex for species: {species}")
-
-                index_entries = BirdBaseIndexModel.query(species.lower())
-
-                for entry in index_entries:
-                    logger.info(f"Found MediaID: {entry.MediaID}")
-                    # Fetch media info from BirdBase
-                    try:
-                        media_item = BirdBaseModel.get(entry.MediaID)
-                        matching_media.append({
-                            "MediaID": media_item.MediaID,
-                            "FileType": media_item.FileType,
-                            "MediaURL":  _.generate_presigned_url(media_item.MediaURL, s3),
-                            "ThumbnailURL": media_item.ThumbnailURL,
-                            "Uploader": media_item.Uploader
-                        })
-                    except BirdBaseModel.DoesNotExist:
-                        logger.warning(f"MediaID {entry.MediaID} not found in BirdBase")
-
-            return  _.build_response(200,{
-                "detected_species": species_list,
-                "matching_media": matching_media
-            })
-        else:
+        detections, _embeddings, stats = pipeline.analyze(audio_data)
+        if pipeline.PREFILTER:
+            logger.info(f"🤫 Pre-filter skipped {stats['skipped']} of {stats['scored'] + stats['skipped']} windows")
+        species_list = pipeline.species_of(detections)
+
+        if not species_list:
             return _.build_response(200, {
                 "detected_species": species_list,
-                "matching_media": matching_media
+                "matching_media": []
+            })
+
+        logger.info(f"📊 Detected species: {species_list}")
+        # the same 3 s grid count TagValue holds, whatever BIRDNET_HOPS is
+        ranked = rank_media(pipeline.window_counts(detections), k)
+
+        # Only the winners are read from BirdBase, in one batch
+        winner_ids = [media_id for *_, media_id in ranked]
+        media_items = {item.MediaID: item for item in BirdBaseModel.batch_get(winner_ids)}
+        matching_media = []
+        for score, matched, media_id in ranked:
+            media_item = media_items.get(media_id)
+            if media_item is None:
+                logger.warning(f"MediaID {media_id} not found in BirdBase")
+                continue
+            matching_media.append({
+                "MediaID": media_item.MediaID,
+                "FileType": media_item.FileType,
+                "MediaURL": _.generate_presigned_url(media_item.MediaURL, s3),
+                "ThumbnailURL": media_item.ThumbnailURL,
+                "Uploader": media_item.Uploader,
+                "Score": round(score, 4),
+                "MatchedSpecies": matched
+            })
+
+        return _.build_response(200, {
+            "detected_species": species_list,
+            "matching_media": matching_media
         })
 
     except Exception as e:
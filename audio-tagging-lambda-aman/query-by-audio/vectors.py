@@ -0,0 +1,256 @@
+import argparse
+import io
+import json
+import os
+import time
+
+import boto3
+import numpy as np
+
+# An IVF (inverted file) index: vectors are clustered around n_lists centroids and
+# stored grouped by cluster, so a search only scores the few clusters closest to the
+# query. Every array is a plain float16 .npy file that warm Lambdas memory-map from /tmp.
+INDEX_FILES = ("centroids.npy", "vectors.npy", "offsets.npy", "ids.json")
+MANIFEST = "manifest.json"
+KMEANS_ITERATIONS = 10
+
+
+def normalize(vectors: np.ndarray):
+    """
+    L2-normalizes rows so a dot product is the cosine similarity.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def kmeans(vectors: np.ndarray, n_lists: int, seed: int = 0):
+    """
+    Spherical k-means over normalized vectors.
+
+    Parameters:
+        vectors (np.ndarray): (n, d) normalized float32 vectors
+        n_lists (int): Number of clusters
+        seed (int): Seed for picking the initial centroids
+
+    Returns:
+        tuple: (centroids, assignment of each vector)
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)]
+    for _ in range(KMEANS_ITERATIONS):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        for cluster in range(n_lists):
+            members = vectors[assignment == cluster]
+            # an empty cluster keeps its old centroid
+            if len(members):
+                centroids[cluster] = members.sum(axis=0)
+        centroids = normalize(centroids)
+    return centroids, np.argmax(vectors @ centroids.T, axis=1)
+
+
+class VectorIndex:
+    def __init__(self, centroids, vectors, offsets, ids):
+        self.centroids = centroids
+        self.vectors = vectors
+        self.offsets = offsets
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, ids: list, vectors: np.ndarray, n_lists: int = None):
+        """
+        Builds an index over vectors; n_lists defaults to about sqrt(n) clusters.
+        """
+        vectors = normalize(vectors)
+        n_lists = min(n_lists or max(1, int(np.sqrt(len(vectors)))), len(vectors))
+        centroids, assignment = kmeans(vectors, n_lists)
+
+        # group the vectors by cluster; offsets[c]:offsets[c + 1] is cluster c
+        order = np.argsort(assignment, kind="stable")
+        offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(assignment, minlength=n_lists))
+        return cls(
+            centroids.astype(np.float16),
+            vectors[order].astype(np.float16),
+            offsets,
+            [ids[i] for i in order],
+        )
+
+    def search(self, query: np.ndarray, k: int = 10, n_probe: int = 8):
+        """
+        Approximate top-k neighbours of query by cosine similarity.
+
+        Parameters:
+            query (np.ndarray): Query vector
+            k (int): Number of neighbours to return
+            n_probe (int): Number of closest clusters to score
+
+        Returns:
+            list: (id, score) pairs, best first
+        """
+        if not len(self):
+            return []
+        query = normalize(query).ravel()
+        n_probe = min(n_probe, len(self.centroids))
+        cluster_scores = self.centroids.astype(np.float32) @ query
+        clusters = np.argpartition(-cluster_scores, n_probe - 1)[:n_probe]
+
+        positions = np.concatenate([
+            np.arange(self.offsets[cluster], self.offsets[cluster + 1]) for cluster in clusters
+        ])
+        if not len(positions):
+            return []
+        scores = self.vectors[positions].astype(np.float32) @ query
+        top = np.argpartition(-scores, min(k, len(scores)) - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.ids[positions[i]], float(scores[i])) for i in top]
+
+    def save(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, "centroids.npy"), self.centroids)
+        np.save(os.path.join(directory, "vectors.npy"), self.vectors)
+        np.save(os.path.join(directory, "offsets.npy"), self.offsets)
+        with open(os.path.join(directory, "ids.json"), "w") as f:
+            json.dump(self.ids, f)
+
+    @classmethod
+    def load(cls, directory: str):
+        """
+        Opens a saved index; the vectors stay on disk and are paged in on demand.
+        """
+        with open(os.path.join(directory, "ids.json")) as f:
+            ids = json.load(f)
+        return cls(
+            np.load(os.path.join(directory, "centroids.npy")),
+            np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r"),
+            np.load(os.path.join(directory, "offsets.npy")),
+            ids,
+        )
+
+
+# Warm containers keep the opened index and only re-check S3 once per TTL
+_cache = {"index": None, "etag": None, "checked_at": 0.0}
+
+
+def get_index(s3_client, bucket: str, prefix: str, ttl: int = 60):
+    """
+    Returns the index stored under s3://bucket/prefix, downloading it to /tmp only
+    when its manifest changed. Returns None if no index has been built yet.
+    """
+    now = time.time()
+    if now - _cache["checked_at"] < ttl:
+        return _cache["index"]
+    _cache["checked_at"] = now
+
+    try:
+        head = s3_client.head_object(Bucket=bucket, Key=prefix + MANIFEST)
+    except s3_client.exceptions.ClientError as e:
+        print(f"No vector index at s3://{bucket}/{prefix}: {e}")
+        return _cache["index"]
+
+    if head["ETag"] != _cache["etag"]:
+        manifest = json.loads(s3_client.get_object(Bucket=bucket, Key=prefix + MANIFEST)["Body"].read())
+        version_prefix = f"{prefix}{manifest['version']}/"
+        directory = os.path.join("/tmp", "vectors", version_prefix.strip("/").replace("/", "_"))
+        if not os.path.exists(os.path.join(directory, "ids.json")):
+            os.makedirs(directory, exist_ok=True)
+            # ids.json comes last, so an interrupted download is fetched again next time
+            for name in INDEX_FILES:
+                s3_client.download_file(bucket, version_prefix + name, os.path.join(directory, name))
+        _cache["index"], _cache["etag"] = VectorIndex.load(directory), head["ETag"]
+        print(f"Loaded vector index s3://{bucket}/{version_prefix} ({len(_cache['index'])} vectors)")
+    return _cache["index"]
+
+
+def rebuild(s3_client, bucket: str, embeddings_prefix: str, index_prefix: str, n_lists: int = None):
+    """
+    Rebuilds the index from every .npy embedding under embeddings_prefix and uploads it.
+    The object name (without .npy) becomes the vector's ID.
+    """
+    started = time.time()
+    ids, vectors = [], []
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=embeddings_prefix):
+        for obj in page.get("Contents", []):
+            if not obj["Key"].endswith(".npy"):
+                continue
+            body = s3_client.get_object(Bucket=bucket, Key=obj["Key"])["Body"].read()
+            vector = np.load(io.BytesIO(body))
+            name = os.path.basename(obj["Key"])[: -len(".npy")]
+            # a file may hold one vector or one per row (e.g. per analysis window)
+            for row, values in enumerate(np.atleast_2d(vector)):
+                # all-zero rows are placeholders (e.g. windows the audio pre-filter skipped)
+                if not values.any():
+                    continue
+                ids.append(name if vector.ndim == 1 else f"{name}#{row}")
+                vectors.append(values)
+
+    if not vectors:
+        print(f"No embeddings under s3://{bucket}/{embeddings_prefix}")
+        return None
+
+    index = VectorIndex.build(ids, np.stack(vectors), n_lists)
+    directory = os.path.join("/tmp", "vectors-build")
+    index.save(directory)
+    # each build goes to its own folder and the manifest is switched last, so readers
+    # never mix files from two builds
+    version = time.strftime("%Y%m%dT%H%M%S", time.gmtime())
+    for name in INDEX_FILES:
+        s3_client.upload_file(os.path.join(directory, name), bucket, f"{index_prefix}{version}/{name}")
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=index_prefix + MANIFEST,
+        # embeddings written after "started" may be missing from this build
+        Body=json.dumps({"version": version, "count": len(index), "lists": len(index.centroids),
+                         "started": started}),
+        ContentType="application/json",
+    )
+    print(f"Built vector index with {len(index)} vectors in {len(index.centroids)} lists")
+    return index
+
+
+def needs_rebuild(s3_client, bucket: str, embeddings_prefix: str, index_prefix: str):
+    """
+    Whether any embedding was written after the current index started building.
+    """
+    try:
+        manifest = json.loads(s3_client.get_object(Bucket=bucket, Key=index_prefix + MANIFEST)["Body"].read())
+    except s3_client.exceptions.ClientError:
+        return True
+    # manifests from before "started" was recorded force one rebuild
+    started = manifest.get("started", 0)
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=embeddings_prefix):
+        if any(obj["LastModified"].timestamp() > started for obj in page.get("Contents", [])):
+            return True
+    return False
+
+
+def lambda_handler(event, context):
+    """
+    Scheduled rebuild, for an EventBridge schedule rule (see the README). Embeddings
+    written since the last build are only searchable after the next one, so the rule's
+    rate is how stale similarity results can get. Nothing is built when no embedding changed.
+    """
+    s3_client = boto3.client("s3")
+    bucket = os.environ.get("EMBEDDING_BUCKET", "birdstore")
+    embeddings_prefix = os.environ.get("EMBEDDING_PREFIX", "embeddings/audio/")
+    index_prefix = os.environ.get("VECTOR_INDEX_PREFIX", "indexes/audio-vectors/")
+    if not needs_rebuild(s3_client, bucket, embeddings_prefix, index_prefix):
+        print(f"No new embeddings under s3://{bucket}/{embeddings_prefix}, index is current")
+        return {"statusCode": 200, "body": json.dumps({"rebuilt": False})}
+    index = rebuild(s3_client, bucket, embeddings_prefix, index_prefix)
+    return {"statusCode": 200, "body": json.dumps({"rebuilt": index is not None, "count": len(index) if index else 0})}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild a vector index from stored embeddings")
+    parser.add_argument("--bucket", default=os.environ.get("EMBEDDING_BUCKET", "birdstore"))
+    parser.add_argument("--embeddings", default=os.environ.get("EMBEDDING_PREFIX", "embeddings/audio/"))
+    parser.add_argument("--index", default=os.environ.get("VECTOR_INDEX_PREFIX", "indexes/audio-vectors/"))
+    parser.add_argument("--lists", type=int, default=None, help="number of IVF lists (default sqrt(n))")
+    args = parser.parse_args()
+    rebuild(boto3.client("s3"), args.bucket, args.embeddings, args.index, args.lists)
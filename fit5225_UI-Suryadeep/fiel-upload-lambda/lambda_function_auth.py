@@ -1,24 +1,352 @@
 import json
+import math
 import boto3
 import uuid
 import os
+from botocore.exceptions import ClientError
 
 s3 = boto3.client('s3')
 dynamodb = boto3.resource('dynamodb')
 BUCKET_NAME = 'birdstore'
 TABLE_NAME = 'BirdBase' 
 
+MEDIA_FOLDERS = {'audio': 'audio', 'videos': 'video', 'images': 'image'}
+
+# Multipart uploads for large files: the client uploads the parts in parallel with
+# presigned URLs, can resume after a failure, and the file is only registered in
+# BirdBase once the upload is completed
+PART_SIZE = int(os.environ.get('MULTIPART_PART_SIZE', str(16 * 1024 * 1024)))
+MIN_PART_SIZE = 5 * 1024 * 1024  # S3's minimum for every part but the last
+MAX_PARTS = 10000
+PART_URL_EXPIRATION = int(os.environ.get('MULTIPART_URL_EXPIRATION', '3600'))
+# Part URLs returned per call (about 1 KB each), well under Lambda's 6 MB response limit;
+# the client fetches the rest with presign_parts
+PART_URL_BATCH = int(os.environ.get('MULTIPART_URL_BATCH', '500'))
+# Who started each multipart upload, as <prefix><MediaID>.json; later calls must come from
+# the same user. Outside the media folders, so no upload event fires for it. Add a
+# lifecycle rule to expire what abandoned uploads leave behind.
+PENDING_PREFIX = os.environ.get('MULTIPART_PENDING_PREFIX', 'uploads/pending/')
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Headers': 'Content-Type',
+    'Access-Control-Allow-Methods': 'OPTIONS,POST',
+}
+
+def response(status_code, body=None):
+    # Every reply goes through here so they all carry the same CORS headers
+    return {
+        'statusCode': status_code,
+        'headers': CORS_HEADERS,
+        'body': json.dumps(body) if body is not None else ''
+    }
+
+def media_folder(file_extension):
+    """
+    Returns the S3 folder and BirdBase FileType for an extension, or (None, None).
+    """
+    audio_extensions = ['.wav', '.mp3', '.m4a']
+    video_extensions = ['.mp4', '.mov', '.avi']
+    image_extensions = ['.jpg', '.png']
+
+    if file_extension.lower() in audio_extensions:
+        return 'audio', 'audio'
+    elif file_extension.lower() in video_extensions:
+        return 'videos', 'video'
+    elif file_extension.lower() in image_extensions:
+        return 'images', 'image'
+    return None, None
+
+def part_urls(s3_key, upload_id, part_numbers):
+    return [
+        {
+            'part_number': part_number,
+            'upload_url': s3.generate_presigned_url(
+                ClientMethod='upload_part',
+                Params={
+                    'Bucket': BUCKET_NAME,
+                    'Key': s3_key,
+                    'UploadId': upload_id,
+                    'PartNumber': part_number
+                },
+                ExpiresIn=PART_URL_EXPIRATION
+            )
+        }
+        for part_number in part_numbers
+    ]
+
+def uploaded_parts(s3_key, upload_id):
+    parts = []
+    list_args = {'Bucket': BUCKET_NAME, 'Key': s3_key, 'UploadId': upload_id}
+    while True:
+        page = s3.list_parts(**list_args)
+        parts.extend(page.get('Parts', []))
+        if not page.get('IsTruncated'):
+            return parts
+        list_args['PartNumberMarker'] = page['NextPartNumberMarker']
+
+def object_exists(s3_key):
+    try:
+        s3.head_object(Bucket=BUCKET_NAME, Key=s3_key)
+        return True
+    except ClientError:
+        return False
+
+def pending_key(s3_key):
+    media_id = os.path.splitext(os.path.basename(s3_key))[0]
+    return f"{PENDING_PREFIX}{media_id}.json"
+
+def check_uploader(s3_key, upload_id, user_id):
+    """
+    Returns None if user_id started this multipart upload, otherwise the error response.
+    """
+    try:
+        pending = json.loads(s3.get_object(Bucket=BUCKET_NAME, Key=pending_key(s3_key))['Body'].read())
+    except ClientError:
+        return response(404, 'Upload not found')
+    if pending['upload_id'] != upload_id or pending['uploader'] != user_id:
+        return response(403, 'The upload was started by another user')
+    return None
+
+def registered_by(media_id, user_id):
+    item = dynamodb.Table(TABLE_NAME).get_item(Key={'MediaID': media_id}).get('Item')
+    return item is not None and item.get('Uploader') == user_id
+
+def multipart_target(data):
+    """
+    The (s3_key, upload_id) a multipart call refers to, or (None, None) if the key
+    is not a media upload.
+    """
+    s3_key = data.get('s3_key', '')
+    upload_id = data.get('upload_id', '')
+    if not upload_id or s3_key.split('/')[0] not in MEDIA_FOLDERS or s3_key.count('/') != 1:
+        return None, None
+    return s3_key, upload_id
+
+def create_multipart(data, user_id):
+    file_name = data.get('file_name', 'file.unknown')
+    file_size = int(data.get('file_size', 0))
+    _, file_extension = os.path.splitext(file_name)
+    folder, _ = media_folder(file_extension)
+    if not folder:
+        return response(400, 'Unsupported file type')
+    if file_size <= 0:
+        return response(400, 'file_size is required for a multipart upload')
+
+    part_size = max(PART_SIZE, MIN_PART_SIZE, math.ceil(file_size / MAX_PARTS))
+    part_count = math.ceil(file_size / part_size)
+
+    unique_filename = f"{uuid.uuid4()}{file_extension}"
+    s3_key = f"{folder}/{unique_filename}"
+    upload = s3.create_multipart_upload(
+        Bucket=BUCKET_NAME,
+        Key=s3_key,
+        ContentType=data.get('content_type', 'application/octet-stream')
+    )
+    s3.put_object(
+        Bucket=BUCKET_NAME,
+        Key=pending_key(s3_key),
+        Body=json.dumps({'upload_id': upload['UploadId'], 'uploader': user_id}),
+        ContentType='application/json'
+    )
+
+    return response(200, {
+        'upload_id': upload['UploadId'],
+        's3_key': s3_key,
+        'file_name': unique_filename,
+        'part_size': part_size,
+        'part_count': part_count,
+        'parts': part_urls(s3_key, upload['UploadId'], range(1, min(part_count, PART_URL_BATCH) + 1))
+    })
+
+def presign_parts(data, user_id):
+    # Fresh URLs for parts still to upload, e.g. when resuming after the first ones expired
+    s3_key, upload_id = multipart_target(data)
+    if not s3_key:
+        return response(400, 's3_key and upload_id of a media upload are required')
+    part_numbers = [int(n) for n in data.get('part_numbers', [])]
+    if not part_numbers or not all(1 <= n <= MAX_PARTS for n in part_numbers):
+        return response(400, f"part_numbers must be between 1 and {MAX_PARTS}")
+    if len(part_numbers) > PART_URL_BATCH:
+        return response(400, f"At most {PART_URL_BATCH} part_numbers per request")
+    error = check_uploader(s3_key, upload_id, user_id)
+    if error:
+        return error
+    return response(200, {'parts': part_urls(s3_key, upload_id, part_numbers)})
+
+def list_parts(data, user_id):
+    # What S3 already has, so a resumed upload only sends the missing parts
+    s3_key, upload_id = multipart_target(data)
+    if not s3_key:
+        return response(400, 's3_key and upload_id of a media upload are required')
+    error = check_uploader(s3_key, upload_id, user_id)
+    if error:
+        return error
+    try:
+        parts = uploaded_parts(s3_key, upload_id)
+    except ClientError as e:
+        return response(404, f"Upload not found: {e}")
+    return response(200, {
+        'parts': [
+            {'part_number': part['PartNumber'], 'etag': part['ETag'], 'size': part['Size']}
+            for part in parts
+        ]
+    })
+
+def complete_multipart(data, user_id):
+    s3_key, upload_id = multipart_target(data)
+    if not s3_key:
+        return response(400, 's3_key and upload_id of a media upload are required')
+
+    file_name = os.path.basename(s3_key)
+    media_id = os.path.splitext(file_name)[0]
+    media_url = f"https://{BUCKET_NAME}.s3.us-east-1.amazonaws.com/{s3_key}"
+    completed = response(200, {
+        's3_key': s3_key,
+        'file_name': file_name,
+        'media_url': media_url
+    })
+
+    # Only the user who started the upload can register it under their ID
+    error = check_uploader(s3_key, upload_id, user_id)
+    if error:
+        # a retry after a successful completion finds the pending entry removed
+        if error['statusCode'] == 404 and registered_by(media_id, user_id) and object_exists(s3_key):
+            return completed
+        return error
+
+    # A retried completion finds the upload gone but the object in place
+    already_completed = False
+    # Without an explicit list, every part S3 has received makes up the file
+    if data.get('parts'):
+        parts = [{'PartNumber': int(part['part_number']), 'ETag': part['etag']} for part in data['parts']]
+    else:
+        try:
+            parts = [{'PartNumber': part['PartNumber'], 'ETag': part['ETag']}
+                     for part in uploaded_parts(s3_key, upload_id)]
+        except ClientError as e:
+            if not object_exists(s3_key):
+                return response(404, f"Upload not found: {e}")
+            already_completed = True
+    if not already_completed:
+        parts.sort(key=lambda part: part['PartNumber'])
+
+    # The record goes in just before completing, so the Object Created event for the
+    # finished file never reaches the thumbnail and tagging Lambdas ahead of it.
+    # A retry must not reset a record that thumbnails or tags were already added to.
+    table = dynamodb.Table(TABLE_NAME)
+    created = True
+    try:
+        table.put_item(
+            Item={
+                'MediaID': media_id,
+                'FileType': MEDIA_FOLDERS[s3_key.split('/')[0]],
+                'MediaURL': media_url,
+                'ThumbnailURL': "",
+                'Uploader': user_id
+            },
+            ConditionExpression='attribute_not_exists(MediaID)'
+        )
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        created = False
+
+    if not already_completed:
+        try:
+            s3.complete_multipart_upload(
+                Bucket=BUCKET_NAME,
+                Key=s3_key,
+                UploadId=upload_id,
+                MultipartUpload={'Parts': parts}
+            )
+        except ClientError as e:
+            exists = object_exists(s3_key)
+            # an earlier call completed it; the file and its record are both there
+            if not (e.response['Error']['Code'] == 'NoSuchUpload' and exists):
+                # only undo a record this call wrote for a file that never got stored
+                if created and not exists:
+                    table.delete_item(Key={'MediaID': media_id})
+                return response(400, f"Could not complete upload: {e}")
+
+    s3.delete_object(Bucket=BUCKET_NAME, Key=pending_key(s3_key))
+    return completed
+
+def abort_multipart(data, user_id):
+    s3_key, upload_id = multipart_target(data)
+    if not s3_key:
+        return response(400, 's3_key and upload_id of a media upload are required')
+    error = check_uploader(s3_key, upload_id, user_id)
+    if error:
+        return error
+    s3.abort_multipart_upload(Bucket=BUCKET_NAME, Key=s3_key, UploadId=upload_id)
+    s3.delete_object(Bucket=BUCKET_NAME, Key=pending_key(s3_key))
+    return response(200, {'s3_key': s3_key, 'aborted': True})
+
+MULTIPART_ACTIONS = {
+    'create_multipart': create_multipart,
+    'presign_parts': presign_parts,
+    'list_parts': list_parts,
+    'complete_multipart': complete_multipart,
+    'abort_multipart': abort_multipart,
+}
+
+# Bulk upload sessions: one call presigns every file and registers them all in BirdBase
+MAX_BULK_FILES = int(os.environ.get('MAX_BULK_FILES', '500'))
+BULK_URL_EXPIRATION = int(os.environ.get('BULK_URL_EXPIRATION', '3600'))
+
+def bulk_presign(data, user_id):
+    files = data.get('files')
+    if not isinstance(files, list) or not files:
+        return response(400, 'files must be a non-empty list')
+    if len(files) > MAX_BULK_FILES:
+        return response(400, f"At most {MAX_BULK_FILES} files per request")
+
+    uploads, rejected, items = [], [], []
+    for index, entry in enumerate(files):
+        file_name = entry.get('file_name', 'file.unknown')
+        _, file_extension = os.path.splitext(file_name)
+        folder, file_type = media_folder(file_extension)
+        if not folder:
+            rejected.append({'index': index, 'file_name': file_name, 'error': 'Unsupported file type'})
+            continue
+
+        unique_id = str(uuid.uuid4())
+        unique_filename = f"{unique_id}{file_extension}"
+        s3_key = f"{folder}/{unique_filename}"
+        # Presigning is local signing only, so hundreds of URLs take milliseconds
+        upload_url = s3.generate_presigned_url(
+            ClientMethod='put_object',
+            Params={
+                'Bucket': BUCKET_NAME,
+                'Key': s3_key,
+                'ContentType': entry.get('content_type', 'application/octet-stream')
+            },
+            ExpiresIn=BULK_URL_EXPIRATION
+        )
+        items.append({
+            'MediaID': unique_id,
+            'FileType': file_type,
+            'MediaURL': f"https://{BUCKET_NAME}.s3.us-east-1.amazonaws.com/{s3_key}",
+            'ThumbnailURL': "",
+            'Uploader': user_id
+        })
+        uploads.append({
+            'index': index,
+            'original_file_name': file_name,
+            'upload_url': upload_url,
+            's3_key': s3_key,
+            'file_name': unique_filename
+        })
+
+    # batch_writer sends BatchWriteItem requests of 25 items and resends unprocessed ones
+    with dynamodb.Table(TABLE_NAME).batch_writer() as batch:
+        for item in items:
+            batch.put_item(Item=item)
+
+    return response(200, {'files': uploads, 'rejected': rejected})
+
 def lambda_handler(event, context):
     if event['httpMethod'] == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Allow-Methods': 'OPTIONS,POST',
-            },
-            'body': ''
-        }
+        return response(200)
 
     try:
         data = json.loads(event['body'])
@@ -27,44 +355,25 @@ def lambda_handler(event, context):
 
         # Reject if no user ID token provided
         if not user_id:
-            return {
-                'statusCode': 401,
-                'headers': {
-                    'Access-Control-Allow-Origin': '*',
-                    'Access-Control-Allow-Headers': 'Content-Type',
-                    'Access-Control-Allow-Methods': 'OPTIONS,POST',
-                },
-                'body': json.dumps('Unauthorized: Missing user ID token')
-            }
+            return response(401, 'Unauthorized: Missing user ID token')
+
+        # Large files can be uploaded in parts, see MULTIPART_ACTIONS
+        action = data.get('action')
+        if action in MULTIPART_ACTIONS:
+            return MULTIPART_ACTIONS[action](data, user_id)
+
+        # Many files at once: {"files": [{"file_name": ..., "content_type": ...}, ...]}
+        if 'files' in data:
+            return bulk_presign(data, user_id)
 
         _, file_extension = os.path.splitext(file_name)
         unique_id = str(uuid.uuid4())
         unique_filename = f"{unique_id}{file_extension}"
 
-        audio_extensions = ['.wav', '.mp3', '.m4a']
-        video_extensions = ['.mp4', '.mov', '.avi']
-        image_extensions = ['.jpg', '.png']
-
         # Determine folder and file type
-        if file_extension.lower() in audio_extensions:
-            folder = 'audio'
-            file_type = 'audio'
-        elif file_extension.lower() in video_extensions:
-            folder = 'videos'
-            file_type = 'video'
-        elif file_extension.lower() in image_extensions:
-            folder = 'images'
-            file_type = 'image'
-        else: 
-            return {
-                'statusCode': 400,
-                'headers': {
-                    'Access-Control-Allow-Origin': '*',
-                    'Access-Control-Allow-Headers': 'Content-Type',
-                    'Access-Control-Allow-Methods': 'OPTIONS,POST',
-                },
-                'body': json.dumps('Unsupported file type')
-            }
+        folder, file_type = media_folder(file_extension)
+        if not folder:
+            return response(400, 'Unsupported file type')
 
         s3_key = f"{folder}/{unique_filename}"
 
@@ -92,27 +401,11 @@ def lambda_handler(event, context):
             'Uploader': user_id
         })
 
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Allow-Methods': 'OPTIONS,POST',
-            },
-            'body': json.dumps({
-                'upload_url': upload_url,
-                's3_key': s3_key,
-                'file_name': unique_filename
-            })
-        }
+        return response(200, {
+            'upload_url': upload_url,
+            's3_key': s3_key,
+            'file_name': unique_filename
+        })
 
     except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Allow-Methods': 'OPTIONS,POST',
-            },
-            'body': json.dumps(f"Error generating URL: {str(e)}")
-        }
+        return response(500, f"Error generating URL: {str(e)}")
@@ -1,8 +1,11 @@
 import boto3
 import cv2 as cv
+import io
 import os
 import json
+import numpy as np
 import supervision as sv
+from torch.nn.functional import adaptive_avg_pool2d
 from ultralytics import YOLO
 
 
@@ -83,7 +86,32 @@ def publish_sns_notification(sns_client, tag_name: str, message_data: dict):
         return None
 
 
-def update_dynamodb_tags(table, media_id: str, tag_counts: dict):
+def get_media_attributes(base_table, media_id: str):
+    """
+    Reads the BirdBase attributes that get copied onto every BirdBaseIndex row,
+    so searches can answer from the index without a second read per result.
+
+    Parameters:
+        base_table: DynamoDB BirdBase table resource
+        media_id (str): The media ID to look up
+
+    Returns:
+        dict: FileType, MediaURL, ThumbnailURL and Uploader (empty if not found)
+    """
+    try:
+        response = base_table.get_item(
+            Key={"MediaID": media_id},
+            ProjectionExpression="FileType, MediaURL, ThumbnailURL, Uploader",
+        )
+        return response.get("Item", {})
+    except Exception as e:
+        print(f"Error reading media attributes for '{media_id}': {e}")
+        return {}
+
+
+def update_dynamodb_tags(
+    table, media_id: str, tag_counts: dict, media_attributes: dict = None
+):
     """
     Creates separate items for each tag with TagName as hash key and MediaID as range key.
     Overwrites existing items without checking.
@@ -92,6 +120,7 @@ def update_dynamodb_tags(table, media_id: str, tag_counts: dict):
         table: DynamoDB table resource
         media_id (str): The media ID to associate with tags
         tag_counts (dict): Dictionary of tag names and their counts
+        media_attributes (dict): BirdBase attributes to store on each tag item
     """
     try:
         # Use batch writing for better performance
@@ -99,6 +128,7 @@ def update_dynamodb_tags(table, media_id: str, tag_counts: dict):
             for tag_name, tag_value in tag_counts.items():
                 batch.put_item(
                     Item={
+                        **(media_attributes or {}),
                         "TagName": tag_name,
                         "TagValue": tag_value,
                         "MediaID": media_id,
@@ -113,6 +143,26 @@ def update_dynamodb_tags(table, media_id: str, tag_counts: dict):
         raise
 
 
+def save_embedding(s3_client, bucket: str, key: str, embedding: np.ndarray):
+    """
+    Stores an image embedding as a float16 .npy file for the similarity index.
+
+    Parameters:
+        s3_client: Boto3 S3 client
+        bucket (str): S3 bucket name
+        key (str): S3 object key, e.g. embeddings/images/<MediaID>.npy
+        embedding (np.ndarray): 1-D embedding vector
+    """
+    try:
+        buffer = io.BytesIO()
+        np.save(buffer, embedding.astype(np.float16))
+        s3_client.put_object(Bucket=bucket, Key=key, Body=buffer.getvalue())
+        print(f"Saved {embedding.shape[0]}-d embedding to {bucket}/{key}")
+    except Exception as e:
+        # similarity search just won't find this image; tagging still succeeds
+        print(f"Error saving embedding to {bucket}/{key}: {e}")
+
+
 def image_prediction(image_path: str, model_path: str, confidence: float = 0.5):
     """
     Function to make predictions of a pre-trained YOLO model on a given image.
@@ -121,6 +171,9 @@ def image_prediction(image_path: str, model_path: str, confidence: float = 0.5):
         image_path (str): Path to the image file. Can be a local path or a URL.
         model_path (str): path to the model.
         confidence (float): 0-1, only results over this value are saved.
+
+    Returns:
+        tuple: (list of tags, pooled backbone embedding or None)
     """
     # Load YOLO model
     model = YOLO(model_path)
@@ -132,10 +185,20 @@ def image_prediction(image_path: str, model_path: str, confidence: float = 0.5):
     # Check if image was loaded successfully
     if img is None:
         print("Couldn't load the image! Please check the image path.")
-        return []
+        return [], None
+
+    # Pool the layer model.embed() reads (the one before the Detect head) during the
+    # detection pass, instead of running the image through the model a second time
+    pooled = []
+    hook = model.model.model[-2].register_forward_hook(
+        lambda module, inputs, output: pooled.append(adaptive_avg_pool2d(output, 1).flatten(1))
+    )
 
     # Run the model on the image
-    result = model(img)[0]
+    try:
+        result = model(img)[0]
+    finally:
+        hook.remove()
 
     # Convert YOLO result to Detections format
     detections = sv.Detections.from_ultralytics(result)
@@ -151,7 +214,10 @@ def image_prediction(image_path: str, model_path: str, confidence: float = 0.5):
             for cls_id, _ in zip(detections.class_id, detections.confidence)
         ]
 
-    return tags
+    # Pooled features from the detector backbone, used for "looks like this" search
+    embedding = pooled[-1][0].cpu().numpy().ravel() if pooled else None
+
+    return tags, embedding
 
 
 def lambda_handler(event, context):
@@ -161,25 +227,31 @@ def lambda_handler(event, context):
     try:
         # Get environment variables
         table_name = os.environ.get("DYNAMODB_TABLE_NAME", "BirdBaseIndex")
+        base_table_name = os.environ.get("BASE_TABLE_NAME", "BirdBase")
         model_bucket = os.environ.get("MODEL_BUCKET_NAME", "birdstore")
         model_key = os.environ.get("MODEL_KEY", "models/model.pt")
         confidence_threshold = float(os.environ.get("CONFIDENCE_THRESHOLD", "0.5"))
         presigned_url_expiration = int(
             os.environ.get("PRESIGNED_URL_EXPIRATION", "86400") # 24 hours default
         ) 
+        embedding_bucket = os.environ.get("EMBEDDING_BUCKET", "birdstore")
+        embedding_prefix = os.environ.get("EMBEDDING_PREFIX", "embeddings/images/")
 
         print(f"Using DynamoDB table: {table_name}")
+        print(f"Using base table: {base_table_name}")
         print(f"Using model bucket: {model_bucket}")
         print(f"Using model key: {model_key}")
         print(f"Using confidence threshold: {confidence_threshold}")
         print(f"Using presigned url expiration: {presigned_url_expiration}")
+        print(f"Using embedding location: {embedding_bucket}/{embedding_prefix}")
 
         s3 = boto3.client("s3")
         dynamodb = boto3.resource("dynamodb")
         sns = boto3.client("sns")
 
-        # Get DynamoDB table
+        # Get DynamoDB tables
         table = dynamodb.Table(table_name)
+        base_table = dynamodb.Table(base_table_name)
 
         # Download model
         print("Downloading model from S3...")
@@ -201,14 +273,19 @@ def lambda_handler(event, context):
         s3.download_file(img_bucket, img_key, img_temp_path)
 
         print("Making predictions...")
-        tags = image_prediction(img_temp_path, model_temp_path, confidence_threshold)
+        tags, embedding = image_prediction(img_temp_path, model_temp_path, confidence_threshold)
+
+        # Saved even without tags, similarity search doesn't need a detection
+        if embedding is not None:
+            save_embedding(s3, embedding_bucket, f"{embedding_prefix}{file_uuid}.npy", embedding)
 
         print(f"Updating DynamoDB for UUID: {file_uuid}")
         # Convert tags and update DynamoDB
         tag_counts = count_items(tags) if tags else {}
 
         if tag_counts:
-            update_dynamodb_tags(table, file_uuid, tag_counts)
+            media_attributes = get_media_attributes(base_table, file_uuid)
+            update_dynamodb_tags(table, file_uuid, tag_counts, media_attributes)
             print("DynamoDB updated successfully")
 
             # Generate presigned URL for the image
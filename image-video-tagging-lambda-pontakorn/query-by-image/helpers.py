@@ -1,7 +1,21 @@
+import base64
 import boto3
+import gzip
 import json
+import os
+import uuid
 from urllib.parse import urlparse
 
+# Optional faster codecs; the stdlib json/gzip paths are used when they aren't installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 s3_client = boto3.client('s3')
 
 def clean_url(url):
@@ -44,16 +58,169 @@ def generate_presigned_url(s3_url, s3_client = boto3.client('s3'), expiration=36
     except Exception as e:
         return ""
 
-def build_response(status_code, body):
+# Response fields a client can ask for with ?fields=..., plus shorthands
+MEDIA_FIELDS = ("MediaID", "FileType", "MediaURL", "ThumbnailURL", "Uploader")
+FIELD_PRESETS = {
+    "ids": ("MediaID",),
+    "thumbnails": ("MediaID", "ThumbnailURL")
+}
+PRESIGNED_FIELDS = ("MediaURL", "ThumbnailURL")
+
+# Bodies smaller than this aren't worth compressing
+MIN_COMPRESS_BYTES = 1024
+COMPRESS_RESPONSES = os.environ.get("COMPRESS_RESPONSES", "1") == "1"
+# An HTTP API (payload format 2.0) always decodes a base64 body before sending it. A REST
+# API only does when the request's Accept header matches its binaryMediaTypes, otherwise
+# the client receives the base64 text. Set REST_BINARY_MEDIA_TYPES=1 once the REST API
+# lists "*/*" under Settings > Binary media types ("application/json" only matches
+# clients that send Accept: application/json).
+REST_BINARY_MEDIA_TYPES = os.environ.get("REST_BINARY_MEDIA_TYPES", "0") == "1"
+
+def parse_fields(value):
+    """
+    Turns "ids", "thumbnails" or a comma separated list of MEDIA_FIELDS into a tuple,
+    or None for the full record.
+    """
+    if not value:
+        return None
+    if value.strip().lower() in FIELD_PRESETS:
+        return FIELD_PRESETS[value.strip().lower()]
+    known = {field.lower(): field for field in MEDIA_FIELDS}
+    fields = tuple(known[name.strip().lower()] for name in value.split(",") if name.strip().lower() in known)
+    return fields or None
+
+def media_result(item, s3_client, fields=None):
+    # Only the requested URLs get signed, so projections also save signing time
+    result = {}
+    for field in fields or MEDIA_FIELDS:
+        value = getattr(item, field)
+        result[field] = generate_presigned_url(value, s3_client) if field in PRESIGNED_FIELDS else value
+    return result
+
+# Query media can be uploaded first and referenced by key instead of sent as base64.
+# Only keys under QUERY_PREFIX are read, so a request can't fetch arbitrary objects.
+QUERY_BUCKET = os.environ.get("QUERY_BUCKET", "birdstore")
+QUERY_PREFIX = os.environ.get("QUERY_PREFIX", "queries/")
+
+def header(event, name):
+    headers = (event or {}).get("headers") or {}
+    return next((v for k, v in headers.items() if k.lower() == name.lower()), "") or ""
+
+def is_json_request(event):
+    content_type = header(event, "content-type").split(";")[0].strip().lower()
+    return content_type in ("", "application/json") or content_type.endswith("+json")
+
+def raw_body(event):
+    # API Gateway delivers binary media types base64 encoded
+    body = event.get("body") or ""
+    if event.get("isBase64Encoded"):
+        return base64.b64decode(body)
+    return body.encode("utf-8") if isinstance(body, str) else body
+
+def query_upload(s3_client, content_type="application/octet-stream", expiration=300):
+    """
+    A presigned PUT for a query file; the query request then sends {"s3_key": ...}.
+    """
+    key = f"{QUERY_PREFIX}{uuid.uuid4()}"
+    upload_url = s3_client.generate_presigned_url(
+        "put_object",
+        Params={"Bucket": QUERY_BUCKET, "Key": key, "ContentType": content_type},
+        ExpiresIn=expiration
+    )
+    return {"s3_key": key, "upload_url": upload_url, "content_type": content_type, "expires_in": expiration}
+
+def query_object_key(body):
+    """
+    The uploaded query's key from the body, or None when the media is inline.
+    """
+    key = body.get("s3_key")
+    if not key:
+        return None
+    key = str(key).lstrip("/")
+    if not key.startswith(QUERY_PREFIX) or ".." in key:
+        raise ValueError(f"'s3_key' must be an upload under {QUERY_PREFIX}")
+    return key
+
+def query_media_bytes(event, body, field, s3_client):
+    """
+    The query media from a raw binary body, an uploaded s3_key or the base64 field,
+    in that order. Raises ValueError when none of them is usable.
+    """
+    if not is_json_request(event):
+        return raw_body(event)
+
+    key = query_object_key(body)
+    if key:
+        try:
+            return s3_client.get_object(Bucket=QUERY_BUCKET, Key=key)["Body"].read()
+        except s3_client.exceptions.NoSuchKey:
+            raise ValueError(f"Nothing has been uploaded to '{key}'")
+
+    if field not in body:
+        raise ValueError(f"No '{field}' or 's3_key' field found in request body")
+    try:
+        return base64.b64decode(body[field])
+    except Exception as e:
+        raise ValueError(f"Invalid base64 {field} data: {str(e)}")
+
+def dumps(body):
+    if orjson is not None:
+        return orjson.dumps(body)
+    return json.dumps(body, separators=(",", ":")).encode("utf-8")
+
+def accepted_encodings(event):
+    value = header(event, "accept-encoding")
+    encodings = set()
+    for part in value.split(","):
+        name, _, params = part.partition(";")
+        # "gzip;q=0" means the client refuses it
+        if params.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        encodings.add(name.strip().lower())
+    return encodings
+
+def can_compress(event):
+    if not COMPRESS_RESPONSES or not event:
+        return False
+    return event.get("version") == "2.0" or REST_BINARY_MEDIA_TYPES
+
+def build_response(status_code, body, headers=None, event=None):
+    response_headers = {
+        "Access-Control-Allow-Origin": "http://localhost:3000",
+        "Access-Control-Allow-Headers": "Content-Type, Authorization",
+        "Access-Control-Allow-Methods": "GET, POST, OPTIONS, DELETE",
+        "Access-Control-Allow-Credentials": "true"
+    }
+    if headers:
+        response_headers.update(headers)
+        # let the browser read the extra headers
+        response_headers["Access-Control-Expose-Headers"] = ", ".join(headers)
+
+    payload = dumps(body)
+    encodings = accepted_encodings(event) if can_compress(event) else set()
+    encoding = None
+    if len(payload) >= MIN_COMPRESS_BYTES:
+        if brotli is not None and "br" in encodings:
+            encoding, payload = "br", brotli.compress(payload, quality=4)
+        elif "gzip" in encodings:
+            encoding, payload = "gzip", gzip.compress(payload, compresslevel=5)
+
+    if encoding is None:
+        return {
+            "statusCode": status_code,
+            "headers": response_headers,
+            "body": payload.decode("utf-8")
+        }
+
+    # API Gateway decodes base64 bodies back to the compressed bytes
+    response_headers["Content-Type"] = "application/json"
+    response_headers["Content-Encoding"] = encoding
+    response_headers["Vary"] = "Accept-Encoding"
     return {
         "statusCode": status_code,
-        "headers": {
-            "Access-Control-Allow-Origin": "http://localhost:3000",
-            "Access-Control-Allow-Headers": "Content-Type, Authorization",
-            "Access-Control-Allow-Methods": "GET, POST, OPTIONS, DELETE",
-            "Access-Control-Allow-Credentials": "true"
-        },
-        "body": json.dumps(body)
+        "headers": response_headers,
+        "body": base64.b64encode(payload).decode("ascii"),
+        "isBase64Encoded": True
     }
 
 if __name__ == "__main__":
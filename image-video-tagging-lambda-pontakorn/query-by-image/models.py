@@ -40,4 +40,20 @@ class BirdBaseIndexModel(Model):
     TagValue = NumberAttribute()
 
     # UUID of the media file
-    MediaID = UnicodeAttribute(range_key=True)
\ No newline at end of file
+    MediaID = UnicodeAttribute(range_key=True)
+
+    # Copies of the BirdBase attributes so a search can answer from the index alone.
+    # Rows written before these existed leave them empty and get hydrated from BirdBase.
+    FileType = UnicodeAttribute(null=True)
+    MediaURL = UnicodeAttribute(null=True)
+    ThumbnailURL = UnicodeAttribute(null=True)
+    Uploader = UnicodeAttribute(null=True)
+
+def media_record(index_item):
+    """
+    Returns something with the BirdBase attributes for an index row: the row itself when
+    the media attributes were copied onto it, otherwise the BirdBase record.
+    """
+    if index_item.FileType is not None and index_item.MediaURL is not None:
+        return index_item
+    return BirdBaseModel.get(index_item.MediaID)
@@ -1,12 +1,19 @@
-import base64
 import boto3
 import cv2 as cv
 import json
+import numpy as np
 import os
 import supervision as sv
 from ultralytics import YOLO
 import helpers as _
-from models import BirdBaseModel, BirdBaseIndexModel
+import vectors
+from models import BirdBaseModel, BirdBaseIndexModel, media_record
+
+# Most query images accepted in one batch request
+MAX_BATCH_IMAGES = int(os.environ.get("MAX_BATCH_IMAGES", "16"))
+
+# Warm containers keep the downloaded and loaded model between requests
+_models = {}
 
 
 def count_items(input_list: list):
@@ -21,110 +28,298 @@ def count_items(input_list: list):
     return counts
 
 
-def image_prediction(image_path: str, model_path: str, confidence: float = 0.5):
+def decode_image(image_data: bytes):
     """
-    Function to make predictions of a pre-trained YOLO model on a given image.
+    Decodes encoded image bytes (JPEG, PNG, ...) in memory, or None if unreadable.
+    """
+    return cv.imdecode(np.frombuffer(image_data, dtype=np.uint8), cv.IMREAD_COLOR)
+
+
+def load_model(s3, model_bucket: str, model_key: str):
+    """
+    Returns the YOLO model, downloading and loading it only on a cold start.
+
+    Parameters:
+        s3: Boto3 S3 client
+        model_bucket (str): S3 bucket containing the model
+        model_key (str): S3 key of the model file
+    """
+    cache_key = (model_bucket, model_key)
+    if cache_key not in _models:
+        print("Downloading model from S3...")
+        model_path = f"/tmp/model_{os.path.basename(model_key)}"
+        s3.download_file(model_bucket, model_key, model_path)
+        _models[cache_key] = YOLO(model_path)
+    return _models[cache_key]
+
+
+def batch_image_prediction(imgs: list, model, confidence: float = 0.5):
+    """
+    Runs the model once over a batch of images.
 
     Parameters:
-        image_path (str): Path to the image file. Can be a local path or a URL.
-        model_path (str): path to the model.
+        imgs (list): Decoded BGR images.
+        model: Loaded YOLO model.
         confidence (float): 0-1, only results over this value are saved.
+
+    Returns:
+        list: The detected tags of each image, in input order
     """
-    # Load YOLO model
-    model = YOLO(model_path)
     class_dict = model.names
 
-    # Load image from local path
-    img = cv.imread(image_path)
+    # One forward pass for the whole batch
+    batch_tags = []
+    for result in model(imgs, verbose=False):
+        # Convert YOLO result to Detections format
+        detections = sv.Detections.from_ultralytics(result)
+
+        tags = []
+        # Filter detections based on confidence threshold and check if any exist
+        if detections.class_id is not None:
+            detections = detections[(detections.confidence > confidence)]
 
-    # Check if image was loaded successfully
-    if img is None:
-        print("Couldn't load the image! Please check the image path.")
-        return []
+            # Create tags for the detected objects
+            tags = [f"{class_dict[cls_id]}" for cls_id in detections.class_id]
+        batch_tags.append(tags)
 
-    # Run the model on the image
-    result = model(img)[0]
+    return batch_tags
 
-    # Convert YOLO result to Detections format
-    detections = sv.Detections.from_ultralytics(result)
 
-    tags = []
-    # Filter detections based on confidence threshold and check if any exist
-    if detections.class_id is not None:
-        detections = detections[(detections.confidence > confidence)]
+def image_prediction(img, model, confidence: float = 0.5):
+    """
+    Function to make predictions of a pre-trained YOLO model on a given image.
 
-        # Create tags for the detected objects
-        tags = [
-            f"{class_dict[cls_id]}"
-            for cls_id, _ in zip(detections.class_id, detections.confidence)
-        ]
+    Parameters:
+        img (np.ndarray): Decoded BGR image.
+        model: Loaded YOLO model.
+        confidence (float): 0-1, only results over this value are saved.
+    """
+    return batch_image_prediction([img], model, confidence)[0]
 
-    return tags
 
+def image_embedding(img, model):
+    """
+    Pooled detector backbone features of an image, the same vector image-tagging
+    stores for every upload.
 
-def lambda_handler(event, context):
-    model_temp_path = None
-    img_temp_path = None
+    Parameters:
+        img (np.ndarray): Decoded BGR image.
+        model: Loaded YOLO model.
+    """
+    embeddings = model.embed(img, verbose=False)
+    return embeddings[0].cpu().numpy().ravel() if embeddings else None
+
+
+def query_species(filter_tags_list: list):
+    """
+    Reads each species partition once for all the images, at the lowest count any
+    image asks for.
+
+    Returns:
+        dict: {species: {MediaID: index row}}
+    """
+    lowest = {}
+    for filter_tags in filter_tags_list:
+        for species, min_count in filter_tags.items():
+            lowest[species] = min(min_count, lowest.get(species, min_count))
+
+    rows = {}
+    for species, min_count in lowest.items():
+        rows[species] = {
+            item.MediaID: item
+            for item in BirdBaseIndexModel.query(species)
+            if item.TagValue >= min_count
+        }
+    return rows
 
+
+def matching_media_ids(filter_tags: dict, species_rows: dict):
+    """
+    MediaIDs with at least the given count of every species (AND logic).
+    """
+    matching_ids = None
+    for species, min_count in filter_tags.items():
+        result_ids = {
+            media_id for media_id, item in species_rows[species].items() if item.TagValue >= min_count
+        }
+        # Intersect with previous results to satisfy all tag conditions
+        matching_ids = result_ids if matching_ids is None else matching_ids & result_ids
+    return matching_ids or set()
+
+
+def similar_media(index, embedding, k: int, n_probe: int, s3, fields=None):
+    """
+    Looks up the k nearest images in the vector index and returns their records,
+    best match first, each with its cosine similarity as "Score".
+    """
+    scores = dict(index.search(embedding, k, n_probe))
+    results = []
+    for item in BirdBaseModel.batch_get(list(scores)):
+        result = _.media_result(item, s3, fields)
+        result["Score"] = round(scores[item.MediaID], 4)
+        results.append(result)
+    results.sort(key=lambda result: result["Score"], reverse=True)
+    return results
+
+
+def batch_search(images: list, model, confidence: float, s3, fields=None, event=None):
+    """
+    Tag search for several query images: one batched forward pass, one read per
+    distinct species and one rendered result per distinct media file.
+    """
+    imgs = []
+    for position, image in enumerate(images):
+        # each entry is base64 data or {"s3_key": "queries/..."}
+        entry = image if isinstance(image, dict) else {"image": image}
+        try:
+            img = decode_image(_.query_media_bytes({}, entry, "image", s3))
+        except ValueError as e:
+            raise ValueError(f"images[{position}]: {str(e)}")
+        if img is None:
+            raise ValueError(f"images[{position}]: Could not decode the image")
+        imgs.append(img)
+
+    print(f"Making predictions for {len(imgs)} images...")
+    filter_tags_list = [count_items(tags) for tags in batch_image_prediction(imgs, model, confidence)]
+    print(f"Detected tags: {filter_tags_list}")
+
+    species_rows = query_species(filter_tags_list)
+
+    # Media matching several images is hydrated and presigned once
+    rendered = {}
+    groups = []
+    for position, filter_tags in enumerate(filter_tags_list):
+        results = []
+        for media_id in (matching_media_ids(filter_tags, species_rows) if filter_tags else set()):
+            if media_id not in rendered:
+                row = next(rows[media_id] for rows in species_rows.values() if media_id in rows)
+                rendered[media_id] = _.media_result(media_record(row), s3, fields)
+            results.append(rendered[media_id])
+        groups.append({
+            "index": position,
+            "detected_tags": filter_tags,
+            "results": results
+        })
+
+    return _.build_response(200, {
+        "message": f"Succeeded! Searched {len(groups)} images, {len(rendered)} distinct records",
+        "images": groups
+    }, event=event)
+
+
+def lambda_handler(event, context):
     try:
         # Get environment variables
         model_bucket = os.environ.get("MODEL_BUCKET_NAME", "birdstore")
         model_key = os.environ.get("MODEL_KEY", "models/model.pt")
         confidence_threshold = float(os.environ.get("CONFIDENCE_THRESHOLD", "0.5"))
+        index_bucket = os.environ.get("VECTOR_INDEX_BUCKET", "birdstore")
+        index_prefix = os.environ.get("VECTOR_INDEX_PREFIX", "indexes/image-vectors/")
+        index_ttl = int(os.environ.get("VECTOR_INDEX_TTL", "60"))
+        n_probe = int(os.environ.get("VECTOR_INDEX_PROBES", "8"))
 
         print(f"Using model bucket: {model_bucket}")
         print(f"Using model key: {model_key}")
         print(f"Using confidence threshold: {confidence_threshold}")
 
         s3 = boto3.client("s3")
+        params = event.get("queryStringParameters") or {}
 
-        # Download model
-        print("Downloading model from S3...")
-        model_temp_path = f"/tmp/model_{context.aws_request_id}_{os.path.basename(model_key)}"
-        s3.download_file(model_bucket, model_key, model_temp_path)
+        # ?upload=1 hands out a presigned PUT; the query then sends {"s3_key": ...}
+        if params.get("upload"):
+            return _.build_response(200, _.query_upload(s3, params.get("content_type") or "image/jpeg"))
+
+        model = load_model(s3, model_bucket, model_key)
 
-        # Process base64 encoded image from request
         if not event.get("body"):
             return _.build_response(400, {
                 "message": "An error occurred while processing your request",
                 "error": "No request body found"
             })
 
-        # Parse JSON body to get base64 image data
+        # A JSON body carries the image as base64 or an s3_key; any other
+        # Content-Type (e.g. image/jpeg) is the image itself
+        body = {}
+        if _.is_json_request(event):
+            try:
+                body = json.loads(event["body"])
+            except json.JSONDecodeError:
+                return _.build_response(400, {
+                    "message": "An error occurred while processing your request",
+                    "error": "Invalid JSON in request body"
+                })
+
+        # Optional projection, e.g. "ids", "thumbnails" or "MediaID,FileType"
+        fields = _.parse_fields(body.get("fields") or params.get("fields"))
+
+        # mode=similar returns the k most similar images instead of a tag match
+        mode = str(body.get("mode") or params.get("mode") or "tags").lower()
         try:
-            body = json.loads(event["body"])
-        except json.JSONDecodeError:
+            k = min(max(int(body.get("k") or params.get("k") or 10), 1), 100)
+        except ValueError:
             return _.build_response(400, {
                 "message": "An error occurred while processing your request",
-                "error": "Invalid JSON in request body"
+                "error": "'k' must be a number"
             })
 
-        # Extract base64 image data
-        if "image" not in body:
+        # "images": [...] searches for several query images in one batched call
+        if "images" in body:
+            images = body["images"]
+            if not isinstance(images, list) or not images or len(images) > MAX_BATCH_IMAGES:
+                return _.build_response(400, {
+                    "message": "An error occurred while processing your request",
+                    "error": f"'images' must be a list of 1 to {MAX_BATCH_IMAGES} images"
+                })
+            try:
+                return batch_search(images, model, confidence_threshold, s3, fields, event)
+            except ValueError as e:
+                return _.build_response(400, {
+                    "message": "An error occurred while processing your request",
+                    "error": str(e)
+                })
+
+        print("Reading query image...")
+        try:
+            image_data = _.query_media_bytes(event, body, "image", s3)
+        except ValueError as e:
             return _.build_response(400, {
                 "message": "An error occurred while processing your request",
-                "error": "No 'image' field found in request body"
+                "error": str(e)
             })
 
-        print("Processing base64 encoded image data...")
-        try:
-            image_data = base64.b64decode(body["image"])
-        except Exception as e:
+        # Decoded straight from memory, nothing is written to /tmp
+        img = decode_image(image_data)
+        del image_data
+        if img is None:
             return _.build_response(400, {
                 "message": "An error occurred while processing your request",
-                "error": f"Invalid base64 image data: {str(e)}"
+                "error": "Could not decode the image"
             })
 
-        # Save image data to temporary file
-        print("Saving image data to temporary file...")
-
-        img_temp_path = f"/tmp/img_{context.aws_request_id}"
-
-        with open(img_temp_path, "wb") as f:
-            f.write(image_data)
+        if mode == "similar":
+            index = vectors.get_index(s3, index_bucket, index_prefix, index_ttl)
+            if index is None:
+                return _.build_response(503, {
+                    "message": "An error occurred while processing your request",
+                    "error": "The similarity index has not been built yet"
+                })
+
+            embedding = image_embedding(img, model)
+            if embedding is None:
+                return _.build_response(400, {
+                    "message": "An error occurred while processing your request",
+                    "error": "Could not embed the image"
+                })
+
+            results = similar_media(index, embedding, k, n_probe, s3, fields)
+            print(f"Found {len(results)} similar images")
+            return _.build_response(200, {
+                "message": f"Succeeded! Got {len(results)} records",
+                "results": results
+            }, event=event)
 
         print("Making predictions...")
-        tags = image_prediction(img_temp_path, model_temp_path, confidence_threshold)
+        tags = image_prediction(img, model, confidence_threshold)
 
         # Convert tags
         filter_tags = count_items(tags) if tags else {}
@@ -132,21 +327,8 @@ def lambda_handler(event, context):
         print(f"Detected tags: {filter_tags}")
 
         # Query database for each detected species
-        matching_ids = None
-
-        for species, min_count in filter_tags.items():
-            # Query BirdBaseIndexModel for each tag
-            result_ids = set()
-            for item in BirdBaseIndexModel.query(species):
-                if item.TagValue >= min_count:
-                    result_ids.add(item.MediaID)
-                    result_ids.add(item.MediaID)
-            
-            # Intersect with previous results to satisfy all tag conditions
-            if matching_ids is None:
-                matching_ids = result_ids
-            else:
-                matching_ids &= result_ids
+        species_rows = query_species([filter_tags])
+        matching_ids = matching_media_ids(filter_tags, species_rows) if filter_tags else set()
 
         if not matching_ids:
             return _.build_response(200, {
@@ -157,24 +339,17 @@ def lambda_handler(event, context):
         # Retrieve media records from BirdBaseModel
         results = []
         for media_id in matching_ids:
-            item = BirdBaseModel.get(media_id)
-        for media_id in matching_ids:
-            item = BirdBaseModel.get(media_id)
-            results.append({
-                "MediaID": item.MediaID,
-                "FileType": item.FileType,
-                "MediaURL": _.generate_presigned_url(item.MediaURL, s3),
-                "ThumbnailURL": _.generate_presigned_url(item.ThumbnailURL, s3),
-            #    "UploadedDate": item.UploadedDate,
-                "Uploader": item.Uploader
-            })
+            # Index rows carry the media attributes, so BirdBase is only read for old rows
+            row = next(rows[media_id] for rows in species_rows.values() if media_id in rows)
+            item = media_record(row)
+            results.append(_.media_result(item, s3, fields))
 
         print(f"Retrived results: {results}")
 
         return _.build_response(200, {
             "message": f"Succeeded! Got {len(results)} records",
             "results": results
-        })
+        }, event=event)
 
     except Exception as e:
         return _.build_response(500, {
@@ -182,12 +357,3 @@ def lambda_handler(event, context):
             "error": str(e)
         })
 
-    finally:
-        # Clean up temporary files
-        for temp_path in [model_temp_path, img_temp_path]:
-            if temp_path and os.path.exists(temp_path):
-                try:
-                    os.remove(temp_path)
-                    print(f"Cleaned up temporary file: {temp_path}")
-                except Exception as e:
-                    print(f"Warning: Could not clean up {temp_path}: {e}")
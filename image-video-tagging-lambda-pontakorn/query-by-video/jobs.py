@@ -0,0 +1,164 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import boto3
+from models import QueryJobModel
+from pynamodb.exceptions import UpdateError
+
+# Long videos are queried as background jobs: submitting returns a job ID right away,
+# a worker runs the inference from a queue and the client polls for the result.
+# Without QUERY_JOB_QUEUE_URL the queue is a thread in this process, for local runs only:
+# a Lambda sandbox is frozen once the response is returned, so there is no queue there.
+QUEUE_URL = os.environ.get("QUERY_JOB_QUEUE_URL", "")
+IN_LAMBDA = bool(os.environ.get("AWS_LAMBDA_FUNCTION_NAME"))
+RESULT_TTL = int(os.environ.get("QUERY_JOB_RESULT_TTL", str(7 * 24 * 3600)))
+# A QUEUED or RUNNING job not updated for this long (the Lambda timeout) has been lost
+STALE_AFTER = int(os.environ.get("QUERY_JOB_STALE_AFTER", "900"))
+# The result is one DynamoDB item (400 KB at most), so only this many MediaIDs are kept
+MAX_RESULT_IDS = int(os.environ.get("QUERY_JOB_MAX_RESULTS", "1000"))
+
+QUEUED = "QUEUED"
+RUNNING = "RUNNING"
+DONE = "DONE"
+FAILED = "FAILED"
+
+
+class SQSQueue:
+    def __init__(self, queue_url: str):
+        self.queue_url = queue_url
+        self.sqs = boto3.client("sqs")
+
+    def send(self, message: dict):
+        self.sqs.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(message))
+
+
+class LocalQueue:
+    """
+    Runs each job on a background thread of this process instead of going through SQS.
+    """
+
+    def __init__(self, worker):
+        self.worker = worker
+
+    def send(self, message: dict):
+        threading.Thread(target=self.worker, args=(message,), daemon=True).start()
+
+
+def get_queue(worker):
+    """
+    The job queue: SQS when QUERY_JOB_QUEUE_URL is set, otherwise a LocalQueue
+    calling worker(message) directly when running locally, and None inside Lambda.
+    """
+    if QUEUE_URL:
+        return SQSQueue(QUEUE_URL)
+    if IN_LAMBDA:
+        return None
+    return LocalQueue(worker)
+
+
+def content_hash(data: bytes):
+    # MD5 is what S3 reports as the ETag of a single-part upload, so inline
+    # and uploaded copies of the same clip share a cache entry
+    return hashlib.md5(data).hexdigest()
+
+
+def job_id_for(video_hash: str, settings: dict):
+    """
+    Job IDs are derived from the content and detection settings, so an identical
+    submission finds the earlier job and its cached result.
+    """
+    key = json.dumps({"video": video_hash, **settings}, sort_keys=True)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+
+
+def is_stale(job):
+    return job.Status in (QUEUED, RUNNING) and job.UpdatedAt < time.time() - STALE_AFTER
+
+
+def get_job(job_id: str):
+    """
+    Reads a job; one left QUEUED or RUNNING for longer than STALE_AFTER is marked
+    FAILED, so it is reported as such and the same video can be submitted again.
+    """
+    try:
+        job = QueryJobModel.get(job_id)
+    except QueryJobModel.DoesNotExist:
+        return None
+    if is_stale(job):
+        print(f"Job {job_id} was {job.Status} for over {STALE_AFTER} s, marking it failed")
+        set_status(job, FAILED, error=f"Job did not finish within {STALE_AFTER} s")
+    return job
+
+
+def submit(queue, video_hash: str, source_key: str, settings: dict):
+    """
+    Creates and enqueues a job, unless the same video is already queued, running or done.
+
+    Returns:
+        tuple: (job, whether an existing job was reused)
+    """
+    job_id = job_id_for(video_hash, settings)
+    job = get_job(job_id)
+    if job is not None and job.Status != FAILED and job.ExpiresAt > time.time():
+        return job, True
+
+    now = int(time.time())
+    job = QueryJobModel(
+        job_id,
+        Status=QUEUED,
+        SourceKey=source_key,
+        CreatedAt=now,
+        UpdatedAt=now,
+        ExpiresAt=now + RESULT_TTL,
+    )
+    job.save()
+    queue.send({"job_id": job_id})
+    print(f"Queued job {job_id} for {source_key}")
+    return job, False
+
+
+def job_result(tags: dict, media_ids):
+    """
+    The stored result: the detected tags, the first MAX_RESULT_IDS matching MediaIDs
+    in sorted order and how many matched in total.
+    """
+    media_ids = sorted(media_ids)
+    return {"tags": tags, "media_ids": media_ids[:MAX_RESULT_IDS], "total": len(media_ids)}
+
+
+def claim(job):
+    """
+    Moves a QUEUED job to RUNNING. SQS can deliver a message more than once, so only
+    the worker whose update still finds the job QUEUED runs it.
+
+    Returns:
+        bool: Whether this worker should run the job
+    """
+    try:
+        job.update(
+            actions=[
+                QueryJobModel.Status.set(RUNNING),
+                QueryJobModel.UpdatedAt.set(int(time.time())),
+            ],
+            condition=QueryJobModel.Status == QUEUED,
+        )
+    except UpdateError as e:
+        if e.cause_response_code == "ConditionalCheckFailedException":
+            return False
+        raise
+    return True
+
+
+def set_status(job, status: str, result: dict = None, error: str = None):
+    actions = [
+        QueryJobModel.Status.set(status),
+        QueryJobModel.UpdatedAt.set(int(time.time())),
+    ]
+    if result is not None:
+        actions.append(QueryJobModel.Result.set(result))
+    if error is not None:
+        actions.append(QueryJobModel.Error.set(error))
+    job.update(actions=actions)
@@ -1,5 +1,6 @@
+import os
 from pynamodb.models import Model
-from pynamodb.attributes import UnicodeAttribute, NumberAttribute, MapAttribute
+from pynamodb.attributes import UnicodeAttribute, NumberAttribute, MapAttribute, JSONAttribute
 
 class BirdBaseModel(Model):
     class Meta:
@@ -40,4 +41,47 @@ class BirdBaseIndexModel(Model):
     TagValue = NumberAttribute()
 
     # UUID of the media file
-    MediaID = UnicodeAttribute(range_key=True)
\ No newline at end of file
+    MediaID = UnicodeAttribute(range_key=True)
+
+    # Copies of the BirdBase attributes so a search can answer from the index alone.
+    # Rows written before these existed leave them empty and get hydrated from BirdBase.
+    FileType = UnicodeAttribute(null=True)
+    MediaURL = UnicodeAttribute(null=True)
+    ThumbnailURL = UnicodeAttribute(null=True)
+    Uploader = UnicodeAttribute(null=True)
+
+class QueryJobModel(Model):
+    class Meta:
+        table_name = os.environ.get("QUERY_JOB_TABLE", "QueryJobs")
+        region = 'us-east-1'
+        read_capacity_units = 1
+        write_capacity_units = 1
+
+    # Hash of the video content and detection settings, so a repeat is the same job
+    JobID = UnicodeAttribute(hash_key=True)
+
+    # QUEUED, RUNNING, DONE or FAILED
+    Status = UnicodeAttribute()
+
+    # Uploaded query video under the queries/ prefix
+    SourceKey = UnicodeAttribute()
+
+    # {"tags": {species: count}, "media_ids": [...], "total": n}, at most
+    # QUERY_JOB_MAX_RESULTS IDs so the item stays under 400 KB; URLs are signed when fetched
+    Result = JSONAttribute(null=True)
+    Error = UnicodeAttribute(null=True)
+
+    CreatedAt = NumberAttribute()
+    UpdatedAt = NumberAttribute()
+
+    # Epoch seconds; the table's TTL removes cached results after this
+    ExpiresAt = NumberAttribute()
+
+def media_record(index_item):
+    """
+    Returns something with the BirdBase attributes for an index row: the row itself when
+    the media attributes were copied onto it, otherwise the BirdBase record.
+    """
+    if index_item.FileType is not None and index_item.MediaURL is not None:
+        return index_item
+    return BirdBaseModel.get(index_item.MediaID)
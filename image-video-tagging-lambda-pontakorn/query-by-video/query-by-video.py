@@ -1,12 +1,16 @@
-import base64
 import boto3
 import cv2 as cv
 import json
 import os
+import time
 import supervision as sv
 from ultralytics import YOLO
 import helpers as _
-from models import BirdBaseModel, BirdBaseIndexModel
+import jobs
+from models import BirdBaseModel, BirdBaseIndexModel, media_record
+
+# Time kept back from a budgeted query for the index lookup and the response
+RESPONSE_RESERVE_MS = int(os.environ.get("RESPONSE_RESERVE_MS", "3000"))
 
 
 def count_items(input_list: list):
@@ -36,16 +40,120 @@ def update_items(prev_list: dict, curr_list: dict):
                 prev_list[key] = value
 
 
-def video_prediction(video_path: str, model_path: str, confidence: int = 0.5, frame_skip: int = 1):
+def coarse_to_fine(frame_total: int, first: int = 8, min_step: int = 1):
+    """
+    Yields frame indices spread over the whole video first, then the frames halfway
+    between those already taken, until every min_step-th frame has been yielded.
+    Stopping at any point leaves an evenly spaced sample.
+    """
+    step = max(frame_total // first, min_step)
+    seen = set()
+    while True:
+        for index in range(0, frame_total, step):
+            if index not in seen:
+                seen.add(index)
+                yield index
+        if step <= min_step:
+            return
+        step = max(step // 2, min_step)
+
+
+def sampled_prediction(video_path: str, model, confidence: float, frame_skip: int, budget_ms: float, time_left=None):
+    """
+    Runs the model on coarse-to-fine sampled frames until the budget is spent.
+    Counts are the most birds of each species seen in one frame. There is no tracker,
+    because the sampled frames aren't consecutive.
+
+    Parameters:
+        video_path (str): Path or URL of the video.
+        model: Loaded YOLO model.
+        confidence (float): 0-1, only results over this value are saved.
+        frame_skip (int): Finest sampling step; every Nth frame means full coverage.
+        budget_ms (float): Time allowed for sampling.
+        time_left: Optional callable returning the milliseconds left (e.g. the Lambda context's).
+
+    Returns:
+        tuple: (tags, whether every frame_skip-th frame was processed)
+    """
+    started = time.monotonic()
+    class_dict = model.names
+    cap = cv.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise Exception("Error: couldn't open the video!")
+
+    try:
+        frame_total = int(cap.get(cv.CAP_PROP_FRAME_COUNT))
+        if frame_total <= 0:
+            raise Exception("Error: couldn't read the video's frame count!")
+
+        tags = {}
+        sampled = 0
+        frame_cost_ms = 0.0
+        position = 0
+        complete = True
+        for index in coarse_to_fine(frame_total, min_step=frame_skip):
+            elapsed_ms = (time.monotonic() - started) * 1000
+            remaining_ms = budget_ms - elapsed_ms
+            if time_left is not None:
+                remaining_ms = min(remaining_ms, time_left())
+            # stop before a frame that wouldn't finish in time; always do at least one
+            if sampled and remaining_ms < frame_cost_ms:
+                complete = False
+                break
+
+            # seeking is only needed when the next frame isn't the one after the last
+            if index != position:
+                cap.set(cv.CAP_PROP_POS_FRAMES, index)
+            ret, frame = cap.read()
+            position = index + 1
+            if not ret:
+                continue
+
+            result = model(frame, verbose=False)[0]
+            detections = sv.Detections.from_ultralytics(result)
+            if detections.class_id is not None:
+                detections = detections[(detections.confidence > confidence)]
+                labels = [f"{class_dict[cls_id]}" for cls_id in detections.class_id]
+                update_items(tags, count_items(labels))
+
+            sampled += 1
+            frame_cost_ms = (time.monotonic() - started) * 1000 / sampled
+
+        print(f"Sampled {sampled} of {frame_total} frames in {(time.monotonic() - started) * 1000:.0f} ms, complete: {complete}")
+        return tags, complete
+
+    finally:
+        cap.release()
+
+
+def video_prediction(
+    video_path: str,
+    model_path: str,
+    confidence: int = 0.5,
+    frame_skip: int = 1,
+    budget_ms: float = None,
+    time_left=None,
+):
     """
     Function to make predictions on video frames using a trained YOLO model.
     
     Parameters:
-        video_path (str): Path to the video file.
+        video_path (str): Path or URL of the video (e.g. a presigned S3 URL, read as a stream).
         model_path (str): path to the model.
         confidence (float): 0-1, only results over this value are saved.
         frame_skip (int): Process every Nth frame (1 = all frames, 2 = every other frame, etc.)
+        budget_ms (float): If set, sample frames coarse-to-fine for at most this long
+            instead of tracking through every frame.
+        time_left: Optional callable returning the milliseconds left, e.g.
+            context.get_remaining_time_in_millis; sampling also stops on it.
+
+    Returns:
+        tuple: (tags, whether the whole video was covered)
     """
+    if budget_ms is not None:
+        return sampled_prediction(video_path, YOLO(model_path), confidence, frame_skip, budget_ms, time_left)
+
+    cap = None
     try:
         # Load video info and extract width, height, and frames per second (fps)
         video_info = sv.VideoInfo.from_video_path(video_path=video_path)
@@ -94,7 +202,7 @@ def video_prediction(video_path: str, model_path: str, confidence: int = 0.5, fr
 
                 update_items(tags, count_items(labels_1))
 
-        return tags
+        return tags, True
 
     except Exception as e:
         print(f"An error occurred: {e}")
@@ -107,16 +215,159 @@ def video_prediction(video_path: str, model_path: str, confidence: int = 0.5, fr
             print("Released video capture resources.")
 
 
+def detection_settings():
+    """
+    Detection settings from the environment; they are also part of a job's cache key.
+    """
+    return {
+        "model_bucket": os.environ.get("MODEL_BUCKET_NAME", "birdstore"),
+        "model_key": os.environ.get("MODEL_KEY", "models/model.pt"),
+        "confidence": float(os.environ.get("CONFIDENCE_THRESHOLD", "0.5")),
+        "frame_skip": int(os.environ.get("FRAME_SKIP", "1")),
+    }
+
+
+def find_matching_media(filter_tags: dict):
+    """
+    Queries BirdBaseIndex for media that has at least the given count of every species.
+
+    Returns:
+        tuple: (set of matching MediaIDs, index row per MediaID)
+    """
+    matching_ids = None
+    index_rows = {}
+
+    for species, min_count in filter_tags.items():
+        # Query BirdBaseIndexModel for each tag
+        result_ids = set()
+        for item in BirdBaseIndexModel.query(species):
+            if item.TagValue >= min_count:
+                result_ids.add(item.MediaID)
+                index_rows.setdefault(item.MediaID, item)
+
+        # Intersect with previous results to satisfy all tag conditions
+        if matching_ids is None:
+            matching_ids = result_ids
+        else:
+            matching_ids &= result_ids
+
+    return matching_ids or set(), index_rows
+
+
+def run_job(message: dict):
+    """
+    Worker side of an async query: runs detection on the job's uploaded video and
+    stores the detected tags and matching MediaIDs on the job.
+    """
+    job = jobs.get_job(message["job_id"])
+    if job is None or not jobs.claim(job):
+        # a redelivered message for a job another worker already ran or is running
+        print(f"Job {message['job_id']} is not queued, skipping it")
+        return
+
+    settings = detection_settings()
+    s3 = boto3.client("s3")
+    print(f"Running job {job.JobID} on {job.SourceKey}")
+
+    try:
+        # Kept between jobs on a warm worker
+        model_path = f"/tmp/model_worker_{os.path.basename(settings['model_key'])}"
+        if not os.path.exists(model_path):
+            s3.download_file(settings["model_bucket"], settings["model_key"], model_path)
+
+        video_url = s3.generate_presigned_url(
+            "get_object", Params={"Bucket": _.QUERY_BUCKET, "Key": job.SourceKey}, ExpiresIn=900
+        )
+        tags, _complete = video_prediction(video_url, model_path, settings["confidence"], settings["frame_skip"])
+        matching_ids, _index_rows = find_matching_media(tags or {})
+        jobs.set_status(job, jobs.DONE, result=jobs.job_result(tags or {}, matching_ids))
+        print(f"Job {job.JobID} done: {tags}, {len(matching_ids)} matches")
+    except Exception as e:
+        print(f"Job {job.JobID} failed: {e}")
+        jobs.set_status(job, jobs.FAILED, error=str(e))
+
+
+def job_response(job, s3, fields=None, event=None, reused=False):
+    """
+    Status of a job; a finished job also gets its results, with URLs signed now
+    rather than when the job ran.
+    """
+    body = {
+        "job_id": job.JobID,
+        "status": job.Status,
+        "cached": reused and job.Status == jobs.DONE,
+    }
+    if job.Status == jobs.FAILED:
+        body["error"] = job.Error
+    if job.Status != jobs.DONE:
+        return _.build_response(202 if job.Status in (jobs.QUEUED, jobs.RUNNING) else 200, body, event=event)
+
+    results = []
+    media_ids = job.Result.get("media_ids", [])
+    if media_ids:
+        for item in BirdBaseModel.batch_get(media_ids):
+            results.append(_.media_result(item, s3, fields))
+    total = job.Result.get("total", len(media_ids))
+    body.update({
+        "message": f"Succeeded! Got {len(results)} records",
+        "detected_tags": job.Result.get("tags", {}),
+        "total_matches": total,
+        # only the first QUERY_JOB_MAX_RESULTS matches are stored
+        "truncated": total > len(media_ids),
+        "results": results
+    })
+    return _.build_response(200, body, event=event)
+
+
+def submit_job(event, body, s3, fields=None):
+    """
+    Queues an async query for the video in the request and returns its job ID, or the
+    finished result straight away when the same video was already processed.
+    """
+    queue = jobs.get_queue(run_job)
+    if queue is None:
+        return _.build_response(503, {
+            "message": "Async queries are not available",
+            "error": "QUERY_JOB_QUEUE_URL is not configured"
+        }, event=event)
+
+    query_key = _.query_object_key(body)
+    if query_key:
+        # a single-part upload's ETag is the MD5 of its content
+        try:
+            head = s3.head_object(Bucket=_.QUERY_BUCKET, Key=query_key)
+        except s3.exceptions.ClientError:
+            raise ValueError(f"Nothing has been uploaded to '{query_key}'")
+        video_hash = head["ETag"].strip('"')
+    else:
+        # the worker reads the video from S3, so inline videos are stored first
+        video_data = _.query_media_bytes(event, body, "video", s3)
+        video_hash = jobs.content_hash(video_data)
+        query_key = f"{_.QUERY_PREFIX}{video_hash}"
+        s3.put_object(Bucket=_.QUERY_BUCKET, Key=query_key, Body=video_data)
+        del video_data
+
+    job, reused = jobs.submit(queue, video_hash, query_key, detection_settings())
+    return job_response(job, s3, fields, event, reused)
+
+
 def lambda_handler(event, context):
     model_temp_path = None
     vid_temp_path = None
 
+    # SQS delivering async query jobs
+    if event.get("Records"):
+        for record in event["Records"]:
+            run_job(json.loads(record["body"]))
+        return {"statusCode": 200, "body": json.dumps({"jobs": len(event["Records"])})}
+
     try:
         # Get environment variables
-        model_bucket = os.environ.get("MODEL_BUCKET_NAME", "birdstore")
-        model_key = os.environ.get("MODEL_KEY", "models/model.pt")
-        confidence_threshold = float(os.environ.get("CONFIDENCE_THRESHOLD", "0.5"))
-        frame_skip = int(os.environ.get("FRAME_SKIP", "1"))
+        settings = detection_settings()
+        model_bucket = settings["model_bucket"]
+        model_key = settings["model_key"]
+        confidence_threshold = settings["confidence"]
+        frame_skip = settings["frame_skip"]
 
         print(f"Using model bucket: {model_bucket}")
         print(f"Using model key: {model_key}")
@@ -124,55 +375,105 @@ def lambda_handler(event, context):
         print(f"Using frame skip: {frame_skip}")
 
         s3 = boto3.client("s3")
+        params = event.get("queryStringParameters") or {}
+
+        # ?upload=1 hands out a presigned PUT; the query then sends {"s3_key": ...}
+        if params.get("upload"):
+            return _.build_response(200, _.query_upload(s3, params.get("content_type") or "video/mp4"))
+
+        # ?job_id=... polls an async query and returns its results once it's done
+        if params.get("job_id"):
+            job = jobs.get_job(params["job_id"])
+            if job is None:
+                return _.build_response(404, {
+                    "message": "An error occurred while processing your request",
+                    "error": f"No job '{params['job_id']}'"
+                })
+            return job_response(job, s3, _.parse_fields(params.get("fields")), event)
 
-        # Download model
-        print("Downloading model from S3...")
-        model_temp_path = f"/tmp/model_{context.aws_request_id}_{os.path.basename(model_key)}"
-        s3.download_file(model_bucket, model_key, model_temp_path)
-
-        # Process base64 encoded video from request
         if not event.get("body"):
-            return {
-                "statusCode": 400,
-                "body": json.dumps({"error": "No request body found"}),
-            }
-
-        # Parse JSON body to get base64 video data
-        try:
-            body = json.loads(event["body"])
-        except json.JSONDecodeError:
             return _.build_response(400, {
                 "message": "An error occurred while processing your request",
-                "error": "Invalid JSON in request body"
+                "error": "No request body found"
             })
 
-        # Extract base64 video data
-        if "video" not in body:
+        # A JSON body carries the video as base64 or an s3_key; any other
+        # Content-Type (e.g. video/mp4) is the video itself
+        body = {}
+        if _.is_json_request(event):
+            try:
+                body = json.loads(event["body"])
+            except json.JSONDecodeError:
+                return _.build_response(400, {
+                    "message": "An error occurred while processing your request",
+                    "error": "Invalid JSON in request body"
+                })
+
+        # Optional projection, e.g. "ids", "thumbnails" or "MediaID,FileType"
+        fields = _.parse_fields(body.get("fields") or params.get("fields"))
+
+        # budget_ms trades accuracy for latency: frames are sampled coarse-to-fine
+        # until it runs out, and the response says whether the whole video was covered
+        budget_ms = body.get("budget_ms") or params.get("budget_ms")
+        try:
+            budget_ms = float(budget_ms) if budget_ms else None
+        except ValueError:
             return _.build_response(400, {
                 "message": "An error occurred while processing your request",
-                "error": "No 'image' field found in request body"
+                "error": "'budget_ms' must be a number"
             })
+        time_left = None
+        if budget_ms is not None and context is not None:
+            time_left = lambda: context.get_remaining_time_in_millis() - RESPONSE_RESERVE_MS
+
+        # "async": true (or ?async=1) queues the query instead of waiting for it
+        if str(body.get("async") or params.get("async") or "").lower() in ("1", "true"):
+            try:
+                return submit_job(event, body, s3, fields)
+            except ValueError as e:
+                return _.build_response(400, {
+                    "message": "An error occurred while processing your request",
+                    "error": str(e)
+                })
+
+        # Download model
+        print("Downloading model from S3...")
+        model_temp_path = f"/tmp/model_{context.aws_request_id}_{os.path.basename(model_key)}"
+        s3.download_file(model_bucket, model_key, model_temp_path)
 
-        print("Processing base64 encoded video data...")
         try:
-            video_data = base64.b64decode(body["video"])
-        except Exception as e:
+            query_key = _.query_object_key(body)
+            if query_key:
+                # OpenCV streams the upload over HTTP, so it is never copied into the Lambda
+                print(f"Streaming query video from {_.QUERY_BUCKET}/{query_key}")
+                try:
+                    s3.head_object(Bucket=_.QUERY_BUCKET, Key=query_key)
+                except s3.exceptions.ClientError:
+                    raise ValueError(f"Nothing has been uploaded to '{query_key}'")
+                video_source = s3.generate_presigned_url(
+                    "get_object", Params={"Bucket": _.QUERY_BUCKET, "Key": query_key}, ExpiresIn=900
+                )
+            else:
+                video_data = _.query_media_bytes(event, body, "video", s3)
+
+                # OpenCV needs a file for in-request bytes
+                print("Saving video data to temporary file...")
+                vid_temp_path = f"/tmp/vid_{context.aws_request_id}"
+                with open(vid_temp_path, "wb") as f:
+                    f.write(video_data)
+                del video_data
+                video_source = vid_temp_path
+        except ValueError as e:
             return _.build_response(400, {
                 "message": "An error occurred while processing your request",
-                "error": f"Invalid base64 image data: {str(e)}"
+                "error": str(e)
             })
 
-        # Save video data to temporary file
-        print("Saving video data to temporary file...")
-
-        vid_temp_path = f"/tmp/img_{context.aws_request_id}"
-
-        with open(vid_temp_path, "wb") as f:
-            f.write(video_data)
-
         print("Making predictions...")
         try:
-            tags = video_prediction(vid_temp_path, model_temp_path, confidence_threshold, frame_skip)
+            tags, complete = video_prediction(
+                video_source, model_temp_path, confidence_threshold, frame_skip, budget_ms, time_left
+            )
         except Exception as e:
             return _.build_response(500, {
                 "message": "An error occurred while processing your request",
@@ -185,49 +486,31 @@ def lambda_handler(event, context):
         print(f"Detected tags: {filter_tags}")
 
         # Query database for each detected species
-        matching_ids = None
-
-        for species, min_count in filter_tags.items():
-            # Query BirdBaseIndexModel for each tag
-            result_ids = set()
-            for item in BirdBaseIndexModel.query(species):
-                if item.TagValue >= min_count:
-                    result_ids.add(item.MediaID)
-                    result_ids.add(item.MediaID)
-            
-            # Intersect with previous results to satisfy all tag conditions
-            if matching_ids is None:
-                matching_ids = result_ids
-            else:
-                matching_ids &= result_ids
+        matching_ids, index_rows = find_matching_media(filter_tags)
 
         if not matching_ids:
             return _.build_response(200, {
                 "message": "No results found",
+                "detected_tags": filter_tags,
+                "complete": complete,
                 "results": []
             })
 
         # Retrieve media records from BirdBaseModel
         results = []
         for media_id in matching_ids:
-            item = BirdBaseModel.get(media_id)
-        for media_id in matching_ids:
-            item = BirdBaseModel.get(media_id)
-            results.append({
-                "MediaID": item.MediaID,
-                "FileType": item.FileType,
-                "MediaURL": _.generate_presigned_url(item.MediaURL, s3),
-                "ThumbnailURL": _.generate_presigned_url(item.ThumbnailURL, s3),
-            #    "UploadedDate": item.UploadedDate,
-                "Uploader": item.Uploader
-            })
+            # Index rows carry the media attributes, so BirdBase is only read for old rows
+            item = media_record(index_rows[media_id])
+            results.append(_.media_result(item, s3, fields))
 
         print(f"Retrived results: {results}")
 
         return _.build_response(200, {
             "message": f"Succeeded! Got {len(results)} records",
+            "detected_tags": filter_tags,
+            "complete": complete,
             "results": results
-        })
+        }, event=event)
 
     except Exception as e:
         return _.build_response(500, {
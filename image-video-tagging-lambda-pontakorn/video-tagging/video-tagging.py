@@ -3,7 +3,18 @@ import cv2 as cv
 import os
 import json
 import supervision as sv
+from concurrent.futures import ThreadPoolExecutor
 from ultralytics import YOLO
+import pipeline
+
+# Where the BirdNET checkpoint the audio track is scored with lives in S3
+BIRDNET_MODEL_BUCKET = os.environ.get("BIRDNET_MODEL_BUCKET", "birdstore")
+BIRDNET_MODEL_PREFIX = os.environ.get("BIRDNET_MODEL_PREFIX", "models/V2.4/")
+
+# DetectionSource values stored on each BirdBaseIndex row
+SOURCE_FRAMES = "frames"
+SOURCE_AUDIO = "audio"
+SOURCE_BOTH = "frames+audio"
 
 
 def count_items(input_list: list):
@@ -98,7 +109,81 @@ def publish_sns_notification(sns_client, tag_name: str, message_data: dict):
         return None
 
 
-def update_dynamodb_tags(table, media_id: str, tag_counts: dict):
+def get_media_attributes(base_table, media_id: str):
+    """
+    Reads the BirdBase attributes that get copied onto every BirdBaseIndex row,
+    so searches can answer from the index without a second read per result.
+
+    Parameters:
+        base_table: DynamoDB BirdBase table resource
+        media_id (str): The media ID to look up
+
+    Returns:
+        dict: FileType, MediaURL, ThumbnailURL and Uploader (empty if not found)
+    """
+    try:
+        response = base_table.get_item(
+            Key={"MediaID": media_id},
+            ProjectionExpression="FileType, MediaURL, ThumbnailURL, Uploader",
+        )
+        return response.get("Item", {})
+    except Exception as e:
+        print(f"Error reading media attributes for '{media_id}': {e}")
+        return {}
+
+
+def frame_tag_for(species: str, frame_tags: dict):
+    """
+    Maps an audio species onto the frame-tag vocabulary: a frame tag matches when it is
+    the species' common name or its last words, e.g. "crow" for "american crow".
+    Species without a matching frame tag keep their own name.
+    """
+    for tag_name in frame_tags:
+        if species == tag_name or species.endswith(" " + tag_name):
+            return tag_name
+    return species
+
+
+def merge_tags(frame_tags: dict, audio_tags: dict):
+    """
+    Merges the tags seen in the frames with the species heard on the audio track.
+    TagValue stays in frame units, the most birds of a tag seen in one frame, so
+    tag>=N searches mean the same for every video. Audio only adds presence: audio
+    species are mapped onto the frame tags with frame_tag_for, a tag found by both
+    keeps its frame count and a tag only heard is stored with a count of 1.
+
+    Parameters:
+        frame_tags (dict): Tag counts from the frames
+        audio_tags (dict): Species heard on the audio track, keyed by pipeline.species_tag
+
+    Returns:
+        tuple: (merged tag counts, DetectionSource of each tag)
+    """
+    heard = {frame_tag_for(species, frame_tags) for species in audio_tags}
+
+    tag_counts = dict(frame_tags)
+    for tag_name in heard:
+        # the number of windows a call spans says nothing about how many birds there are
+        tag_counts.setdefault(tag_name, 1)
+
+    sources = {}
+    for tag_name in tag_counts:
+        if tag_name in frame_tags and tag_name in heard:
+            sources[tag_name] = SOURCE_BOTH
+        elif tag_name in heard:
+            sources[tag_name] = SOURCE_AUDIO
+        else:
+            sources[tag_name] = SOURCE_FRAMES
+    return tag_counts, sources
+
+
+def update_dynamodb_tags(
+    table,
+    media_id: str,
+    tag_counts: dict,
+    media_attributes: dict = None,
+    detection_sources: dict = None,
+):
     """
     Creates separate items for each tag with TagName as hash key and MediaID as range key.
     Overwrites existing items without checking.
@@ -107,18 +192,22 @@ def update_dynamodb_tags(table, media_id: str, tag_counts: dict):
         table: DynamoDB table resource
         media_id (str): The media ID to associate with tags
         tag_counts (dict): Dictionary of tag names and their counts
+        media_attributes (dict): BirdBase attributes to store on each tag item
+        detection_sources (dict): Whether each tag came from the frames, the audio or both
     """
     try:
         # Use batch writing for better performance
         with table.batch_writer() as batch:
             for tag_name, tag_value in tag_counts.items():
-                batch.put_item(
-                    Item={
-                        "TagName": tag_name,
-                        "TagValue": tag_value,
-                        "MediaID": media_id,
-                    }
-                )
+                item = {
+                    **(media_attributes or {}),
+                    "TagName": tag_name,
+                    "TagValue": tag_value,
+                    "MediaID": media_id,
+                }
+                if detection_sources and tag_name in detection_sources:
+                    item["DetectionSource"] = detection_sources[tag_name]
+                batch.put_item(Item=item)
                 print(
                     f"Updated tag '{tag_name}' for MediaID '{media_id}' with value {tag_value}"
                 )
@@ -208,6 +297,52 @@ def video_prediction(
             print("Released video capture resources.")
 
 
+def download_birdnet_model(s3_client, bucket: str, prefix: str):
+    """
+    Downloads the BirdNET checkpoint folder to pipeline.MODEL_DIR, once per container.
+
+    Parameters:
+        s3_client: Boto3 S3 client
+        bucket (str): S3 bucket containing the checkpoint
+        prefix (str): S3 prefix of the checkpoint folder
+    """
+    if os.path.exists(os.path.join(pipeline.MODEL_DIR, pipeline.LABELS_FILE)):
+        return
+
+    print("Downloading BirdNET model from S3...")
+    labels_key = prefix + pipeline.LABELS_FILE
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            if obj["Key"].endswith("/") or obj["Key"] == labels_key:
+                continue
+            local_path = os.path.join(pipeline.MODEL_DIR, obj["Key"][len(prefix):])
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            s3_client.download_file(bucket, obj["Key"], local_path)
+    # the labels file marks a complete download, so it goes last
+    s3_client.download_file(bucket, labels_key, os.path.join(pipeline.MODEL_DIR, pipeline.LABELS_FILE))
+
+
+def audio_prediction(video_path: str):
+    """
+    Runs BirdNET over the audio track of a video, straight from the downloaded file.
+
+    Parameters:
+        video_path (str): Path to the video file.
+
+    Returns:
+        dict: Lowercased common name of each species (pipeline.species_tag) and the
+              number of 3 s windows it was heard in; empty if the video has no audio track
+    """
+    try:
+        detections, _, _ = pipeline.analyze(video_path)
+    except ValueError as e:
+        # ffmpeg fails when there is no audio stream to decode
+        print(f"No usable audio track: {e}")
+        return {}
+    return pipeline.window_counts(detections)
+
+
 def lambda_handler(event, context):
     model_temp_path = None
     vid_temp_path = None
@@ -215,27 +350,32 @@ def lambda_handler(event, context):
     try:
         # Get environment variables
         table_name = os.environ.get("DYNAMODB_TABLE_NAME", "BirdBaseIndex")
+        base_table_name = os.environ.get("BASE_TABLE_NAME", "BirdBase")
         model_bucket = os.environ.get("MODEL_BUCKET_NAME", "birdstore")
         model_key = os.environ.get("MODEL_KEY", "models/model.pt")
         confidence_threshold = float(os.environ.get("CONFIDENCE_THRESHOLD", "0.5"))
         frame_skip = int(os.environ.get("FRAME_SKIP", "1"))
+        audio_tagging = os.environ.get("AUDIO_TAGGING", "true").lower() == "true"
         presigned_url_expiration = int(
             os.environ.get("PRESIGNED_URL_EXPIRATION", "86400") # 24 hours default
         ) 
 
         print(f"Using DynamoDB table: {table_name}")
+        print(f"Using base table: {base_table_name}")
         print(f"Using model bucket: {model_bucket}")
         print(f"Using model key: {model_key}")
         print(f"Using confidence threshold: {confidence_threshold}")
         print(f"Using frame skip: {frame_skip}")
+        print(f"Using audio tagging: {audio_tagging}")
         print(f"Using presigned url expiration: {presigned_url_expiration}")
 
         s3 = boto3.client("s3")
         dynamodb = boto3.resource("dynamodb")
         sns = boto3.client("sns")
 
-        # Get DynamoDB table
+        # Get DynamoDB tables
         table = dynamodb.Table(table_name)
+        base_table = dynamodb.Table(base_table_name)
 
         # Download model
         print("Downloading model from S3...")
@@ -256,16 +396,36 @@ def lambda_handler(event, context):
         vid_temp_path = f"/tmp/img_{context.aws_request_id}_{os.path.basename(vid_key)}"
         s3.download_file(vid_bucket, vid_key, vid_temp_path)
 
+        # The audio track is scored from the same download while the frames are analyzed
+        audio_future = None
+        if audio_tagging:
+            download_birdnet_model(s3, BIRDNET_MODEL_BUCKET, BIRDNET_MODEL_PREFIX)
+            audio_executor = ThreadPoolExecutor(max_workers=1)
+            audio_future = audio_executor.submit(audio_prediction, vid_temp_path)
+            audio_executor.shutdown(wait=False)
+
         print("Making predictions...")
         tags = video_prediction(
             vid_temp_path, model_temp_path, confidence_threshold, frame_skip
         )
 
+        audio_tags = {}
+        if audio_future:
+            try:
+                audio_tags = audio_future.result()
+                print(f"Audio track species: {audio_tags}")
+            except Exception as e:
+                # the frame tags are still stored without the audio
+                print(f"Error tagging the audio track: {e}")
+
         print(f"Updating DynamoDB for UUID: {file_uuid}")
         # Convert tags and update DynamoDB
-        tag_counts = tags
+        tag_counts, detection_sources = merge_tags(tags, audio_tags)
         if tag_counts:
-            update_dynamodb_tags(table, file_uuid, tag_counts)
+            media_attributes = get_media_attributes(base_table, file_uuid)
+            update_dynamodb_tags(
+                table, file_uuid, tag_counts, media_attributes, detection_sources
+            )
             print("DynamoDB updated successfully")
 
             # Generate presigned URL for the image
@@ -312,6 +472,7 @@ def lambda_handler(event, context):
                 "message": f"Successfully processed {vid_key}",
                 "MediaID": file_uuid,
                 "tag_counts": tag_counts,
+                "detection_sources": detection_sources,
                 "bucket": vid_bucket,
                 "key": vid_key,
                 "sns_notifications": sns_message_ids,